@@ -0,0 +1,160 @@
+"""Utility functions to measure the read throughput of the storage devices.
+
+The tests only ever read: the devices are opened read-only, with O_DIRECT so
+that the page cache is bypassed and the storage itself is measured. The queue
+depth is the number of threads with a read in flight; the reads release the GIL,
+so the threads keep the device busy while python accounts the latencies. The
+latencies are sampled, so that long tests of fast devices use a bounded memory.
+"""
+
+import logging
+import mmap
+import os
+import random
+import stat
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+SEQUENTIAL = "sequential"
+RANDOM = "random"
+PATTERNS = [SEQUENTIAL, RANDOM]
+PERCENTILES = [50, 90, 99, 99.9]
+SECTOR_SIZE = 512
+# latencies kept per test, shared by its readers, enough for the p99.9 percentile
+LATENCY_SAMPLES = 100000
+
+
+def _percentile(latencies, percentile):
+    """Return the percentile of the sorted latencies."""
+    index = min(len(latencies) - 1, int(len(latencies) * percentile / 100))
+    return latencies[index]
+
+
+def summarize(nbytes, latencies, elapsed, reads=None, slowest=None):
+    """Return the throughput, IOPS and latency percentiles of a test.
+
+    latencies may be a sample of the latencies of the reads, in which case the
+    number of reads and the slowest read are given too.
+    """
+    latencies = sorted(latencies)
+    if reads is None:
+        reads = len(latencies)
+    summary = {
+        "mb-per-s": round(nbytes / elapsed / 10**6, 1),
+        "iops": round(reads / elapsed),
+    }
+    if latencies:
+        summary["latency-us"] = {
+            f"p{percentile:g}": round(_percentile(latencies, percentile) * 10**6)
+            for percentile in PERCENTILES
+        }
+        summary["latency-us"]["max"] = round(
+            (latencies[-1] if slowest is None else slowest) * 10**6
+        )
+    return summary
+
+
+def _size(fd):
+    """Return the size in bytes of an open block device or file."""
+    return os.lseek(fd, 0, os.SEEK_END)
+
+
+def _open(path, direct):
+    """Open a block device or regular file read-only."""
+    mode = os.stat(path).st_mode
+    if not (stat.S_ISBLK(mode) or stat.S_ISREG(mode)):
+        raise ValueError(f"{path} is neither a block device nor a regular file")
+    return os.open(path, os.O_RDONLY | (os.O_DIRECT if direct else 0))
+
+
+def run(paths, pattern, block_size, queue_depth, duration, direct=True):
+    """Read from the paths for duration seconds and return the summary.
+
+    The queue depth is spread round-robin over the paths, and raised to the
+    number of paths so that every path is read. Sequential readers each start at
+    their own offset and read consecutive blocks, random readers pick block
+    aligned offsets across the whole device. Each reader keeps a uniform sample
+    of its latencies (reservoir sampling). ValueError is raised for invalid
+    parameters, OSError if the devices cannot be read.
+    """
+    if pattern not in PATTERNS:
+        raise ValueError(f"unknown pattern {pattern}")
+    if block_size <= 0 or block_size % SECTOR_SIZE:
+        raise ValueError(f"block size must be a multiple of {SECTOR_SIZE}")
+    if queue_depth < 1 or duration <= 0:
+        raise ValueError("queue depth and duration must be positive")
+
+    fds = []
+    try:
+        for path in paths:
+            fds.append(_open(path, direct))
+        blocks = min(_size(fd) for fd in fds) // block_size
+        if not blocks:
+            raise ValueError(f"devices are smaller than the block size {block_size}")
+
+        if queue_depth < len(fds):
+            logger.info("Raising the queue depth to %d, one read per path", len(fds))
+            queue_depth = len(fds)
+        samples = max(1, LATENCY_SAMPLES // queue_depth)
+        results = [None] * queue_depth
+        errors = []
+        deadline = time.monotonic() + duration
+
+        def reader(index):
+            fd = fds[index % len(fds)]
+            # anonymous mappings are page aligned, as O_DIRECT requires
+            buffer = mmap.mmap(-1, block_size)
+            block = index * blocks // queue_depth
+            nbytes, reads, slowest, latencies = 0, 0, 0.0, []
+            try:
+                while time.monotonic() < deadline:
+                    if pattern == RANDOM:
+                        block = random.randrange(blocks)
+                    start = time.perf_counter()
+                    nbytes += os.preadv(fd, [buffer], block * block_size)
+                    latency = time.perf_counter() - start
+                    reads += 1
+                    slowest = max(slowest, latency)
+                    if len(latencies) < samples:
+                        latencies.append(latency)
+                    else:
+                        slot = random.randrange(reads)
+                        if slot < samples:
+                            latencies[slot] = latency
+                    block = (block + 1) % blocks
+            except OSError as err:
+                errors.append(err)
+            finally:
+                buffer.close()
+            results[index] = (nbytes, reads, slowest, latencies)
+
+        logger.info(
+            "Running %s read test on %s, block size %d, queue depth %d, for %ss",
+            pattern,
+            ", ".join(paths),
+            block_size,
+            queue_depth,
+            duration,
+        )
+        start = time.perf_counter()
+        threads = [threading.Thread(target=reader, args=(index,)) for index in range(queue_depth)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+    finally:
+        for fd in fds:
+            os.close(fd)
+
+    if errors:
+        raise errors[0]
+    return summarize(
+        sum(result[0] for result in results),
+        [latency for *_, latencies in results for latency in latencies],
+        elapsed,
+        reads=sum(result[1] for result in results),
+        slowest=max(result[2] for result in results),
+    )
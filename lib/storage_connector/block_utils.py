@@ -0,0 +1,163 @@
+"""Utility functions to tune the block layer queues of the storage devices.
+
+The queue settings are applied by udev rules, so that they are set on the SCSI
+paths and multipath devices as soon as they appear, including after a reboot or
+a rescan. Existing devices get the settings by replaying a change event.
+"""
+
+import json
+import logging
+from collections import namedtuple
+from fnmatch import fnmatch
+from pathlib import Path
+
+from storage_connector import command_utils
+
+logger = logging.getLogger(__name__)
+
+SYS_BLOCK = Path("/sys/block")
+SCHEDULERS = ["none", "mq-deadline", "kyber", "bfq"]
+# queue attributes which can be set, with their minimum and maximum values
+QUEUE_LIMITS = {
+    "nr_requests": (4, 65536),
+    "read_ahead_kb": (0, 65536),
+    "max_sectors_kb": (4, 65536),
+    "rq_affinity": (0, 2),
+    "add_random": (0, 1),
+}
+QUEUE_SETTINGS = ["scheduler"] + list(QUEUE_LIMITS)
+MATCH_KEYS = ["vendor", "product", "alias"]
+# characters which cannot be matched on, they would break out of the udev rule
+FORBIDDEN_CHARACTERS = ['"', "\\", ",", "\n", "\r"]
+# kernel names of the devices the rules apply to
+DEVICE_PATTERNS = ["sd*", "dm-*"]
+
+QueueRule = namedtuple("QueueRule", ["vendor", "product", "alias", "settings"])
+
+
+def _parse_rule(entry):
+    """Parse and validate a single queue rule."""
+    if not isinstance(entry, dict):
+        raise ValueError("expected a dictionary per rule")
+    match = {key: entry.get(key) for key in MATCH_KEYS}
+    for key, value in match.items():
+        if value is None:
+            continue
+        if not isinstance(value, str):
+            raise ValueError(f"{key} must be a string")
+        if any(character in value for character in FORBIDDEN_CHARACTERS):
+            raise ValueError(f"{key} must not contain quotes, backslashes, commas or newlines")
+    if bool(match["alias"]) == bool(match["vendor"]) or (match["product"] and match["alias"]):
+        raise ValueError("each rule must match either a vendor (and product) or an alias")
+
+    settings = {}
+    for key, value in entry.items():
+        if key in MATCH_KEYS:
+            continue
+        if key == "scheduler":
+            if value not in SCHEDULERS:
+                raise ValueError(f"scheduler must be one of {', '.join(SCHEDULERS)}")
+        elif key in QUEUE_LIMITS:
+            minimum, maximum = QUEUE_LIMITS[key]
+            if isinstance(value, bool) or not isinstance(value, int):
+                raise ValueError(f"{key} must be an integer")
+            if not minimum <= value <= maximum:
+                raise ValueError(f"{key} must be between {minimum} and {maximum}")
+        else:
+            raise ValueError(f"unknown queue setting {key}")
+        settings[key] = value
+    if not settings:
+        raise ValueError("each rule must set at least one queue setting")
+    # the scheduler goes first, changing it resets nr_requests
+    settings = {key: settings[key] for key in QUEUE_SETTINGS if key in settings}
+    return QueueRule(settings=settings, **match)
+
+
+def parse_queue_rules(value):
+    """Parse the queue rules from a JSON list.
+
+    Each rule matches the SCSI devices of a vendor (and optionally product), or
+    a multipath device by alias, and sets queue attributes on them. ValueError is
+    raised if the rules are malformed.
+    """
+    try:
+        entries = json.loads(value or "[]")
+    except json.JSONDecodeError as err:
+        raise ValueError(f"invalid JSON, {err}") from None
+    if not isinstance(entries, list):
+        raise ValueError("expected a list of rules")
+    return [_parse_rule(entry) for entry in entries]
+
+
+def _matches(rule, device):
+    """Return whether the udev rule matches the block device, as udev would."""
+    if rule.alias:
+        return fnmatch(_read_attribute(device / "dm" / "name") or "", rule.alias)
+    vendor = _read_attribute(device / "device" / "vendor") or ""
+    model = _read_attribute(device / "device" / "model") or ""
+    return fnmatch(vendor, f"{rule.vendor}*") and fnmatch(model, f"{rule.product or ''}*")
+
+
+def get_rule_devices(rules):
+    """Return the kernel names of the existing devices matched by the rules.
+
+    SCSI disks are matched on their vendor and model prefixes, and multipath
+    devices on their alias.
+    """
+    devices = []
+    for pattern, has_alias in (("sd*[!0-9]", False), ("dm-*", True)):
+        for device in sorted(SYS_BLOCK.glob(pattern)):
+            if any(_matches(rule, device) for rule in rules if bool(rule.alias) == has_alias):
+                devices.append(device.name)
+    return devices
+
+
+def apply_queue_rules(rules):
+    """Reload the udev rules and replay them on the existing devices they match.
+
+    Only the matched devices get a change event, so that the other devices, and
+    the udev rules acting on them, are left alone.
+    """
+    command_utils.check_call(["udevadm", "control", "--reload"])
+    devices = get_rule_devices(rules)
+    if not devices:
+        return
+    logger.info("Applying the block queue udev rules to %s", ", ".join(devices))
+    command_utils.check_call(
+        ["udevadm", "trigger", "--action=change", "--subsystem-match=block"]
+        + [f"--sysname-match={device}" for device in devices]
+    )
+
+
+def _read_attribute(path):
+    """Return the stripped content of a sysfs attribute, or None if missing."""
+    try:
+        return path.read_text().strip()
+    except OSError:
+        return None
+
+
+def get_queue_settings():
+    """Return the queue settings in effect on the SCSI and multipath devices.
+
+    The devices are identified by their vendor and model for SCSI devices, and by
+    their name for device-mapper devices.
+    """
+    devices = {}
+    for pattern in DEVICE_PATTERNS:
+        for device in sorted(SYS_BLOCK.glob(pattern)):
+            if pattern == "sd*":
+                info = {
+                    "vendor": _read_attribute(device / "device" / "vendor"),
+                    "model": _read_attribute(device / "device" / "model"),
+                }
+            else:
+                info = {"name": _read_attribute(device / "dm" / "name")}
+            for setting in QUEUE_SETTINGS:
+                value = _read_attribute(device / "queue" / setting)
+                if setting == "scheduler" and value and "[" in value:
+                    # the active scheduler is the one in brackets
+                    value = value.split("[", 1)[1].split("]", 1)[0]
+                info[setting] = value
+            devices[device.name] = info
+    return devices
@@ -0,0 +1,95 @@
+"""Run the external commands of the charm, accounting for their cost.
+
+Every external command of the charm is run through this module, which records its
+wall time, exit code and output size in the profile of the current hook, see
+timing_utils. Commands slower than the slow command threshold are logged at
+WARNING level, so that the tool dominating a slow hook stands out in the logs. Only the
+name of the command is logged, never its arguments, which may hold secrets such as the
+CHAP passwords set with iscsiadm.
+
+The functions take the same arguments as their subprocess counterparts.
+"""
+
+import logging
+import subprocess
+import time
+from pathlib import PurePath
+
+from storage_connector import timing_utils
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SLOW_THRESHOLD = 10.0
+
+_slow_threshold = DEFAULT_SLOW_THRESHOLD
+
+
+def set_slow_threshold(seconds):
+    """Set the wall time in seconds above which a command is logged as slow."""
+    global _slow_threshold  # pylint: disable=global-statement
+    _slow_threshold = seconds
+
+
+def get_name(args):
+    """Return the name of the command run by args, e.g. iscsiadm."""
+    if isinstance(args, str):
+        args = args.split()
+    return PurePath(args[0]).name
+
+
+def _run(function, args, has_exit_code=True, returns_exit_code=False, **kwargs):
+    """Run the command with the subprocess function, and account for it.
+
+    The exit code is None if the command could not be run, or if the function
+    does not tell it. returns_exit_code tells the function returns the exit code
+    instead of the output.
+    """
+    start = time.perf_counter()
+    returncode = None
+    output = None
+    try:
+        result = function(args, **kwargs)
+        if returns_exit_code:
+            returncode = result
+        else:
+            output = result
+            if has_exit_code:
+                returncode = 0
+        return result
+    except subprocess.CalledProcessError as err:
+        returncode, output = err.returncode, err.output
+        raise
+    finally:
+        duration = time.perf_counter() - start
+        size = len(output) if isinstance(output, (bytes, str)) else 0
+        name = get_name(args)
+        timing_utils.record_command(name, duration, returncode, size)
+        if duration > _slow_threshold:
+            logger.warning(
+                "Slow command %s took %.1f seconds (exit code %s)", name, duration, returncode
+            )
+        else:
+            logger.debug("Command %s took %.3f seconds (exit code %s)", name, duration, returncode)
+
+
+def call(args, **kwargs):
+    """Run the command and return its exit code."""
+    return _run(subprocess.call, args, returns_exit_code=True, **kwargs)
+
+
+def check_call(args, **kwargs):
+    """Run the command, and raise CalledProcessError if it fails."""
+    return _run(subprocess.check_call, args, **kwargs)
+
+
+def check_output(args, **kwargs):
+    """Run the command and return its output, and raise CalledProcessError if it fails."""
+    return _run(subprocess.check_output, args, **kwargs)
+
+
+def getoutput(cmd):
+    """Run the shell command and return its output, whatever its exit code.
+
+    The exit code is not known, getoutput hides it.
+    """
+    return _run(subprocess.getoutput, cmd, has_exit_code=False)
@@ -0,0 +1,69 @@
+"""Profile the charm hooks with cProfile.
+
+Profiling is opt-in: the profiler is only imported and enabled when asked to. The
+profile of each hook is saved as a gzip compressed pstats file, named after the time
+and the hook, in a directory keeping only the most recent profiles. Once decompressed,
+the files can be read with the pstats module or any pstats viewer, e.g. snakeviz.
+"""
+
+import gzip
+import io
+import logging
+import marshal
+import pstats
+import shutil
+import tempfile
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+SUFFIX = ".pstats.gz"
+
+
+def start():
+    """Enable a new profiler and return it, or None if it cannot be enabled."""
+    import cProfile  # pylint: disable=import-outside-toplevel
+
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError as err:
+        # only one profiler can be active at a time
+        logger.warning("Cannot profile the hook: %s", err)
+        return None
+    return profiler
+
+
+def save(directory, profiler, hook, keep):
+    """Stop the profiler and save its profile, keeping the keep most recent ones.
+
+    Returns the path of the saved profile.
+    """
+    profiler.disable()
+    profiler.create_stats()
+    directory.mkdir(parents=True, exist_ok=True)
+    path = directory / f"{datetime.now():%Y%m%d-%H%M%S-%f}-{hook or 'unknown'}{SUFFIX}"
+    with gzip.open(path, "wb") as file:
+        marshal.dump(profiler.stats, file)
+    logger.info("Saved the profile of the hook to %s", path)
+
+    for old_path in list_profiles(directory)[keep:]:
+        old_path.unlink()
+    return path
+
+
+def list_profiles(directory):
+    """Return the paths of the saved profiles, the most recent first."""
+    return sorted(directory.glob(f"*{SUFFIX}"), reverse=True)
+
+
+def summarize(path, count):
+    """Return the count functions with the highest cumulative time, as text."""
+    stream = io.StringIO()
+    with tempfile.NamedTemporaryFile() as stats_file:
+        with gzip.open(path, "rb") as file:
+            shutil.copyfileobj(file, stats_file)
+        stats_file.flush()
+        stats = pstats.Stats(stats_file.name, stream=stream)
+    stats.strip_dirs().sort_stats(pstats.SortKey.CUMULATIVE).print_stats(count)
+    return stream.getvalue()
@@ -0,0 +1,117 @@
+"""Utility functions to manage the interrupt affinity of the storage devices.
+
+The interrupts of the HBAs and NICs carrying the storage traffic are spread
+across the CPUs of the NUMA node the device is attached to, so that completions
+are handled close to the device instead of wherever the interrupts landed.
+"""
+
+import logging
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+SYS_CLASS_FC_HOST = Path("/sys/class/fc_host")
+SYS_CLASS_NET = Path("/sys/class/net")
+PROC_IRQ = Path("/proc/irq")
+
+
+def parse_cpulist(cpulist):
+    """Parse a kernel cpu list like 0-3,8 into a list of CPU numbers."""
+    cpus = []
+    for part in cpulist.strip().split(","):
+        if not part:
+            continue
+        first, _, last = part.partition("-")
+        cpus.extend(range(int(first), int(last or first) + 1))
+    return cpus
+
+
+def get_fc_devices():
+    """Return the PCI devices of the FC HBAs, keyed by the name of the device."""
+    devices = {}
+    if not SYS_CLASS_FC_HOST.exists():
+        return devices
+    for host in sorted(SYS_CLASS_FC_HOST.iterdir()):
+        # the scsi host of an HBA port is a child of its PCI device
+        device = (host / "device").resolve().parent
+        devices[device.name] = device
+    return devices
+
+
+def get_nic_devices(nics):
+    """Return the PCI devices of the NICs, keyed by the name of the device.
+
+    Bonds and VLANs have no device of their own, the devices of their lower
+    interfaces are returned instead.
+    """
+    devices = {}
+    for nic in nics:
+        net = SYS_CLASS_NET / nic
+        if (net / "device").exists():
+            device = (net / "device").resolve()
+            devices[device.name] = device
+            continue
+        lower = [path.name[len("lower_") :] for path in sorted(net.glob("lower_*"))]
+        if not lower:
+            logger.warning("No device found for network interface %s", nic)
+        devices.update(get_nic_devices(lower))
+    return devices
+
+
+def get_irqs(device):
+    """Return the MSI interrupts of a PCI device."""
+    msi_irqs = device / "msi_irqs"
+    if not msi_irqs.exists():
+        return []
+    return sorted(int(path.name) for path in msi_irqs.iterdir())
+
+
+def get_numa_node(device):
+    """Return the NUMA node of a PCI device, -1 if the host is not NUMA."""
+    return int((device / "numa_node").read_text())
+
+
+def get_local_cpus(device):
+    """Return the CPUs of the NUMA node the PCI device is attached to."""
+    return parse_cpulist((device / "local_cpulist").read_text())
+
+
+def spread_irqs(device):
+    """Assign the interrupts of the device round-robin to its local CPUs.
+
+    Interrupts whose affinity is managed by the kernel reject the change and are
+    left as they are. Returns the CPU assigned to each interrupt.
+    """
+    cpus = get_local_cpus(device)
+    assigned = {}
+    for index, irq in enumerate(get_irqs(device)):
+        cpu = cpus[index % len(cpus)]
+        try:
+            (PROC_IRQ / str(irq) / "smp_affinity_list").write_text(str(cpu))
+        except OSError as err:
+            logger.debug("Cannot set the affinity of irq %d: %s", irq, err)
+            continue
+        assigned[irq] = cpu
+    logger.info("Spread %d irqs of %s over cpus %s", len(assigned), device.name, cpus)
+    return assigned
+
+
+def get_affinity(device):
+    """Return the CPUs currently handling each interrupt of the device."""
+    affinity = {}
+    for irq in get_irqs(device):
+        irq_dir = PROC_IRQ / str(irq)
+        for name in ("effective_affinity_list", "smp_affinity_list"):
+            if (irq_dir / name).exists():
+                affinity[irq] = (irq_dir / name).read_text().strip()
+                break
+    return affinity
+
+
+def describe(device):
+    """Return the NUMA node, local CPUs and interrupt affinity of the device."""
+    return {
+        "numa-node": get_numa_node(device),
+        "local-cpus": (device / "local_cpulist").read_text().strip(),
+        "irqs": get_affinity(device),
+    }
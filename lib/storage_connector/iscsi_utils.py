@@ -0,0 +1,404 @@
+"""Utility functions to manage the iscsi node records and sessions.
+
+Most of the iscsid.conf settings are copied into the node records when the targets
+are discovered, and are read from there when logging in. These settings can be
+changed on the existing node records with "iscsiadm -m node -o update" and take
+effect with the next login, without restarting iscsid and tearing down every
+session at once.
+"""
+import ipaddress
+import json
+import logging
+import re
+import subprocess
+import time
+from collections import namedtuple
+from pathlib import Path
+
+from storage_connector import command_utils
+
+logger = logging.getLogger(__name__)
+
+# Disruption needed to apply a changed iscsid.conf setting, from least to most
+# disruptive.
+DISRUPTION_NONE = "none"  # node records update, used by the next login
+DISRUPTION_RELOGIN = "relogin"  # node records update and relogin of the sessions
+DISRUPTION_RESTART = "restart"  # restart of the iscsi services
+DISRUPTION_ORDER = [DISRUPTION_NONE, DISRUPTION_RELOGIN, DISRUPTION_RESTART]
+
+# node settings which do not affect already established sessions
+NO_RELOGIN_SETTINGS = ["node.startup", "node.leading_login", "node.session.scan"]
+
+# iscsiadm exit code when there are no active sessions
+ISCSI_ERR_NO_OBJS_FOUND = 21
+
+Session = namedtuple("Session", ["transport", "sid", "portal", "tpgt", "target"])
+SESSION_RE = re.compile(r"^(\S+): \[(\d+)\] (\S+),(\d+) (\S+)")
+
+# prefixes of iscsi names, used to tell targets from portals in the overrides
+TARGET_NAME_PREFIXES = ("iqn.", "eui.", "naa.")
+
+# prefix of the names of the iscsi ifaces managed by the charm
+IFACE_PREFIX = "storage-connector-"
+SYS_CLASS_NET = Path("/sys/class/net")
+
+# iscsid.conf performance settings exposed as config options, rendered in the
+# template as the variable name
+Tunable = namedtuple("Tunable", ["name", "default", "minimum", "maximum"])
+ISCSID_TUNABLES = {
+    "iscsi-node-session-cmds-max": Tunable("cmds_max", 128, 2, 2048),
+    "iscsi-node-session-queue-depth": Tunable("queue_depth", 32, 1, 1024),
+    "iscsi-node-session-nr-sessions": Tunable("nr_sessions", 1, 1, 64),
+    "iscsi-node-session-iscsi-first-burst-length": Tunable(
+        "first_burst_length", 262144, 512, 16777215
+    ),
+    "iscsi-node-session-iscsi-max-burst-length": Tunable(
+        "max_burst_length", 16776192, 512, 16777215
+    ),
+    "iscsi-node-conn-iscsi-max-recv-data-segment-length": Tunable(
+        "max_recv_data_segment_length", 262144, 512, 16777215
+    ),
+    "iscsi-node-conn-timeo-noop-out-interval": Tunable("noop_out_interval", 5, 0, 3600),
+    "iscsi-node-conn-timeo-noop-out-timeout": Tunable("noop_out_timeout", 5, 0, 3600),
+    "iscsi-node-session-timeo-replacement-timeout": Tunable(
+        "replacement_timeout", 120, 0, 86400
+    ),
+}
+
+# Tunable values recommended by the array vendors for multipathed all-flash
+# arrays. Config options which are set explicitly take precedence.
+ISCSID_PRESETS = {
+    "pure": {
+        "iscsi-node-session-cmds-max": 1024,
+        "iscsi-node-session-queue-depth": 128,
+        "iscsi-node-session-timeo-replacement-timeout": 20,
+    },
+    "netapp-ontap": {
+        "iscsi-node-session-cmds-max": 1024,
+        "iscsi-node-session-queue-depth": 128,
+        "iscsi-node-session-timeo-replacement-timeout": 5,
+    },
+    "dell-powerstore": {
+        "iscsi-node-session-cmds-max": 1024,
+        "iscsi-node-session-queue-depth": 128,
+        "iscsi-node-session-timeo-replacement-timeout": 15,
+    },
+    "dell-unity": {
+        "iscsi-node-session-cmds-max": 256,
+        "iscsi-node-session-queue-depth": 64,
+        "iscsi-node-session-timeo-replacement-timeout": 15,
+    },
+    "hpe-3par": {
+        "iscsi-node-session-cmds-max": 512,
+        "iscsi-node-session-queue-depth": 64,
+        "iscsi-node-session-timeo-replacement-timeout": 10,
+    },
+    "ibm-flashsystem": {
+        "iscsi-node-session-cmds-max": 512,
+        "iscsi-node-session-queue-depth": 64,
+        "iscsi-node-session-timeo-replacement-timeout": 20,
+    },
+    "hitachi": {
+        "iscsi-node-session-cmds-max": 512,
+        "iscsi-node-session-queue-depth": 64,
+        "iscsi-node-session-timeo-replacement-timeout": 15,
+    },
+}
+
+
+def parse_iscsid_conf(content):
+    """Parse the content of iscsid.conf into a dictionary of settings."""
+    settings = {}
+    for line in content.splitlines():
+        line = line.strip()
+        if not line or line.startswith("#") or "=" not in line:
+            continue
+        key, _, value = line.partition("=")
+        settings[key.strip()] = value.strip()
+    return settings
+
+
+def classify_setting(key):
+    """Return the disruption needed to apply a change of the setting."""
+    if key in NO_RELOGIN_SETTINGS:
+        return DISRUPTION_NONE
+    if key.startswith("node."):
+        return DISRUPTION_RELOGIN
+    return DISRUPTION_RESTART
+
+
+def changed_settings(old, new):
+    """Return the settings which are new or have a different value in new.
+
+    Settings removed from the configuration are returned with a None value, since
+    the value to restore on the node records is unknown.
+    """
+    changes = {key: value for key, value in new.items() if old.get(key) != value}
+    changes.update({key: None for key in old if key not in new})
+    return changes
+
+
+def get_disruption(changes):
+    """Return the disruption needed to apply all the changed settings."""
+    disruption = DISRUPTION_NONE
+    for key, value in changes.items():
+        needed = DISRUPTION_RESTART if value is None else classify_setting(key)
+        disruption = max(disruption, needed, key=DISRUPTION_ORDER.index)
+    return disruption
+
+
+def get_iscsid_tuning(config):
+    """Return the iscsid.conf performance settings to render, keyed by name.
+
+    The value of each setting is taken from the config option if set, else from
+    the preset selected by iscsi-tuning-preset or array-preset, else from the
+    default of the setting. ValueError is raised if the preset is unknown or a
+    value is invalid.
+    """
+    preset_name = config.get("iscsi-tuning-preset") or config.get("array-preset") or ""
+    if preset_name and preset_name not in ISCSID_PRESETS:
+        raise ValueError(
+            f"unknown preset {preset_name}, valid presets are {', '.join(ISCSID_PRESETS)}"
+        )
+    preset = ISCSID_PRESETS.get(preset_name, {})
+
+    tuning = {}
+    for option, tunable in ISCSID_TUNABLES.items():
+        value = config.get(option)
+        if value is None:
+            value = preset.get(option, tunable.default)
+        if not tunable.minimum <= value <= tunable.maximum:
+            raise ValueError(
+                f"{option} must be between {tunable.minimum} and {tunable.maximum}"
+            )
+        tuning[tunable.name] = value
+
+    if tuning["cmds_max"] & (tuning["cmds_max"] - 1):
+        raise ValueError("iscsi-node-session-cmds-max must be a power of 2")
+    if tuning["first_burst_length"] > tuning["max_burst_length"]:
+        raise ValueError(
+            "iscsi-node-session-iscsi-first-burst-length must not exceed "
+            "iscsi-node-session-iscsi-max-burst-length"
+        )
+    return tuning
+
+
+def update_node_settings(settings, target=None, portal=None):
+    """Update the settings on the existing node records.
+
+    All the node records are updated, unless they are restricted to a target
+    and/or a portal. Having no node records at all, e.g. before the first
+    discovery, leaves nothing to update; missing records of a target or portal
+    raise subprocess.CalledProcessError.
+    """
+    node = ["iscsiadm", "-m", "node"]
+    if target:
+        node += ["-T", target]
+    if portal:
+        node += ["-p", portal]
+    for key, value in settings.items():
+        logger.info("Updating %s on iscsi node records", key)
+        try:
+            command_utils.check_call(node + ["-o", "update", "-n", key, "-v", value])
+        except subprocess.CalledProcessError as err:
+            if target or portal or err.returncode != ISCSI_ERR_NO_OBJS_FOUND:
+                raise
+            logger.info("No iscsi node records to update")
+            return
+
+
+def parse_target_overrides(value):
+    """Parse the per-target overrides of node settings from a JSON string.
+
+    The overrides map a target IQN or a portal to a dictionary of node settings.
+    Values are converted to the strings iscsiadm expects, booleans to Yes or No.
+    ValueError is raised if the overrides are malformed.
+    """
+    try:
+        overrides = json.loads(value or "{}")
+    except json.JSONDecodeError as err:
+        raise ValueError(f"invalid JSON, {err}") from None
+    if not isinstance(overrides, dict) or not all(
+        isinstance(settings, dict) for settings in overrides.values()
+    ):
+        raise ValueError("expected a dictionary of node settings per target or portal")
+
+    parsed = {}
+    for name, settings in overrides.items():
+        parsed[name] = {}
+        for key, setting in settings.items():
+            if not key.startswith("node."):
+                raise ValueError(f"{key} of {name} is not a node setting")
+            if isinstance(setting, bool):
+                setting = "Yes" if setting else "No"
+            elif not isinstance(setting, (str, int, float)):
+                raise ValueError(f"invalid value for {key} of {name}")
+            parsed[name][key] = str(setting)
+    return parsed
+
+
+def apply_target_overrides(old, new, defaults):
+    """Apply the per-target overrides of node settings to the node records.
+
+    Settings which were overridden in old but no longer are in new are reset to
+    their value in defaults, the settings of iscsid.conf. Targets and portals
+    without node records, e.g. not discovered yet, are skipped.
+    """
+    for name in sorted(set(old) | set(new)):
+        settings = {key: defaults[key] for key in old.get(name, {}) if key in defaults}
+        settings.update(new.get(name, {}))
+        if name.startswith(TARGET_NAME_PREFIXES):
+            records = {"target": name}
+        else:
+            records = {"portal": name}
+        try:
+            update_node_settings(settings, **records)
+        except subprocess.CalledProcessError as err:
+            if err.returncode != ISCSI_ERR_NO_OBJS_FOUND:
+                raise
+            logger.info("No iscsi node records for %s, skipping its overrides", name)
+
+
+def get_sessions():
+    """Return the list of active iscsi sessions."""
+    try:
+        output = command_utils.check_output(
+            ["iscsiadm", "-m", "session"], stderr=subprocess.STDOUT
+        ).decode()
+    except subprocess.CalledProcessError as err:
+        if err.returncode == ISCSI_ERR_NO_OBJS_FOUND:
+            return []
+        raise
+
+    sessions = []
+    for line in output.splitlines():
+        match = SESSION_RE.match(line)
+        if match:
+            sessions.append(Session(*match.groups()))
+    return sessions
+
+
+def relogin_session(session):
+    """Log out and back in the sessions to the target of the session via its portal.
+
+    iscsiadm logs out every node record of the target and portal, so all the
+    sessions to them are relogged at once, whatever their iface or number
+    (node.session.nr_sessions). The sessions to other portals are left up.
+    """
+    node = ["iscsiadm", "-m", "node", "-T", session.target, "-p", session.portal]
+    logger.info("Relogin of sessions to %s via %s", session.target, session.portal)
+    command_utils.check_call(node + ["--logout"])
+    command_utils.check_call(node + ["--login"])
+
+
+def rolling_relogin(count_active_paths, timeout, interval=1):
+    """Relogin the sessions one portal at a time, keeping the other paths up.
+
+    count_active_paths is a callable returning the number of paths multipathd
+    reports as active. After the sessions of a portal are logged back in, the
+    next portal is only touched once the active paths are back to the count
+    observed before, so at most one portal's paths are down at any time.
+    TimeoutError is raised if the paths do not come back within timeout seconds.
+    """
+    portals = {}
+    for session in get_sessions():
+        # a relogin covers every session to the target via the portal
+        sessions = portals.setdefault(session.portal, {})
+        sessions.setdefault(session.target, session)
+
+    for portal, sessions in portals.items():
+        expected_paths = count_active_paths()
+        for session in sessions.values():
+            relogin_session(session)
+
+        deadline = time.monotonic() + timeout
+        while count_active_paths() < expected_paths:
+            if time.monotonic() >= deadline:
+                raise TimeoutError(
+                    f"Paths via {portal} not active after {timeout} seconds"
+                )
+            time.sleep(interval)
+        logger.info("Paths via %s are active again", portal)
+
+
+def _interface_for_address(address):
+    """Return the network interface which holds the IP address, or None."""
+    output = command_utils.check_output(["ip", "-o", "addr", "show"]).decode()
+    for line in output.splitlines():
+        fields = line.split()
+        if len(fields) > 3 and fields[3].split("/")[0] == address:
+            return fields[1]
+    return None
+
+
+def get_route_interface(address):
+    """Return the network interface the traffic to the address is routed through."""
+    output = command_utils.check_output(["ip", "route", "get", address]).decode()
+    fields = output.split()
+    if "dev" in fields[:-1]:
+        return fields[fields.index("dev") + 1]
+    return None
+
+
+def resolve_iface_bindings(bindings):
+    """Resolve a space separated list of NICs and IP addresses to iscsi ifaces.
+
+    Returns a dictionary mapping the iface names to the network interface their
+    sessions are bound to. IP addresses are bound to the interface holding them.
+    ValueError is raised if an interface or address does not exist on the host.
+    """
+    ifaces = {}
+    for binding in (bindings or "").split():
+        try:
+            ipaddress.ip_address(binding)
+        except ValueError:
+            if not (SYS_CLASS_NET / binding).exists():
+                raise ValueError(f"no network interface {binding}") from None
+            interface = binding
+        else:
+            interface = _interface_for_address(binding)
+            if interface is None:
+                raise ValueError(f"no network interface with address {binding}")
+        ifaces[IFACE_PREFIX + binding] = interface
+    return ifaces
+
+
+def get_managed_ifaces():
+    """Return the names of the iscsi ifaces managed by the charm."""
+    output = command_utils.check_output(["iscsiadm", "-m", "iface"]).decode()
+    return [
+        line.split()[0] for line in output.splitlines() if line.startswith(IFACE_PREFIX)
+    ]
+
+
+def configure_ifaces(ifaces):
+    """Create, update and remove the managed iscsi ifaces to match ifaces.
+
+    ifaces maps the iface names to the network interface to bind to. The sessions
+    and node records of removed ifaces are logged out and deleted first.
+    """
+    existing = get_managed_ifaces()
+    for name in existing:
+        if name in ifaces:
+            continue
+        logger.info("Removing iscsi iface %s", name)
+        try:
+            command_utils.check_call(["iscsiadm", "-m", "node", "-I", name, "--logout"])
+        except subprocess.CalledProcessError as err:
+            if err.returncode != ISCSI_ERR_NO_OBJS_FOUND:
+                raise
+        try:
+            command_utils.check_call(["iscsiadm", "-m", "node", "-I", name, "-o", "delete"])
+        except subprocess.CalledProcessError as err:
+            if err.returncode != ISCSI_ERR_NO_OBJS_FOUND:
+                raise
+        command_utils.check_call(["iscsiadm", "-m", "iface", "-I", name, "-o", "delete"])
+
+    for name, interface in ifaces.items():
+        iface = ["iscsiadm", "-m", "iface", "-I", name]
+        if name not in existing:
+            logger.info("Creating iscsi iface %s bound to %s", name, interface)
+            command_utils.check_call(iface + ["-o", "new"])
+        command_utils.check_call(
+            iface + ["-o", "update", "-n", "iface.net_ifacename", "-v", interface]
+        )
@@ -0,0 +1,487 @@
+"""Utility functions to query and control the multipathd daemon."""
+
+import logging
+import os
+import re
+import tempfile
+from collections import namedtuple
+
+from storage_connector import command_utils
+
+logger = logging.getLogger(__name__)
+
+Path = namedtuple("Path", ["dev", "dm_state", "checker_state"])
+PathGroup = namedtuple("PathGroup", ["policy", "prio", "status", "devices"])
+
+# path group and path lines of the multipath -ll topology, in the current format
+# ("policy='service-time 0' prio=50 status=active") and the older one
+# ("\_ round-robin 0 [prio=50][active]")
+PATH_GROUP_RE = re.compile(
+    r"(?:policy='([^']*)' prio=(\d+) status=(\w+)|\\_ (.+?) \[prio=(\d+)\]\[(\w+)\])"
+)
+GROUP_PATH_RE = re.compile(r"\d+:\d+:\d+:\d+\s+(\w+)\s")
+
+# keywords identifying a device in the devices, blacklist and blacklist_exceptions
+DEVICE_KEYWORDS = ["vendor", "product"]
+# keywords of the blacklist and blacklist_exceptions sections, besides devices
+BLACKLIST_KEYWORDS = ["wwid", "devnode", "property", "protocol"]
+# attributes which can be set in the defaults section and per device, as documented
+# in multipath.conf(5) of the multipath-tools releases shipped by Ubuntu
+COMMON_KEYWORDS = {
+    "all_tg_pt",
+    "alias_prefix",
+    "deferred_remove",
+    "delay_wait_checks",
+    "delay_watch_checks",
+    "detect_checker",
+    "detect_pgpolicy",
+    "detect_pgpolicy_use_tpg",
+    "detect_prio",
+    "dev_loss_tmo",
+    "eh_deadline",
+    "failback",
+    "fast_io_fail_tmo",
+    "features",
+    "flush_on_last_del",
+    "ghost_delay",
+    "marginal_path_double_failed_time",
+    "marginal_path_err_rate_threshold",
+    "marginal_path_err_recheck_gap_time",
+    "marginal_path_err_sample_time",
+    "max_sectors_kb",
+    "no_path_retry",
+    "path_checker",
+    "path_grouping_policy",
+    "path_selector",
+    "prio",
+    "prio_args",
+    "recheck_wwid",
+    "retain_attached_hw_handler",
+    "rr_min_io",
+    "rr_min_io_rq",
+    "rr_weight",
+    "san_path_err_forget_rate",
+    "san_path_err_recovery_time",
+    "san_path_err_threshold",
+    "skip_kpartx",
+    "uid_attribute",
+    "user_friendly_names",
+}
+# deprecated attributes, still accepted by the older releases, e.g. 0.8.3 on focal
+DEPRECATED_KEYWORDS = {"getuid_callout", "pg_timeout"}
+KEYWORDS = {
+    "defaults": COMMON_KEYWORDS
+    | DEPRECATED_KEYWORDS
+    | {
+        "allow_usb_devices",
+        "auto_resize",
+        "bindings_file",
+        "checker_timeout",
+        "config_dir",
+        "disable_changed_wwids",
+        "enable_foreign",
+        "find_multipaths",
+        "find_multipaths_timeout",
+        "force_sync",
+        "hw_str_match",
+        "ignore_new_boot_devs",
+        "log_checker_err",
+        "marginal_pathgroups",
+        "max_fds",
+        "max_polling_interval",
+        "missing_uev_wait_timeout",
+        "multipath_dir",
+        "partition_delimiter",
+        "polling_interval",
+        "prkeys_file",
+        "queue_without_daemon",
+        "reassign_maps",
+        "reservation_key",
+        "remove_retries",
+        "retrigger_delay",
+        "retrigger_tries",
+        "strict_timing",
+        "uid_attrs",
+        "uxsock_timeout",
+        "verbosity",
+        "wwids_file",
+    },
+    "devices": COMMON_KEYWORDS
+    | DEPRECATED_KEYWORDS
+    | {"hardware_handler", "product", "product_blacklist", "revision", "vendor", "vpd_vendor"},
+    "blacklist": {*DEVICE_KEYWORDS, *BLACKLIST_KEYWORDS},
+    "blacklist_exceptions": {*DEVICE_KEYWORDS, *BLACKLIST_KEYWORDS},
+}
+
+# WWIDs and aliases of the managed wwids and bindings files
+WWID_RE = re.compile(r"^[\w.:-]+$")
+ALIAS_RE = re.compile(r"^[\w.-]+$")
+WWIDS_HEADER = """\
+# Multipath wwids, Version : 1.0
+# NOTE: This file is maintained by Juju, local changes will be overwritten.
+#
+# Valid WWIDs:
+"""
+BINDINGS_HEADER = """\
+# Multipath bindings, Version : 1.0
+# NOTE: This file is maintained by Juju, local changes will be overwritten.
+#
+# Format:
+# alias wwid
+#
+"""
+
+# device entries recommended by the array vendors' Linux host guides, selected by
+# the array-preset option. Entries of multipath-devices for the same vendor and
+# product override single attributes.
+MULTIPATH_PRESETS = {
+    "pure": {
+        "vendor": "PURE",
+        "product": "FlashArray",
+        "path_selector": "service-time 0",
+        "path_grouping_policy": "group_by_prio",
+        "prio": "alua",
+        "hardware_handler": "1 alua",
+        "failback": "immediate",
+        "fast_io_fail_tmo": "10",
+        "dev_loss_tmo": "60",
+        "no_path_retry": "0",
+        "max_sectors_kb": "4096",
+    },
+    "netapp-ontap": {
+        "vendor": "NETAPP",
+        "product": "LUN",
+        "path_selector": "service-time 0",
+        "path_grouping_policy": "group_by_prio",
+        "prio": "ontap",
+        "features": "2 pg_init_retries 50",
+        "failback": "immediate",
+        "fast_io_fail_tmo": "5",
+        "dev_loss_tmo": "infinity",
+        "no_path_retry": "queue",
+        "max_sectors_kb": "4096",
+    },
+    "dell-powerstore": {
+        "vendor": "DellEMC",
+        "product": "PowerStore",
+        "path_selector": "queue-length 0",
+        "path_grouping_policy": "group_by_prio",
+        "prio": "alua",
+        "hardware_handler": "1 alua",
+        "failback": "immediate",
+        "fast_io_fail_tmo": "5",
+        "dev_loss_tmo": "60",
+        "no_path_retry": "3",
+        "max_sectors_kb": "1024",
+    },
+    "dell-unity": {
+        "vendor": "DGC",
+        "product": ".*",
+        "path_selector": "round-robin 0",
+        "path_grouping_policy": "group_by_prio",
+        "prio": "alua",
+        "hardware_handler": "1 alua",
+        "failback": "immediate",
+        "fast_io_fail_tmo": "5",
+        "dev_loss_tmo": "60",
+        "no_path_retry": "60",
+        "max_sectors_kb": "1024",
+    },
+    "hpe-3par": {
+        "vendor": "3PARdata",
+        "product": "VV",
+        "path_selector": "round-robin 0",
+        "path_grouping_policy": "group_by_prio",
+        "prio": "alua",
+        "hardware_handler": "1 alua",
+        "failback": "immediate",
+        "rr_min_io_rq": "1",
+        "fast_io_fail_tmo": "10",
+        "dev_loss_tmo": "infinity",
+        "no_path_retry": "18",
+        "max_sectors_kb": "4096",
+    },
+    "ibm-flashsystem": {
+        "vendor": "IBM",
+        "product": "2145",
+        "path_selector": "service-time 0",
+        "path_grouping_policy": "group_by_prio",
+        "prio": "alua",
+        "failback": "immediate",
+        "fast_io_fail_tmo": "5",
+        "dev_loss_tmo": "120",
+        "no_path_retry": "5",
+        "max_sectors_kb": "1024",
+    },
+    "hitachi": {
+        "vendor": "HITACHI",
+        "product": "OPEN-.*",
+        "path_selector": "service-time 0",
+        "path_grouping_policy": "multibus",
+        "prio": "const",
+        "failback": "immediate",
+        "fast_io_fail_tmo": "5",
+        "dev_loss_tmo": "60",
+        "no_path_retry": "6",
+        "max_sectors_kb": "1024",
+    },
+}
+
+
+def get_paths():
+    """Return the paths known by multipathd along with their states."""
+    output = command_utils.check_output(
+        ["multipathd", "show", "paths", "raw", "format", "%d %t %T"]
+    ).decode()
+    paths = []
+    for line in output.splitlines():
+        fields = line.split()
+        if len(fields) == 3:
+            paths.append(Path(*fields))
+    return paths
+
+
+def count_active_paths():
+    """Return the number of paths which are active and ready."""
+    return sum(
+        1 for path in get_paths() if path.dm_state == "active" and path.checker_state == "ready"
+    )
+
+
+def get_path_groups(alias):
+    """Return the path groups of a multipath map, in priority order."""
+    output = command_utils.check_output(["multipath", "-ll", alias]).decode()
+    groups = []
+    for line in output.splitlines():
+        match = PATH_GROUP_RE.search(line)
+        if match:
+            policy, prio, status = match.group(1, 2, 3) if match.group(2) else match.group(4, 5, 6)
+            groups.append(PathGroup(policy, int(prio), status, []))
+            continue
+        match = GROUP_PATH_RE.search(line)
+        if match and groups:
+            groups[-1].devices.append(match.group(1))
+    return groups
+
+
+def get_maps():
+    """Return the WWID of each multipath map known by multipathd, keyed by alias."""
+    output = command_utils.check_output(
+        ["multipathd", "show", "maps", "raw", "format", "%n %w"]
+    ).decode()
+    maps = {}
+    for line in output.splitlines():
+        fields = line.split()
+        if len(fields) == 2:
+            maps[fields[0]] = fields[1]
+    return maps
+
+
+def get_map_wwid(alias):
+    """Return the WWID of a multipath map, or None if there is no such map."""
+    return get_maps().get(alias)
+
+
+def reconfigure():
+    """Make multipathd read its configuration again and reload the maps."""
+    logger.info("Reconfiguring multipathd")
+    command_utils.check_call(["multipathd", "reconfigure"])
+
+
+def update_map(wwid):
+    """Create or reload a single multipath map from the configuration files.
+
+    Unlike multipathd, which only reads its configuration upon reconfigure, the
+    multipath command reads it on every run. It applies the alias and attributes
+    of the map, renaming it if needed, and multipathd follows the change through
+    the device-mapper uevents. multipathd is then asked to monitor the map, in
+    case it was just created.
+    """
+    logger.info("Updating multipath map %s", wwid)
+    command_utils.check_call(["multipath", wwid])
+    command_utils.check_call(["multipathd", "add", "map", wwid])
+
+
+def get_map_changes(previous, desired):
+    """Return the WWIDs whose map is affected by the changes of the configuration.
+
+    previous and desired map WWIDs to their alias, or to None if multipath names
+    the map. The maps of new, renamed and removed WWIDs are affected, as well as
+    the live maps whose alias does not match the configuration.
+    """
+    live = {wwid: alias for alias, wwid in get_maps().items()}
+    return sorted(
+        wwid
+        for wwid in set(previous) | set(desired)
+        if (wwid in previous, previous.get(wwid)) != (wwid in desired, desired.get(wwid))
+        or desired.get(wwid) not in (None, live.get(wwid, desired.get(wwid)))
+    )
+
+
+def apply_map_changes(previous, desired):
+    """Apply the changes of the multipaths entries and managed WWIDs to the live maps.
+
+    The maps affected by the changes, see get_map_changes, are updated one by
+    one. Maps of removed WWIDs are kept and fall back to their default name, as a
+    full reload would do. The other maps are left alone. Returns the updated
+    WWIDs, and raises subprocess.CalledProcessError if a command fails.
+    """
+    updated = get_map_changes(previous, desired)
+    for wwid in updated:
+        update_map(wwid)
+    return updated
+
+
+def _attributes(entry, section):
+    """Validate the attributes of a section entry and convert them to strings."""
+    if not isinstance(entry, dict):
+        raise ValueError(f"{section} entries must be dictionaries")
+    attributes = {}
+    for key, value in entry.items():
+        if key not in KEYWORDS[section]:
+            raise ValueError(f"invalid keyword {key} in {section}")
+        if isinstance(value, bool):
+            value = "yes" if value else "no"
+        elif not isinstance(value, (str, int, float)):
+            raise ValueError(f"invalid value of {key} in {section}")
+        attributes[key] = str(value)
+    return attributes
+
+
+def parse_section(section, data):
+    """Validate the entries of a multipath.conf section parsed from JSON.
+
+    defaults is a dictionary of attributes. devices, blacklist and
+    blacklist_exceptions are a list of entries, or a single entry. Device entries
+    need a vendor and a product. blacklist and blacklist_exceptions entries are
+    either a device, returned as {"device": attributes}, or wwid, devnode,
+    property and protocol patterns. Keywords are checked against the ones known
+    by multipath-tools, so that a configuration rejected by multipath is never
+    written. ValueError is raised for invalid entries.
+    """
+    if section == "defaults":
+        return _attributes(data, section)
+
+    entries = [
+        _attributes(entry, section) for entry in (data if isinstance(data, list) else [data])
+    ]
+    if section == "devices":
+        for entry in entries:
+            if not all(key in entry for key in DEVICE_KEYWORDS):
+                raise ValueError("devices entries need a vendor and a product")
+        return entries
+
+    parsed = []
+    for entry in entries:
+        if "vendor" in entry:
+            if set(entry) - set(DEVICE_KEYWORDS):
+                raise ValueError(f"{section} devices only match on vendor and product")
+            parsed.append({"device": entry})
+        elif entry and set(entry) <= set(BLACKLIST_KEYWORDS):
+            parsed.append(entry)
+        else:
+            raise ValueError(
+                f"{section} entries need a vendor or any of {', '.join(BLACKLIST_KEYWORDS)}"
+            )
+    return parsed
+
+
+def apply_preset(name, devices):
+    """Return the device entries of multipath-devices along with an array preset.
+
+    Attributes of the entry of devices with the vendor and product of the preset
+    take precedence over the preset, the other entries are kept as is. ValueError
+    is raised if the preset is unknown.
+    """
+    if name not in MULTIPATH_PRESETS:
+        raise ValueError(
+            f"unknown preset {name}, valid presets are {', '.join(MULTIPATH_PRESETS)}"
+        )
+    preset = dict(MULTIPATH_PRESETS[name])
+    others = []
+    for entry in devices:
+        if (entry["vendor"], entry["product"]) == (preset["vendor"], preset["product"]):
+            preset.update(entry)
+        else:
+            others.append(entry)
+    return [preset, *others]
+
+
+def parse_wwids(data):
+    """Validate the managed WWIDs parsed from JSON.
+
+    data is either a list of WWIDs or a dictionary mapping WWIDs to their alias,
+    or to None to let multipath name the map. Returns the dictionary, and raises
+    ValueError if a WWID or an alias is invalid, or if an alias is used twice.
+    """
+    if isinstance(data, list):
+        data = dict.fromkeys(data)
+    if not isinstance(data, dict):
+        raise ValueError("expected a list of WWIDs or a dictionary of WWIDs to aliases")
+    aliases = set()
+    for wwid, alias in data.items():
+        if not isinstance(wwid, str) or not WWID_RE.match(wwid):
+            raise ValueError(f"invalid WWID {wwid}")
+        if alias is None:
+            continue
+        if not isinstance(alias, str) or not ALIAS_RE.match(alias):
+            raise ValueError(f"invalid alias {alias} of {wwid}")
+        if alias in aliases:
+            raise ValueError(f"alias {alias} is used more than once")
+        aliases.add(alias)
+    return data
+
+
+def parse_bindings(content):
+    """Return the alias of each WWID of a bindings file, keyed by WWID."""
+    bindings = {}
+    for line in content.splitlines():
+        fields = line.split("#", 1)[0].split()
+        if len(fields) == 2:
+            bindings[fields[1]] = fields[0]
+    return bindings
+
+
+def render_wwids(wwids):
+    """Return the content of the wwids file allowing the WWIDs, in sorted order."""
+    return WWIDS_HEADER + "".join(f"/{wwid}/\n" for wwid in sorted(wwids))
+
+
+def render_bindings(bindings):
+    """Return the content of the bindings file, sorted by alias.
+
+    bindings maps WWIDs to their alias. multipath-tools looks the aliases up in
+    alias order, and rewrites a bindings file which is not sorted.
+    """
+    lines = sorted(f"{alias} {wwid}\n" for wwid, alias in bindings.items())
+    return BINDINGS_HEADER + "".join(lines)
+
+
+def write_atomic(path, content, mode=0o600):
+    """Replace the content of a file atomically, if it changed.
+
+    The content is written to a temporary file of the same directory, flushed to
+    disk and renamed over the file, so that multipath never reads a partial
+    file, even after a crash. Returns True if the file was written.
+    """
+    try:
+        with open(path, encoding="utf-8") as file:
+            if file.read() == content:
+                return False
+    except FileNotFoundError:
+        pass
+
+    directory, name = os.path.split(path)
+    fd, tmp_path = tempfile.mkstemp(prefix=f".{name}.", dir=directory)
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as file:
+            file.write(content)
+            file.flush()
+            os.fsync(file.fileno())
+        os.chmod(tmp_path, mode)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+    logger.info("Wrote %s", path)
+    return True
@@ -0,0 +1,150 @@
+"""Reconcile the state managed by the charm with its configuration.
+
+The managed state (configuration files, services, iscsi sessions, multipath maps) is
+modelled as resources. Each resource has inputs, the configuration it is derived from,
+a cheap observe function telling if the live state is still in place, and an apply
+function bringing the live state in line with the inputs. A resource is only applied
+if its inputs changed since it was last applied, if its live state drifted, or if a
+resource it depends on is applied, so that unrelated config changes cost nothing.
+
+Resources can also tell which operations applying them would run, without touching
+the system, to plan a change before making it.
+"""
+
+import hashlib
+import json
+import logging
+from collections import namedtuple
+
+from storage_connector import timing_utils
+
+logger = logging.getLogger(__name__)
+
+# inputs is a callable returning the JSON serializable inputs of the resource,
+# observe a callable returning False if the live state drifted, apply a callable
+# returning False if the resource could not be applied, depends the names of the
+# resources which must be applied before it, and plan a callable returning the
+# operations apply would run.
+Resource = namedtuple(
+    "Resource",
+    ["name", "inputs", "apply", "observe", "depends", "plan"],
+    defaults=(None, (), None),
+)
+Operation = namedtuple("Operation", ["action", "target", "disruption"])
+
+# disruption of the storage traffic caused by an operation, from the least to the
+# most disruptive: none, a reload of the multipath maps which may pause the I/O,
+# a relogin of the iscsi sessions one path at a time, a restart of the iscsi
+# services dropping every session at once
+DISRUPTION_NONE = "none"
+DISRUPTION_RELOAD = "reload"
+DISRUPTION_RELOGIN = "relogin"
+DISRUPTION_RESTART = "restart"
+DISRUPTION_ORDER = [DISRUPTION_NONE, DISRUPTION_RELOAD, DISRUPTION_RELOGIN, DISRUPTION_RESTART]
+
+REASON_INPUTS = "inputs changed"
+REASON_DRIFT = "live state drifted"
+REASON_DEPENDENCY = "dependency applied"
+
+
+def digest(inputs):
+    """Return a digest of the inputs of a resource."""
+    data = json.dumps(inputs, sort_keys=True, default=str).encode()
+    return hashlib.sha256(data).hexdigest()
+
+
+def sort_resources(resources):
+    """Return the resources in dependency order, else in the given order.
+
+    ValueError is raised if a dependency is unknown or if dependencies are circular.
+    """
+    by_name = {resource.name: resource for resource in resources}
+    ordered = []
+    visiting = set()
+
+    def visit(resource):
+        if resource in ordered:
+            return
+        if resource.name in visiting:
+            raise ValueError(f"circular dependency on {resource.name}")
+        visiting.add(resource.name)
+        for name in resource.depends:
+            if name not in by_name:
+                raise ValueError(f"unknown dependency {name} of {resource.name}")
+            visit(by_name[name])
+        visiting.discard(resource.name)
+        ordered.append(resource)
+
+    for resource in resources:
+        visit(resource)
+    return ordered
+
+
+def get_pending(resources, digests):
+    """Return the resources to apply along with the reason, in dependency order.
+
+    digests maps the name of each resource to the digest of the inputs it was
+    last applied with.
+    """
+    pending = []
+    names = set()
+    for resource in sort_resources(resources):
+        if digests.get(resource.name) != digest(resource.inputs()):
+            reason = REASON_INPUTS
+        elif names.intersection(resource.depends):
+            reason = REASON_DEPENDENCY
+        elif resource.observe is not None and not resource.observe():
+            reason = REASON_DRIFT
+        else:
+            continue
+        pending.append((resource, reason))
+        names.add(resource.name)
+    return pending
+
+
+def reconcile(resources, digests):
+    """Apply the pending resources in dependency order.
+
+    digests is updated in place as resources are applied. Reconciliation stops at
+    the first resource which cannot be applied, leaving it and the resources after
+    it pending. Returns the names of the applied resources.
+    """
+    applied = []
+    for resource, reason in get_pending(resources, digests):
+        logger.info("Applying %s: %s", resource.name, reason)
+        inputs_digest = digest(resource.inputs())
+        with timing_utils.span(resource.name):
+            applied_ok = resource.apply() is not False
+        if not applied_ok:
+            logger.warning("Failed to apply %s, stopping", resource.name)
+            break
+        digests[resource.name] = inputs_digest
+        applied.append(resource.name)
+    skipped = len(resources) - len(applied)
+    logger.info("Applied %d resources, %d unchanged or pending", len(applied), skipped)
+    return applied
+
+
+def plan(resources, digests):
+    """Return the operations the pending resources would run, without applying them.
+
+    Returns a list of (name, reason, operations) tuples, in dependency order.
+    Resources without a plan function are reported as a single apply operation.
+    """
+    steps = []
+    for resource, reason in get_pending(resources, digests):
+        if resource.plan is None:
+            operations = [Operation("apply", resource.name, DISRUPTION_NONE)]
+        else:
+            operations = resource.plan()
+        steps.append((resource.name, reason, operations))
+    return steps
+
+
+def get_disruption(operations):
+    """Return the most disruptive class of the operations."""
+    return max(
+        (operation.disruption for operation in operations),
+        key=DISRUPTION_ORDER.index,
+        default=DISRUPTION_NONE,
+    )
@@ -0,0 +1,131 @@
+"""Utility functions to manage systemd services in batches.
+
+Every function here runs a single systemctl command for all the given services,
+instead of forking one systemctl per service. systemd receives all the jobs at once
+and orders them according to the units' dependencies.
+"""
+import logging
+import time
+from datetime import datetime
+from pathlib import Path
+
+from storage_connector import command_utils
+
+logger = logging.getLogger(__name__)
+
+SYSTEMCTL = "systemctl"
+TIMESTAMP_FORMAT = "%a %Y-%m-%d %H:%M:%S %Z"
+PROC_NET_UNIX = Path("/proc/net/unix")
+# socket flag set on listening sockets, see __SO_ACCEPTCON in the kernel
+SO_ACCEPTCON = 0x10000
+
+
+def _systemctl(command, services):
+    """Run a systemctl command against all the services at once."""
+    services = list(services)
+    if not services:
+        return
+    logger.info("Running systemctl %s for %s", command, ", ".join(services))
+    command_utils.check_call([SYSTEMCTL, command, *services])
+
+
+def enable(services):
+    """Enable the services."""
+    _systemctl("enable", services)
+
+
+def restart(services):
+    """Restart the services."""
+    _systemctl("restart", services)
+
+
+def reload(services):
+    """Reload the services."""
+    _systemctl("reload", services)
+
+
+def show(services, properties):
+    """Read unit properties of several services with a single systemctl call.
+
+    Returns a dictionary mapping each service to a dictionary of the requested
+    properties. systemctl prints one block of properties per unit, separated by
+    an empty line, in the same order as the units were requested.
+    """
+    services = list(services)
+    if not services:
+        return {}
+    output = command_utils.check_output(
+        [SYSTEMCTL, "show", *services, "--property=" + ",".join(properties)]
+    ).decode()
+
+    blocks = output.strip().split("\n\n")
+    result = {}
+    for service, block in zip(services, blocks):
+        values = dict.fromkeys(properties, "")
+        for line in block.splitlines():
+            key, _, value = line.partition("=")
+            if key in values:
+                values[key] = value.strip()
+        result[service] = values
+    return result
+
+
+def get_start_times(services):
+    """Return the time when each service last entered the active state.
+
+    The value is None for services which were never started. ValueError is raised
+    if systemd returns a timestamp which cannot be parsed.
+    """
+    start_times = {}
+    for service, values in show(services, ["ActiveEnterTimestamp"]).items():
+        timestamp = values["ActiveEnterTimestamp"]
+        start_times[service] = (
+            datetime.strptime(timestamp, TIMESTAMP_FORMAT) if timestamp else None
+        )
+    return start_times
+
+
+def get_active_states(services):
+    """Return the ActiveState of each service, e.g. active or failed."""
+    return {
+        service: values["ActiveState"]
+        for service, values in show(services, ["ActiveState"]).items()
+    }
+
+
+def is_unix_socket_listening(path):
+    """Check if a unix socket is listening, without forking.
+
+    Abstract sockets are named with a leading "@", as shown in /proc/net/unix.
+    """
+    for line in PROC_NET_UNIX.read_text().splitlines()[1:]:
+        fields = line.split()
+        if len(fields) == 8 and fields[7] == path and int(fields[3], 16) & SO_ACCEPTCON:
+            return True
+    return False
+
+
+def wait_until_ready(services, timeout, checks=None, interval=0.5):
+    """Wait until the services are active and pass their readiness checks.
+
+    checks maps a service to a callable which returns True once the service is
+    ready to handle requests. Returns the list of services which were still not
+    ready when the timeout expired.
+    """
+    checks = checks or {}
+    deadline = time.monotonic() + timeout
+    pending = list(services)
+    while pending:
+        states = get_active_states(pending)
+        pending = [
+            service
+            for service in pending
+            if states.get(service) != "active" or not checks.get(service, lambda: True)()
+        ]
+        if not pending or time.monotonic() >= deadline:
+            break
+        time.sleep(interval)
+
+    if pending:
+        logger.warning("Services not ready after %s seconds: %s", timeout, ", ".join(pending))
+    return pending
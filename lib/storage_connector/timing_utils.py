@@ -0,0 +1,122 @@
+"""Time the steps of the charm hooks.
+
+A profile records the wall time of the steps (spans) run during a hook. Spans can be
+nested, a nested span is named after its parents, e.g. "reconcile/iscsi/restart". The
+external commands run during the hook are totalled per command, see command_utils. The
+profiles of the last hooks are kept in a JSON file, to find which step of a slow hook
+was slow after the fact.
+
+Only the current profile is timed: spans opened while no profile is started cost
+nothing, so that library functions can be timed whoever calls them.
+"""
+
+import json
+import logging
+import os
+import time
+from collections import namedtuple
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+Span = namedtuple("Span", ["name", "duration"])
+
+_current = None
+
+
+class Profile:
+    """Spans timed during a hook."""
+
+    def __init__(self, hook):
+        """Start the profile of a hook."""
+        self.hook = hook
+        self.started = time.time()
+        self.spans = []
+        self.commands = {}
+        self._start = time.monotonic()
+        self._stack = []
+
+    @contextmanager
+    def span(self, name):
+        """Time the enclosed step, as a child of the spans it is nested in."""
+        self._stack.append(name)
+        qualified_name = "/".join(self._stack)
+        # spans are listed in the order they started, parents before their children
+        index = len(self.spans)
+        self.spans.append(Span(qualified_name, None))
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.spans[index] = Span(qualified_name, time.monotonic() - start)
+            self._stack.pop()
+
+    def record_command(self, name, duration, returncode, size):
+        """Add a run of the command to its totals."""
+        totals = self.commands.setdefault(
+            name, {"count": 0, "duration": 0.0, "failures": 0, "output": 0}
+        )
+        totals["count"] += 1
+        totals["duration"] += duration
+        totals["failures"] += returncode not in (0, None)
+        totals["output"] += size
+
+    def to_dict(self):
+        """Return the profile as a JSON serializable dictionary."""
+        return {
+            "hook": self.hook,
+            "started": self.started,
+            "duration": round(time.monotonic() - self._start, 3),
+            "spans": [[span.name, round(span.duration, 3)] for span in self.spans],
+            "commands": {
+                name: {**totals, "duration": round(totals["duration"], 3)}
+                for name, totals in self.commands.items()
+            },
+        }
+
+
+def start(hook):
+    """Start the profile of the hook and make it the current profile."""
+    global _current  # pylint: disable=global-statement
+    _current = Profile(hook)
+    return _current
+
+
+@contextmanager
+def span(name):
+    """Time the enclosed step in the current profile, if any."""
+    if _current is None:
+        yield
+        return
+    with _current.span(name):
+        yield
+
+
+def record_command(name, duration, returncode, size):
+    """Add a run of the command to the totals of the current profile, if any."""
+    if _current is not None:
+        _current.record_command(name, duration, returncode, size)
+
+
+def load_profiles(path):
+    """Return the profiles saved in the file, from the oldest to the most recent."""
+    try:
+        return json.loads(path.read_text())
+    except FileNotFoundError:
+        return []
+    except ValueError:
+        logger.warning("Ignoring the corrupted hook timings in %s", path)
+        return []
+
+
+def save_profile(path, profile, history):
+    """Append the profile to the file, keeping the history most recent profiles.
+
+    The file is replaced atomically, so that a hook interrupted while saving
+    does not lose the previous profiles.
+    """
+    profiles = [*load_profiles(path), profile.to_dict()][-history:]
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(f".{path.name}.tmp")
+    tmp_path.write_text(json.dumps(profiles))
+    os.replace(tmp_path, path)
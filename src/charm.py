@@ -3,6 +3,8 @@
 """Iscsi Connector Charm."""
 
 
+import atexit
+import base64
 import json
 import logging
 import os
@@ -13,13 +15,9 @@ import time
 from datetime import datetime
 from functools import wraps
 from pathlib import Path
-from typing import Any, Callable, List, Optional, cast
+from typing import TYPE_CHECKING, Any, Callable, Dict, List, Optional, Tuple, cast
 
-import apt  # pylint: disable=import-error
 import yaml
-from charmhelpers.contrib.openstack import deferred_events, policy_rcd
-from charms.grafana_agent.v0.cos_agent import COSAgentProvider  # noqa
-from jinja2 import Environment, FileSystemLoader
 from ops.charm import (
     ActionEvent,
     CharmBase,
@@ -33,14 +31,36 @@ from ops.charm import (
     RelationJoinedEvent,
     StartEvent,
     UpdateStatusEvent,
+    UpgradeCharmEvent,
 )
-from ops.framework import StoredState
+from ops.framework import EventBase, StoredState
 from ops.main import main
 from ops.model import ActiveStatus, BlockedStatus, MaintenanceStatus, StatusBase
-from storage_connector import metrics_utils, nrpe_utils
+from storage_connector import (
+    benchmark_utils,
+    block_utils,
+    command_utils,
+    irq_utils,
+    iscsi_utils,
+    metrics_utils,
+    multipath_utils,
+    reconcile_utils,
+    systemd_utils,
+    timing_utils,
+)
 
 import utils  # noqa
 
+if TYPE_CHECKING:  # pragma: nocover
+    import cProfile
+
+    from charmhelpers.contrib.openstack.deferred_events import ServiceEvent
+    from jinja2 import Environment
+
+# NOTE: charmhelpers, jinja2, apt and the pydantic based cos_agent library are slow to
+# import, so they are imported only by the handlers that need them. This keeps the
+# frequent hooks (e.g. update-status) cheap.
+
 logger = logging.getLogger(__name__)
 
 
@@ -51,6 +71,10 @@ def check_deferred_restarts_queue(func: Callable) -> Callable:
     `StorageConnectorCharm` class. After decorated function is executed, this
     wrapper will clear the expired deferred restarts and attach correct status
     message if the unit is active.
+
+    If the deferred events directory has not changed since a previous check found it
+    empty, there is nothing to clear and the status message cannot have changed, so
+    the check is skipped at the cost of a single stat call.
     """
 
     @wraps(func)
@@ -58,18 +82,30 @@ def check_deferred_restarts_queue(func: Callable) -> Callable:
         """Execute wrapped method and perform status assessment."""
         result = func(self, *args, **kwargs)
 
+        if self._deferred_events_dir_state() == self._stored.idle_deferred_events_state:
+            logging.debug("No deferred events found, skipping deferred restarts check")
+            return result
+
         # Handle manual service restarts outside the charm (e.g. run
         # `systemctl restart {service}` in the unit). It compares
         # each service's start time with its deferred events timestamp
         # and clears any deferred events which happened prior to this time
         try:
-            deferred_events.check_restart_timestamps()
+            self._check_restart_timestamps()
         except ValueError as err:
             logging.error("Cannot retrieve services' start time: %s", err)
 
         if isinstance(self.unit.status, ActiveStatus):
             self.unit.status = ActiveStatus(self.get_status_message())
 
+        # A directory modified within the last second is not trusted, since another
+        # change in the same timestamp tick would leave its modification time as is.
+        dir_state = self._deferred_events_dir_state()
+        if any(self.DEFERRED_EVENTS_DIR.glob("*.deferred")) or time.time_ns() - dir_state < 10**9:
+            self._stored.idle_deferred_events_state = None
+        else:
+            self._stored.idle_deferred_events_state = dir_state
+
         return result
 
     return wrapper
@@ -88,10 +124,32 @@ class StorageConnectorCharm(CharmBase):
     MULTIPATH_CONF_DIR = Path("/etc/multipath")
     MULTIPATH_CONF_PATH = MULTIPATH_CONF_DIR / "conf.d"
     MULTIPATH_CONF_TEMPLATE = "storage-connector-multipath.conf.j2"
+    MULTIPATH_SECTIONS = ["defaults", "devices", "blacklist", "blacklist_exceptions"]
+    MULTIPATH_WWIDS_FILE = MULTIPATH_CONF_DIR / "wwids"
+    MULTIPATH_BINDINGS_FILE = MULTIPATH_CONF_DIR / "bindings"
+    UDEV_RULES_FILE = Path("/etc/udev/rules.d/60-storage-connector-queue.rules")
+    UDEV_RULES_TEMPLATE = "storage-connector-queue.rules.j2"
+    DEV_MAPPER = Path("/dev/mapper")
+    BENCHMARK_CONF_NAME = "zz-storage-connector-benchmark.conf"
+    BENCHMARK_CONF_TEMPLATE = "storage-connector-benchmark.conf.j2"
+    PATH_SELECTORS = ["round-robin", "queue-length", "service-time"]
+    PATH_SELECTOR_TIMEOUT = 30
 
     ISCSI_SERVICES = ["iscsid", "open-iscsi"]
     MULTIPATHD_SERVICE = "multipathd"
     DEFERRED_SERVICES = ISCSI_SERVICES + [MULTIPATHD_SERVICE]
+    # Services which have to be ready before the key service is (re)started
+    SERVICE_DEPENDENCIES = {"open-iscsi": ["iscsid"]}
+    SERVICE_READY_TIMEOUT = 60
+    ISCSID_SOCKET = "@ISCSIADM_ABSTRACT_NAMESPACE"
+    # same as charmhelpers.contrib.openstack.deferred_events.DEFERRED_EVENTS_DIR
+    DEFERRED_EVENTS_DIR = Path("/var/lib/policy-rc.d")
+    TIMINGS_FILE = Path("/var/lib/storage-connector/hook-timings.json")
+    PROFILES_DIR = Path("/var/log/storage-connector/profiles")
+    PROFILES_KEEP = 20
+    # set to profile a hook run by hand, without changing the config
+    PROFILE_ENV = "STORAGE_CONNECTOR_PROFILE"
+    PROFILE_SUMMARY_FUNCTIONS = 25
 
     VALID_STORAGE_TYPES = ["fc", "iscsi"]
     MANDATORY_CONFIG = {
@@ -99,13 +157,39 @@ class StorageConnectorCharm(CharmBase):
         "fc": ["storage-type", "fc-lun-alias", "multipath-devices"],
     }
     EXPORTER_PORT = 9090
+    # Hooks which never touch the cos-agent relation and run often enough that
+    # loading the cos_agent library for them is a measurable cost.
+    COS_AGENT_SKIP_HOOKS = ["update-status"]
+    # Hooks which would flush the timings of the hooks changing the machine out of
+    # the history: update-status runs every few minutes, and the read-only actions.
+    TIMINGS_SKIP_HOOKS = [
+        "update-status",
+        "plan",
+        "show-deferred-restarts",
+        "show-irq-affinity",
+        "show-profiles",
+        "show-queue-settings",
+        "show-timings",
+    ]
 
     def __init__(self, *args: Any) -> None:
         """Initialize charm and configure states and events to observe."""
         super().__init__(*args)
+        self._profiler: Optional["cProfile.Profile"] = None
+        if self.model.config.get("profile-hooks") or os.environ.get(self.PROFILE_ENV):
+            from storage_connector import cprofile_utils
+
+            self._profiler = cprofile_utils.start()
+            if self._profiler is not None:
+                # the commit event is not emitted when the hook fails
+                atexit.register(self._save_hook_profile)
+        self._profile = timing_utils.start(self._hook_name())
+        command_utils.set_slow_threshold(self.model.config.get("slow-command-threshold"))
 
         # -- standard hook observation
+        self.framework.observe(self.framework.on.commit, self._on_commit)
         self.framework.observe(self.on.install, self._on_install)
+        self.framework.observe(self.on.upgrade_charm, self._on_upgrade_charm)
         self.framework.observe(self.on.start, self._on_start)
         self.framework.observe(self.on.config_changed, self._render_config)
         self.framework.observe(self.on.config_changed, self._on_config_changed)
@@ -120,6 +204,15 @@ class StorageConnectorCharm(CharmBase):
         self.framework.observe(
             self.on.iscsi_discovery_and_login_action, self._on_iscsi_discovery_and_login_action
         )
+        self.framework.observe(self.on.rolling_relogin_action, self._on_rolling_relogin_action)
+        self.framework.observe(
+            self.on.show_queue_settings_action, self._on_show_queue_settings_action
+        )
+        self.framework.observe(self.on.show_irq_affinity_action, self._on_show_irq_affinity_action)
+        self.framework.observe(self.on.benchmark_action, self._on_benchmark_action)
+        self.framework.observe(self.on.plan_action, self._on_plan_action)
+        self.framework.observe(self.on.show_timings_action, self._on_show_timings_action)
+        self.framework.observe(self.on.show_profiles_action, self._on_show_profiles_action)
         self.framework.observe(
             self.on.cos_agent_relation_joined, self._on_cos_agent_relation_joined
         )
@@ -138,10 +231,13 @@ class StorageConnectorCharm(CharmBase):
             self.on.nrpe_external_master_relation_broken,
             self._on_nrpe_external_master_relation_broken,
         )
-        self.cos_agent_provider = COSAgentProvider(
-            self,
-            metrics_endpoints=[{"path": "/", "port": self.EXPORTER_PORT}],
-        )
+        if not self._skip_cos_agent():
+            from charms.grafana_agent.v0.cos_agent import COSAgentProvider
+
+            self.cos_agent_provider = COSAgentProvider(
+                self,
+                metrics_endpoints=[{"path": "/", "port": self.EXPORTER_PORT}],
+            )
 
         # -- initialize states --
         self._stored.set_default(
@@ -153,8 +249,20 @@ class StorageConnectorCharm(CharmBase):
             mp_conf_name="juju-" + self.app.name + "-multipath.conf",
             grafana_agent_related=False,
             nrpe_related=False,
+            is_container=None,
+            boot_id=None,
+            idle_deferred_events_state=None,
+            iscsi_relogin_pending=False,
+            iscsi_ifaces={},
+            iscsi_target_overrides={},
+            multipath_sections={},
+            reconciled={},
+            file_digests={},
         )
         self.mp_path: Path = self.MULTIPATH_CONF_PATH / cast(str, self._stored.mp_conf_name)
+        self.benchmark_conf: Path = self.MULTIPATH_CONF_PATH / self.BENCHMARK_CONF_NAME
+        self._deferred_restarts: Optional[List["ServiceEvent"]] = None
+        self._tenv: Optional["Environment"] = None
 
     def _on_install(self, _: InstallEvent) -> None:
         """Handle install state."""
@@ -163,28 +271,32 @@ class StorageConnectorCharm(CharmBase):
         if self._check_if_container():
             return
 
-        self._check_mandatory_config()
+        with timing_utils.span("validate"):
+            self._check_mandatory_config()
         if isinstance(self.unit.status, BlockedStatus):
             return
 
+        import apt  # pylint: disable=import-error
+
         # install packages
         cache = apt.cache.Cache()
-        cache.update()
-        cache.open()
-        for package in self.PACKAGES:
-            pkg = cache[package]
-            if not pkg.is_installed:
-                pkg.mark_install()
-
-        cache.commit()
+        with timing_utils.span("apt update"):
+            cache.update()
+            cache.open()
+        with timing_utils.span("apt install"):
+            for package in self.PACKAGES:
+                pkg = cache[package]
+                if not pkg.is_installed:
+                    pkg.mark_install()
+
+            cache.commit()
         # enable services to ensure they start upon reboot
         if self._stored.storage_type == "iscsi":
-            for service in self.ISCSI_SERVICES:
-                try:
-                    logging.info("Enabling %s service", service)
-                    subprocess.check_call(["systemctl", "enable", service])
-                except subprocess.CalledProcessError:
-                    logging.exception("Failed to enable %s.", service)
+            try:
+                with timing_utils.span("enable services"):
+                    systemd_utils.enable(self.ISCSI_SERVICES)
+            except subprocess.CalledProcessError:
+                logging.exception("Failed to enable %s.", ", ".join(self.ISCSI_SERVICES))
 
         self.unit.status = MaintenanceStatus("Install complete")
         logging.info("Install of software complete")
@@ -193,6 +305,8 @@ class StorageConnectorCharm(CharmBase):
     def _on_config_changed(self, _: ConfigChangedEvent) -> None:
         """Config-changed event handler."""
         if self._stored.nrpe_related is True:
+            from storage_connector import nrpe_utils
+
             nrpe_utils.update_nrpe_config(self.model.config)  # type: ignore
 
     def _render_config(self, _: ConfigChangedEvent) -> None:
@@ -202,42 +316,307 @@ class StorageConnectorCharm(CharmBase):
 
         # type casting is to keep mypy happy; see https://github.com/canonical/operator/issues/1401
         self.unit.status = cast(StatusBase, MaintenanceStatus("Validating charm configuration"))
-        self._check_mandatory_config()
+        with timing_utils.span("validate"):
+            self._validate_config()
         if isinstance(self.unit.status, BlockedStatus):
             return
 
-        if self._stored.storage_type == "fc" and self._stored.fc_scan_ran_once is False:
-            self._fc_scan_host()  # type: ignore
-            if isinstance(self.unit.status, BlockedStatus):
-                return
-
         # type casting is to keep mypy happy; see https://github.com/canonical/operator/issues/1401
         self.unit.status = cast(StatusBase, MaintenanceStatus("Rendering charm configuration"))
-        self._create_directories()
+        with timing_utils.span("reconcile"):
+            reconcile_utils.reconcile(self._resources(), self._stored.reconciled)
+        if isinstance(self.unit.status, BlockedStatus):
+            return
 
-        tenv = Environment(loader=FileSystemLoader("templates"))
+        logging.info("Setting started state")
+        self._stored.started = True
+        self._stored.configured = True
+        self.unit.status = ActiveStatus(self.get_status_message())
 
-        self._configure_deferred_restarts()
+    def _validate_config(self) -> None:
+        """Check the configuration, and block the charm if it is invalid."""
+        self._check_mandatory_config()
+        if isinstance(self.unit.status, BlockedStatus):
+            return
 
         if self._stored.storage_type == "iscsi":
-            self._configure_iscsi(tenv=tenv, event_name="config changed")
+            self._validate_iscsi_config()
             if isinstance(self.unit.status, BlockedStatus):
-                return  # pragma: nocover
+                return
 
-        self._multipath_configuration(tenv)
-        if isinstance(self.unit.status, BlockedStatus):
-            return
+        self._validate_block_queue_config()
+
+    def _on_upgrade_charm(self, _: UpgradeCharmEvent) -> None:
+        """Apply every resource again with the new charm, upon the next config-changed."""
+        self._stored.reconciled = {}
+
+    def _templates(self) -> "Environment":
+        """Return the environment of the templates, created upon first use."""
+        if self._tenv is None:
+            from jinja2 import Environment, FileSystemLoader
+
+            self._tenv = Environment(loader=FileSystemLoader("templates"))
+        return self._tenv
+
+    def _resources(self) -> List["reconcile_utils.Resource"]:
+        """Return the resources managed by the charm for the storage type.
 
-        self._validate_multipath_config()
+        The inputs of each resource are the config options it is rendered from, so
+        that a config change only applies the resources which depend on it.
+        """
+        config = self.model.config
+        storage_type = self._stored.storage_type
+
+        def options(*prefixes: str) -> Dict[str, Any]:
+            inputs = {key: value for key, value in config.items() if key.startswith(prefixes)}
+            return {**inputs, "storage-type": storage_type}
+
+        resources = [
+            reconcile_utils.Resource(
+                "directories",
+                lambda: options(),
+                self._create_directories,
+                observe=lambda: all(path.is_dir() for path in self._directories()),
+                plan=lambda: [
+                    reconcile_utils.Operation("create", str(path), reconcile_utils.DISRUPTION_NONE)
+                    for path in self._directories()
+                    if not path.is_dir()
+                ],
+            ),
+            reconcile_utils.Resource(
+                "deferred-restarts",
+                lambda: options("enable-auto-restarts"),
+                self._configure_deferred_restarts,
+                plan=lambda: [
+                    reconcile_utils.Operation(
+                        "write", "policy-rc.d", reconcile_utils.DISRUPTION_NONE
+                    )
+                ],
+            ),
+        ]
+        if storage_type == "fc":
+            # the scan runs first: nothing is configured if the HBAs cannot be scanned
+            resources.insert(
+                0,
+                reconcile_utils.Resource(
+                    "fc-scan",
+                    lambda: options(),
+                    self._reconcile_fc_scan,
+                    observe=lambda: self._stored.fc_scan_ran_once,
+                    plan=lambda: [
+                        reconcile_utils.Operation(
+                            "rescan", "scsi hosts", reconcile_utils.DISRUPTION_NONE
+                        )
+                    ],
+                ),
+            )
+        if storage_type == "iscsi":
+            resources.append(
+                reconcile_utils.Resource(
+                    "iscsi",
+                    lambda: options(
+                        "iscsi-", "initiator-dictionary", "array-preset", "enable-auto-restarts"
+                    ),
+                    self._reconcile_iscsi,
+                    observe=lambda: self._file_intact(self.ISCSI_CONF)
+                    and self.ISCSI_INITIATOR_NAME.exists(),
+                    depends=("directories", "deferred-restarts"),
+                    plan=self._plan_iscsi,
+                ),
+            )
+        resources += [
+            reconcile_utils.Resource(
+                "multipath",
+                lambda: options("multipath-", "array-preset", "fc-lun-alias"),
+                self._reconcile_multipath,
+                # a benchmark configuration left behind overrides the path selector
+                observe=lambda: self._file_intact(self.mp_path)
+                and not self.benchmark_conf.exists(),
+                depends=("directories", "fc-scan") if storage_type == "fc" else ("directories",),
+                plan=self._plan_multipath,
+            ),
+            reconcile_utils.Resource(
+                "block-queues",
+                lambda: options("block-queue-settings"),
+                lambda: self._configure_block_queues(self._templates()),
+                observe=lambda: self._file_intact(self.UDEV_RULES_FILE, required=False),
+                depends=("multipath",),
+                plan=self._plan_block_queues,
+            ),
+            reconcile_utils.Resource(
+                "irq-affinity",
+                lambda: options("irq-affinity", "iscsi-iface-bindings", "iscsi-target"),
+                self._configure_irq_affinity,
+                depends=("iscsi",) if storage_type == "iscsi" else (),
+                plan=lambda: [
+                    reconcile_utils.Operation(
+                        "spread", f"interrupts of {name}", reconcile_utils.DISRUPTION_NONE
+                    )
+                    for name in (
+                        self._storage_devices() if self.model.config.get("irq-affinity") else {}
+                    )
+                ],
+            ),
+        ]
+        return resources
+
+    def _reconcile_fc_scan(self) -> bool:
+        """Scan the HBAs for LUNs, and return whether it succeeded."""
+        self._fc_scan_host()
+        return not isinstance(self.unit.status, BlockedStatus)
+
+    def _reconcile_iscsi(self) -> bool:
+        """Apply the iscsi configuration, and return whether it succeeded."""
+        self._configure_iscsi(self._templates(), "config changed")
+        return not isinstance(self.unit.status, BlockedStatus)
+
+    def _reconcile_multipath(self) -> bool:
+        """Render the multipath configuration and apply it, if it is valid."""
+        # a configuration edited by hand may have been loaded, multipathd reloads it
+        drifted = not self._file_intact(self.mp_path)
+        ctxt = self._multipath_configuration(self._templates())
         if isinstance(self.unit.status, BlockedStatus):
-            return
+            return False
+        self._apply_multipath_config(ctxt, reload=drifted)
+        return True
 
-        self._reload_multipathd_service()
+    def _file_intact(self, path: Path, required: bool = True) -> bool:
+        """Return whether the file is still as the charm last wrote it.
 
-        logging.info("Setting started state")
-        self._stored.started = True
-        self._stored.configured = True
-        self.unit.status = ActiveStatus(self.get_status_message())
+        The digest of the content is recorded when the file is written, None
+        recording that the file must not exist. Files without a digest, e.g. written
+        by an older revision of the charm, are only checked for existence if required.
+        """
+        digests = self._stored.file_digests
+        if str(path) not in digests:  # type: ignore[operator]
+            return path.exists() or not required
+        expected = digests[str(path)]  # type: ignore[index]
+        if expected is None:
+            return not path.exists()
+        try:
+            return reconcile_utils.digest(path.read_text()) == expected
+        except OSError:
+            return False
+
+    def _record_file(self, path: Path, content: Optional[str]) -> None:
+        """Record the content the charm wrote to the file, None if it removed it."""
+        self._stored.file_digests[str(path)] = (  # type: ignore[index]
+            None if content is None else reconcile_utils.digest(content)
+        )
+
+    def _plan_iscsi(self) -> List["reconcile_utils.Operation"]:
+        """Return the operations applying the iscsi configuration would run."""
+        operation = reconcile_utils.Operation
+        operations = []
+        configured_name = self._configured_initiator_name()
+        file_name = self._get_initiator_name_from_file(self.ISCSI_INITIATOR_NAME)
+        initiator_rendered = not (configured_name or file_name) or bool(
+            configured_name and configured_name != file_name
+        )
+        if initiator_rendered:
+            operations.append(
+                operation("write", str(self.ISCSI_INITIATOR_NAME), reconcile_utils.DISRUPTION_NONE)
+            )
+        config = self.model.config
+        ifaces = iscsi_utils.resolve_iface_bindings(config.get("iscsi-iface-bindings"))
+        ifaces_changed = ifaces != dict(self._stored.iscsi_ifaces)
+        if ifaces_changed:
+            operations.append(operation("update", "iscsi ifaces", reconcile_utils.DISRUPTION_NONE))
+
+        previous_content = self.ISCSI_CONF.read_text() if self.ISCSI_CONF.exists() else None
+        content = self._render_iscsid_conf(self._templates())
+        if content != previous_content:
+            operations.append(
+                operation("write", str(self.ISCSI_CONF), reconcile_utils.DISRUPTION_NONE)
+            )
+        changes, disruption = self._iscsi_changes(initiator_rendered, previous_content, content)
+        services = ", ".join(self.ISCSI_SERVICES)
+        if disruption == iscsi_utils.DISRUPTION_RESTART:
+            if config.get("enable-auto-restarts") or not self._stored.started:
+                operations.append(
+                    operation("restart", services, reconcile_utils.DISRUPTION_RESTART)
+                )
+                return operations
+            operations.append(
+                operation("defer restart", services, reconcile_utils.DISRUPTION_NONE)
+            )
+        elif disruption == iscsi_utils.DISRUPTION_RELOGIN:
+            operations.append(
+                operation("update", "iscsi node records", reconcile_utils.DISRUPTION_NONE)
+            )
+            if config.get("enable-auto-restarts") or config.get("iscsi-rolling-relogin"):
+                operations.append(
+                    operation("relogin", "iscsi sessions", reconcile_utils.DISRUPTION_RELOGIN)
+                )
+            else:
+                operations.append(
+                    operation(
+                        "mark", "iscsi sessions pending relogin", reconcile_utils.DISRUPTION_NONE
+                    )
+                )
+        elif changes:
+            operations.append(
+                operation("update", "iscsi node records", reconcile_utils.DISRUPTION_NONE)
+            )
+        if ifaces_changed and config.get("iscsi-discovery-and-login"):
+            operations.append(operation("login", "iscsi ifaces", reconcile_utils.DISRUPTION_NONE))
+        return operations
+
+    def _plan_multipath(self) -> List["reconcile_utils.Operation"]:
+        """Return the operations applying the multipath configuration would run."""
+        operation = reconcile_utils.Operation
+        ctxt = self._multipath_context()
+        files = {self.mp_path: self._render_multipath_conf(ctxt)}
+        if "wwids" in ctxt:
+            files.update(self._managed_wwids_files(ctxt["wwids"]))
+        operations = [
+            operation("write", str(path), reconcile_utils.DISRUPTION_NONE)
+            for path, content in files.items()
+            if not path.exists() or path.read_text() != content
+        ]
+
+        sections, changed = self._multipath_changes(ctxt)
+        previous = dict(self._stored.multipath_sections)  # type: ignore
+        if self.benchmark_conf.exists():
+            operations.append(
+                operation("remove", str(self.benchmark_conf), reconcile_utils.DISRUPTION_NONE)
+            )
+        if self.benchmark_conf.exists() or not self._file_intact(self.mp_path):
+            operations.append(
+                operation("reload", self.MULTIPATHD_SERVICE, reconcile_utils.DISRUPTION_RELOAD)
+            )
+        elif previous and changed and set(changed) <= {"multipaths", "wwids"}:
+            wwids = multipath_utils.get_map_changes(
+                self._multipath_maps(previous), self._multipath_maps(sections)
+            )
+            operations += [
+                operation("update", f"multipath map {wwid}", reconcile_utils.DISRUPTION_NONE)
+                for wwid in wwids
+            ]
+        elif changed:
+            operations.append(
+                operation("reload", self.MULTIPATHD_SERVICE, reconcile_utils.DISRUPTION_RELOAD)
+            )
+        return operations
+
+    def _plan_block_queues(self) -> List["reconcile_utils.Operation"]:
+        """Return the operations applying the block queue settings would run."""
+        content = self._queue_rules(self._templates())
+        previous = self.UDEV_RULES_FILE.read_text() if self.UDEV_RULES_FILE.exists() else None
+        if content == previous:
+            return []
+        return [
+            reconcile_utils.Operation(
+                "write" if content is not None else "remove",
+                str(self.UDEV_RULES_FILE),
+                reconcile_utils.DISRUPTION_NONE,
+            ),
+            reconcile_utils.Operation(
+                "trigger",
+                "udev rules of the matching block devices",
+                reconcile_utils.DISRUPTION_NONE,
+            ),
+        ]
 
     def _on_start(self, event: StartEvent) -> None:
         """Handle start state."""
@@ -250,6 +629,8 @@ class StorageConnectorCharm(CharmBase):
             return
         self.unit.status = MaintenanceStatus("Starting charm software")
         # Start software
+        # the irq affinity is reset by a reboot, which is followed by a start event
+        self._configure_irq_affinity()
         self.unit.status = ActiveStatus(self.get_status_message())
         self._stored.started = True
         logging.info("Started")
@@ -272,10 +653,7 @@ class StorageConnectorCharm(CharmBase):
             return
         if deferred_only:
             deferred_services = list(
-                {
-                    deferred_event.service
-                    for deferred_event in deferred_events.get_deferred_restarts()
-                }
+                {deferred_event.service for deferred_event in self._get_deferred_restarts()}
             )
             if not deferred_services:
                 event.set_results({"failed": "No deferred services to restart"})
@@ -299,7 +677,7 @@ class StorageConnectorCharm(CharmBase):
     def _on_show_deferred_restarts_action(self, event: ActionEvent) -> None:
         """Get and display the list of service multipathd service."""
         output = []
-        for deferred_event in deferred_events.get_deferred_restarts():
+        for deferred_event in self._get_deferred_restarts():
             output.append(
                 f"{str(datetime.utcfromtimestamp(deferred_event.timestamp))} +0000 UTC "
                 f"{deferred_event.service.ljust(40)} {deferred_event.reason}"
@@ -307,6 +685,241 @@ class StorageConnectorCharm(CharmBase):
         output.sort()
         event.set_results({"deferred-restarts": yaml.dump(output, default_flow_style=False)})
 
+    def _on_show_queue_settings_action(self, event: ActionEvent) -> None:
+        """Show the block queue settings in effect on the storage devices."""
+        event.set_results(
+            {
+                "queue-settings": yaml.dump(
+                    block_utils.get_queue_settings(), default_flow_style=False
+                )
+            }
+        )
+
+    def _on_show_irq_affinity_action(self, event: ActionEvent) -> None:
+        """Show the NUMA node and interrupt affinity of the storage devices.
+
+        Devices whose affinity cannot be read, e.g. virtio devices which have no
+        local CPUs, are reported with the error.
+        """
+        devices: Dict[str, Dict[str, Any]] = {}
+        for name, device in self._storage_devices().items():
+            try:
+                devices[name] = irq_utils.describe(device)
+            except (OSError, ValueError) as err:
+                devices[name] = {"error": str(err)}
+        event.set_results({"irq-affinity": yaml.dump(devices, default_flow_style=False)})
+
+    def _on_benchmark_action(self, event: ActionEvent) -> None:
+        """Measure the read throughput of a multipath device and of its path groups."""
+        alias = event.params.get("alias")
+        device = event.params.get("device")
+        selectors = str(event.params.get("path-selectors") or "").split()
+        if bool(alias) == bool(device):
+            event.set_results({"failed": "Exactly one of alias and device must be given."})
+            return
+        if selectors and not alias:
+            event.set_results({"failed": "Comparing path selectors needs an alias."})
+            return
+        unknown = [name for name in selectors if name not in self.PATH_SELECTORS]
+        if unknown:
+            event.set_results({"failed": f"Unknown path selectors: {', '.join(unknown)}."})
+            return
+
+        try:
+            if selectors:
+                results = self._compare_path_selectors(alias, selectors, event)
+            elif device:
+                results = self._benchmark_all({device: [device]}, event)
+            else:
+                results = self._benchmark_all(self._benchmark_targets(alias), event)
+        except subprocess.CalledProcessError:
+            logging.exception("Failed to query or reconfigure the multipath map %s.", alias)
+            event.set_results(
+                {"failed": f"Multipath map {alias} not available, see the unit logs for details"}
+            )
+            return
+        except (OSError, ValueError) as err:
+            logging.exception("Benchmark failed.")
+            event.set_results({"failed": str(err)})
+            return
+        event.set_results({"results": yaml.dump(results, default_flow_style=False)})
+
+    def _benchmark_all(
+        self, targets: Dict[str, List[str]], event: ActionEvent
+    ) -> Dict[str, Dict[str, Any]]:
+        """Benchmark each target, a list of paths read concurrently."""
+        results = {}
+        for name, paths in targets.items():
+            event.log(f"Benchmarking {name}")
+            try:
+                results[name] = self._benchmark(paths, event.params)
+            except (OSError, ValueError) as err:
+                raise ValueError(f"Benchmark of {name} failed: {err}") from err
+        return results
+
+    def _compare_path_selectors(
+        self, alias: str, selectors: List[str], event: ActionEvent
+    ) -> Dict[str, Dict[str, Any]]:
+        """Benchmark the multipath map with each path selector, switched live.
+
+        A temporary multipath configuration sets the path selector of the map and
+        multipathd is reconfigured to load it. The configuration is removed and
+        multipathd reconfigured again once done, restoring the configured selector.
+        If the action is killed before, the next config change removes it.
+        """
+        from jinja2 import Environment, FileSystemLoader
+
+        wwid = multipath_utils.get_map_wwid(alias)
+        if wwid is None:
+            raise ValueError(f"Multipath map {alias} not found.")
+
+        template = Environment(loader=FileSystemLoader("templates")).get_template(
+            self.BENCHMARK_CONF_TEMPLATE
+        )
+        conf = self.benchmark_conf
+        results = {}
+        try:
+            for name in selectors:
+                selector = f"{name} 0"
+                multipath_utils.write_atomic(
+                    conf,
+                    template.render(
+                        wwid=wwid,
+                        path_selector=selector,
+                        rr_min_io_rq=event.params.get("rr-min-io-rq"),
+                    ),
+                )
+                multipath_utils.reconfigure()
+                self._wait_for_path_selector(alias, selector)
+                target = {f"multipath ({selector})": [str(self.DEV_MAPPER / alias)]}
+                results.update(self._benchmark_all(target, event))
+        finally:
+            if conf.exists():
+                conf.unlink()
+            multipath_utils.reconfigure()
+        return results
+
+    def _wait_for_path_selector(self, alias: str, selector: str) -> None:
+        """Wait until the path groups of the map use the path selector."""
+        deadline = time.monotonic() + self.PATH_SELECTOR_TIMEOUT
+        while True:
+            policies = {group.policy for group in multipath_utils.get_path_groups(alias)}
+            if policies == {selector}:
+                return
+            if time.monotonic() >= deadline:
+                raise ValueError(f"Multipath map {alias} did not switch to {selector}.")
+            time.sleep(1)
+
+    def _benchmark_targets(self, alias: str) -> Dict[str, List[str]]:
+        """Return the devices to benchmark: the multipath map, then each path group."""
+        targets = {"multipath": [str(self.DEV_MAPPER / alias)]}
+        for index, group in enumerate(multipath_utils.get_path_groups(alias), 1):
+            name = f"path-group-{index} ({group.status}, prio {group.prio})"
+            targets[name] = [f"/dev/{dev}" for dev in group.devices]
+        return targets
+
+    def _benchmark(self, paths: List[str], params: Dict[str, Any]) -> Dict[str, Any]:
+        """Run the sequential and random read tests against the paths."""
+        return {
+            pattern: benchmark_utils.run(
+                paths,
+                pattern,
+                params[f"{pattern}-block-size"],
+                params["queue-depth"],
+                params["duration"],
+            )
+            for pattern in benchmark_utils.PATTERNS
+        }
+
+    def _on_plan_action(self, event: ActionEvent) -> None:
+        """Show the operations the next config change would run, without running them."""
+        try:
+            steps = reconcile_utils.plan(self._resources(), self._stored.reconciled)
+        except (ValueError, subprocess.CalledProcessError) as err:
+            event.set_results({"failed": f"Cannot plan the changes: {err}"})
+            return
+        plan = [
+            {
+                "resource": name,
+                "reason": reason,
+                "operations": [
+                    f"{operation.action} {operation.target} ({operation.disruption})"
+                    for operation in operations
+                ],
+            }
+            for name, reason, operations in steps
+        ]
+        disruption = reconcile_utils.get_disruption(
+            [operation for _, _, operations in steps for operation in operations]
+        )
+        event.set_results(
+            {
+                "plan": yaml.dump(plan, default_flow_style=False, sort_keys=False),
+                "disruption": disruption,
+            }
+        )
+
+    def _on_show_timings_action(self, event: ActionEvent) -> None:
+        """Show the time spent in each step of the last hooks."""
+        profiles = timing_utils.load_profiles(self.TIMINGS_FILE)
+        if event.params.get("hook"):
+            profiles = [profile for profile in profiles if profile["hook"] == event.params["hook"]]
+        count = event.params["count"]
+        timings = []
+        for profile in reversed(profiles[-count:]):
+            spans: Dict[str, float] = {}
+            for name, duration in profile["spans"]:
+                # steps run several times in a hook are summed up
+                spans[name] = round(spans.get(name, 0) + duration, 3)
+            timings.append(
+                {
+                    "hook": profile["hook"],
+                    "started": datetime.fromtimestamp(profile["started"]).isoformat(
+                        timespec="seconds"
+                    ),
+                    "duration": profile["duration"],
+                    "spans": spans,
+                    # the commands which took the longest first
+                    "commands": dict(
+                        sorted(
+                            profile.get("commands", {}).items(),
+                            key=lambda item: item[1]["duration"],
+                            reverse=True,
+                        )
+                    ),
+                }
+            )
+        event.set_results(
+            {"timings": yaml.dump(timings, default_flow_style=False, sort_keys=False)}
+        )
+
+    def _on_show_profiles_action(self, event: ActionEvent) -> None:
+        """List the saved hook profiles, or fetch one of them."""
+        from storage_connector import cprofile_utils
+
+        paths = cprofile_utils.list_profiles(self.PROFILES_DIR)
+        name = event.params.get("name")
+        if not name:
+            count = event.params["count"]
+            profiles = [{"name": path.name, "size": path.stat().st_size} for path in paths[:count]]
+            event.set_results(
+                {"profiles": yaml.dump(profiles, default_flow_style=False, sort_keys=False)}
+            )
+            return
+
+        path = next((path for path in paths if path.name == name), None)
+        if path is None:
+            event.set_results({"failed": f"No profile named {name}."})
+            return
+
+        event.set_results(
+            {
+                "path": str(path),
+                "stats": cprofile_utils.summarize(path, self.PROFILE_SUMMARY_FUNCTIONS),
+                "data": base64.b64encode(path.read_bytes()).decode(),
+            }
+        )
+
     def _on_reload_multipathd_service_action(self, event: ActionEvent) -> None:
         """Reload multipathd service."""
         event.log("Reloading multipathd service")
@@ -318,6 +931,18 @@ class StorageConnectorCharm(CharmBase):
         self._iscsi_discovery_and_login()
         event.set_results({"success": "True"})
 
+    @check_deferred_restarts_queue
+    def _on_rolling_relogin_action(self, event: ActionEvent) -> None:
+        """Relogin the iscsi sessions one portal at a time."""
+        if self._stored.storage_type != "iscsi":
+            event.set_results({"failed": "Rolling relogin is only supported for iscsi storage"})
+            return
+        event.log("Relogin of the iscsi sessions one portal at a time")
+        if not self._relogin_iscsi_sessions(event.params.get("path-timeout")):
+            event.set_results({"failed": "Relogin failed, see the unit logs for details"})
+            return
+        event.set_results({"success": "True"})
+
     # Additional functions
     def get_status_message(self) -> str:
         """Set unit status to active with correct status message.
@@ -330,7 +955,7 @@ class StorageConnectorCharm(CharmBase):
             deferred_restarts = list(
                 {
                     event.service
-                    for event in deferred_events.get_deferred_restarts()
+                    for event in self._get_deferred_restarts()
                     if event.policy_requestor_name == self.app.name
                 }
             )
@@ -338,57 +963,349 @@ class StorageConnectorCharm(CharmBase):
                 svc_msg = f"Services queued for restart: {', '.join(sorted(deferred_restarts))}"
                 status_message = f"{status_message}. {svc_msg}"
 
+        if self._stored.iscsi_relogin_pending:
+            status_message = f"{status_message}. iSCSI sessions pending relogin"
+
         return status_message
 
+    def _check_restart_timestamps(self) -> None:
+        """Clear the deferred restarts of services restarted after they were deferred.
+
+        Same as deferred_events.check_restart_timestamps, but the start times of all
+        the services are read with a single systemctl call.
+        """
+        events = self._get_deferred_restarts()
+        start_times = systemd_utils.get_start_times(sorted({event.service for event in events}))
+        restarted_services = []
+        for event in events:
+            start_time = start_times.get(event.service)
+            deferred_restart_time = datetime.fromtimestamp(event.timestamp)
+            if start_time and start_time < deferred_restart_time:
+                logging.debug(
+                    "Restart still required, %s was started at %s, restart was requested "
+                    "after that at %s",
+                    event.service,
+                    start_time,
+                    deferred_restart_time,
+                )
+            else:
+                restarted_services.append(event.service)
+
+        if restarted_services:
+            self._clear_deferred_restarts(restarted_services)
+
+    def _deferred_events_dir_state(self) -> int:
+        """Return the modification time of the deferred events directory.
+
+        Creating or removing deferred event files updates this value. It is 0 if the
+        directory does not exist.
+        """
+        try:
+            return self.DEFERRED_EVENTS_DIR.stat().st_mtime_ns
+        except FileNotFoundError:
+            return 0
+
     def _defer_service_restart(self, services: List[str], reason: Optional[str] = None) -> None:
         """Defer service restarts and record this event."""
+        from charmhelpers.contrib.openstack import deferred_events
+
         for service in services:
-            deferred_events.save_event(
-                deferred_events.ServiceEvent(
-                    timestamp=round(time.time()),
-                    service=service,
-                    reason=f"Charm event: {reason}",
-                    action="restart",
-                )
+            event = deferred_events.ServiceEvent(
+                timestamp=round(time.time()),
+                service=service,
+                reason=f"Charm event: {reason}",
+                action="restart",
             )
+            # restarts already deferred are found in the cached events, while save_event
+            # reads every event file again for its own duplicate check
+            if any(event.matching_request(saved) for saved in self._get_deferred_restarts()):
+                logging.debug("Restart of %s is already deferred for: %s", service, reason)
+                continue
+            deferred_events.save_event(event)
+            self._deferred_restarts = None
+
+    def _get_deferred_restarts(self) -> List["ServiceEvent"]:
+        """Return the deferred restart events.
+
+        The event files are read and parsed once per dispatch. The result is dropped
+        whenever the charm saves or clears deferred events.
+        """
+        if self._deferred_restarts is None:
+            from charmhelpers.contrib.openstack import deferred_events
+
+            self._deferred_restarts = deferred_events.get_deferred_restarts()
+        return self._deferred_restarts
+
+    def _clear_deferred_restarts(self, services: List[str]) -> None:
+        """Clear the deferred restart events of the services."""
+        from charmhelpers.contrib.openstack import deferred_events
+
+        deferred_events.clear_deferred_restarts(services)
+        self._deferred_restarts = None
 
     def _restart_services(self, services: Optional[List[str]] = None) -> None:
         """Restart iscsid and open-iscsi services."""
         if services:
-            for service in services:
-                logging.info("Restarting %s service", service)
-                try:
-                    subprocess.check_call(["systemctl", "restart", service])
-                except subprocess.CalledProcessError:
-                    logging.exception("An error occured while restarting %s.", service)
+            not_ready = []
+            for group in self._restart_order(services):
+                with timing_utils.span(f"restart {', '.join(group)}"):
+                    try:
+                        systemd_utils.restart(group)
+                    except subprocess.CalledProcessError:
+                        logging.exception(
+                            "An error occured while restarting %s.", ", ".join(group)
+                        )
+                    with timing_utils.span("wait until ready"):
+                        not_ready += systemd_utils.wait_until_ready(
+                            group, self.SERVICE_READY_TIMEOUT, checks=self._readiness_checks()
+                        )
 
             # Clear deferred restart events
-            deferred_events.clear_deferred_restarts(services)
+            with timing_utils.span("clear deferred restarts"):
+                self._clear_deferred_restarts(services)
+            if any(svc in self.ISCSI_SERVICES for svc in services):
+                self._set_iscsi_relogin_pending(False)
 
             # If any iscsi services restarted and iscsi-discovery-and-login config is
             # set to true, run iscsiadm discovery and login.
             if any(svc in self.ISCSI_SERVICES for svc in services) and self.model.config.get(
                 "iscsi-discovery-and-login"
             ):
-                self._iscsi_discovery_and_login()
+                if any(svc in self.ISCSI_SERVICES for svc in not_ready):
+                    logging.error(
+                        "Skipping iscsi discovery and login, %s not ready. Run the "
+                        "iscsi-discovery-and-login action once the services are running.",
+                        ", ".join(not_ready),
+                    )
+                else:
+                    with timing_utils.span("iscsi discovery and login"):
+                        self._iscsi_discovery_and_login()
+
+    def _restart_order(self, services: List[str]) -> List[List[str]]:
+        """Split services into groups which can be restarted concurrently.
 
-    def _reload_multipathd_service(self) -> None:
+        Each group only depends on services from the previous groups, so the groups
+        are restarted one after the other, waiting for each one to be ready.
+        """
+        pending = sorted(set(services))
+        groups = []
+        while pending:
+            group = [
+                svc
+                for svc in pending
+                if not set(self.SERVICE_DEPENDENCIES.get(svc, [])).intersection(pending)
+            ]
+            groups.append(group)
+            pending = [svc for svc in pending if svc not in group]
+        return groups
+
+    def _readiness_checks(self) -> Dict[str, Callable[[], bool]]:
+        """Return checks telling if a service is ready, on top of being active."""
+        return {
+            "iscsid": lambda: systemd_utils.is_unix_socket_listening(self.ISCSID_SOCKET),
+        }
+
+    def _reload_multipathd_service(self) -> bool:
         """Reload multipathd service."""
         logging.info("Reloading multipathd service")
         try:
-            subprocess.check_call(["systemctl", "reload", self.MULTIPATHD_SERVICE])
+            systemd_utils.reload([self.MULTIPATHD_SERVICE])
         except subprocess.CalledProcessError:
             logging.exception("%s", "An error occured while reloading the multipathd service.")
+            return False
+        return True
+
+    @staticmethod
+    def _multipath_maps(sections: Dict[str, str]) -> Dict[str, Optional[str]]:
+        """Return the alias of each multipaths entry and managed WWID, keyed by WWID."""
+        maps = json.loads(sections.get("wwids") or "null") or {}
+        entry = json.loads(sections.get("multipaths") or "null")
+        if entry:
+            maps[entry["wwid"]] = entry["alias"]
+        return maps
+
+    def _multipath_changes(self, ctxt: Dict[str, Any]) -> Tuple[Dict[str, str], List[str]]:
+        """Return the serialized multipath sections and the ones changed since applied."""
+        sections = {
+            section: json.dumps(ctxt.get(section), sort_keys=True)
+            for section in [*self.MULTIPATH_SECTIONS, "multipaths", "wwids"]
+        }
+        previous = self._stored.multipath_sections
+        changed = [section for section in sections if sections[section] != previous.get(section)]
+        return sections, changed
 
-    def _configure_iscsi(self, tenv: Environment, event_name: str) -> None:
-        self._iscsi_initiator(tenv)
-        self._iscsid_configuration(tenv)
+    def _apply_multipath_config(self, ctxt: Dict[str, Any], reload: bool = False) -> None:
+        """Apply the changes of the multipath configuration to multipathd.
+
+        A full reload re-evaluates every map on the host, so it is only done when the
+        defaults, devices or blacklist sections changed, or when reload is set.
+        Changes limited to the multipaths section and the managed WWIDs are applied to
+        the affected maps only.
+        """
+        sections, changed = self._multipath_changes(ctxt)
+        previous = dict(self._stored.multipath_sections)  # type: ignore
+        reload = self._remove_benchmark_conf() or reload
+        if not changed and not reload:
+            logging.info("Multipath configuration unchanged, not reloading multipathd")
+            return
+
+        if previous and set(changed) <= {"multipaths", "wwids"} and not reload:
+            try:
+                updated = multipath_utils.apply_map_changes(
+                    self._multipath_maps(previous), self._multipath_maps(sections)
+                )
+                logging.info("Updated multipath maps: %s", ", ".join(updated) or "none")
+                self._stored.multipath_sections = sections
+                return
+            except subprocess.CalledProcessError:
+                logging.exception("Failed to update the multipath maps, reloading multipathd")
+
+        if self._reload_multipathd_service():
+            self._stored.multipath_sections = sections
+
+    def _remove_benchmark_conf(self) -> bool:
+        """Remove the configuration a killed benchmark left behind, if any.
+
+        Returns whether it was removed, in which case multipathd must be reloaded to
+        restore the configured path selector.
+        """
+        if not self.benchmark_conf.exists():
+            return False
+        logging.warning("Removing the stale benchmark configuration %s", self.benchmark_conf)
+        self.benchmark_conf.unlink()
+        return True
+
+    def _configure_iscsi(self, tenv: "Environment", event_name: str) -> None:
+        initiator_rendered = self._iscsi_initiator(tenv)
+        ifaces_changed = self._configure_iscsi_ifaces()
+        previous_content = self.ISCSI_CONF.read_text() if self.ISCSI_CONF.exists() else None
+        content = self._iscsid_configuration(tenv)
+
+        # Changes of node settings are applied to the node records and the sessions,
+        # without restarting the iscsi services and dropping every session at once.
+        changes, disruption = self._iscsi_changes(initiator_rendered, previous_content, content)
+        if disruption != iscsi_utils.DISRUPTION_RESTART and self._apply_iscsi_settings(
+            changes, disruption
+        ):
+            self._login_iscsi_ifaces(ifaces_changed)
+            return
 
         charm_config = self.model.config
         if charm_config.get("enable-auto-restarts") or self._stored.started is False:
             self._restart_services(services=self.ISCSI_SERVICES)
         else:
             self._defer_service_restart(services=self.ISCSI_SERVICES, reason=event_name)
+            self._login_iscsi_ifaces(ifaces_changed)
+
+    def _iscsi_changes(
+        self, initiator_rendered: bool, previous_content: Optional[str], content: str
+    ) -> Tuple[Dict[str, Optional[str]], str]:
+        """Return the changed iscsid.conf settings and the disruption to apply them.
+
+        The iscsi services are restarted before the charm is started and when the
+        initiator name changes, whatever the settings.
+        """
+        if not self._stored.started or initiator_rendered or previous_content is None:
+            return {}, iscsi_utils.DISRUPTION_RESTART
+        changes = iscsi_utils.changed_settings(
+            iscsi_utils.parse_iscsid_conf(previous_content),
+            iscsi_utils.parse_iscsid_conf(content),
+        )
+        disruption = iscsi_utils.get_disruption(changes)
+        if self._target_overrides() != self._stored.iscsi_target_overrides:
+            # overrides are applied to the node records, like node settings
+            disruption = max(
+                disruption,
+                iscsi_utils.DISRUPTION_RELOGIN,
+                key=iscsi_utils.DISRUPTION_ORDER.index,
+            )
+        return changes, disruption
+
+    def _configure_iscsi_ifaces(self) -> bool:
+        """Bind iscsi ifaces to the configured NICs and return whether they changed."""
+        ifaces = iscsi_utils.resolve_iface_bindings(self.model.config.get("iscsi-iface-bindings"))
+        if ifaces == dict(self._stored.iscsi_ifaces):
+            return False
+        try:
+            iscsi_utils.configure_ifaces(ifaces)
+        except subprocess.CalledProcessError:
+            logging.exception("Failed to configure the iscsi ifaces.")
+            return False
+        self._stored.iscsi_ifaces = ifaces
+        return True
+
+    def _login_iscsi_ifaces(self, ifaces_changed: bool) -> None:
+        """Open the sessions of changed ifaces, which do not need a restart."""
+        if ifaces_changed and self.model.config.get("iscsi-discovery-and-login"):
+            self._iscsi_discovery_and_login()
+
+    def _apply_iscsi_settings(self, changes: Dict[str, str], disruption: str) -> bool:
+        """Apply changed iscsid settings to the node records and relogin if needed.
+
+        Returns False if the node records could not be updated.
+        """
+        if not changes and disruption == iscsi_utils.DISRUPTION_NONE:
+            logging.debug("iscsid.conf settings did not change")
+            return True
+
+        logging.info("Applying iscsid settings %s to node records", ", ".join(sorted(changes)))
+        try:
+            iscsi_utils.update_node_settings(changes)
+            # the global settings may have overwritten the per-target overrides
+            self._apply_target_overrides()
+        except subprocess.CalledProcessError:
+            logging.exception("Failed to update the iscsi node records.")
+            return False
+
+        if disruption == iscsi_utils.DISRUPTION_RELOGIN:
+            charm_config = self.model.config
+            if charm_config.get("enable-auto-restarts") or charm_config.get(
+                "iscsi-rolling-relogin"
+            ):
+                self._relogin_iscsi_sessions()
+            else:
+                logging.info("iscsi sessions need a relogin to apply the new settings")
+                self._set_iscsi_relogin_pending(True)
+        return True
+
+    def _target_overrides(self) -> Dict[str, Dict[str, str]]:
+        """Return the per-target overrides of the node settings."""
+        return iscsi_utils.parse_target_overrides(self.model.config.get("iscsi-target-overrides"))
+
+    def _apply_target_overrides(self) -> None:
+        """Apply the per-target overrides to the node records of their targets."""
+        overrides = self._target_overrides()
+        defaults = iscsi_utils.parse_iscsid_conf(
+            self.ISCSI_CONF.read_text() if self.ISCSI_CONF.exists() else ""
+        )
+        iscsi_utils.apply_target_overrides(
+            self._stored.iscsi_target_overrides, overrides, defaults
+        )
+        self._stored.iscsi_target_overrides = overrides
+
+    def _relogin_iscsi_sessions(self, path_timeout: Optional[int] = None) -> bool:
+        """Relogin the iscsi sessions one portal at a time.
+
+        Returns False if the relogin failed or the paths did not come back in time,
+        in which case the remaining sessions are left untouched.
+        """
+        if path_timeout is None:
+            path_timeout = cast(int, self.model.config.get("iscsi-relogin-path-timeout"))
+        try:
+            iscsi_utils.rolling_relogin(multipath_utils.count_active_paths, path_timeout)
+        except (subprocess.CalledProcessError, TimeoutError):
+            logging.exception("Failed to relogin the iscsi sessions.")
+            self._set_iscsi_relogin_pending(True)
+            return False
+        self._set_iscsi_relogin_pending(False)
+        return True
+
+    def _set_iscsi_relogin_pending(self, pending: bool) -> None:
+        """Record whether the iscsi sessions need a relogin to apply settings."""
+        if self._stored.iscsi_relogin_pending != pending:
+            self._stored.iscsi_relogin_pending = pending
+            # the status message changes, so the next status assessment can't be skipped
+            self._stored.idle_deferred_events_state = None
 
     def _check_mandatory_config(self) -> None:
         """Check whether mandatory configs are provided."""
@@ -417,6 +1334,9 @@ class StorageConnectorCharm(CharmBase):
         mandatory_config = self.MANDATORY_CONFIG[cast(str, self._stored.storage_type)]
         missing_config = []
         for config in mandatory_config:
+            # the device entry of the array can come from a preset instead
+            if config == "multipath-devices" and charm_config.get("array-preset"):
+                continue
             if charm_config.get(config) is None:
                 missing_config.append(config)
         if missing_config:
@@ -424,6 +1344,40 @@ class StorageConnectorCharm(CharmBase):
                 f"Missing mandatory configuration option(s) {missing_config}"
             )
 
+    def _validate_iscsi_config(self) -> None:
+        """Check the iscsi tuning, iface bindings and target overrides are valid."""
+        charm_config = self.model.config
+        checks = [
+            ("iscsid tuning", lambda: iscsi_utils.get_iscsid_tuning(charm_config)),
+            (
+                "iscsi iface bindings",
+                lambda: iscsi_utils.resolve_iface_bindings(
+                    charm_config.get("iscsi-iface-bindings")
+                ),
+            ),
+            (
+                "iscsi target overrides",
+                lambda: iscsi_utils.parse_target_overrides(
+                    charm_config.get("iscsi-target-overrides")
+                ),
+            ),
+        ]
+        for name, check in checks:
+            try:
+                check()
+            except ValueError as err:
+                logging.error("Invalid %s: %s", name, err)
+                self.unit.status = BlockedStatus(f"Invalid {name}: {err}")
+                return
+
+    def _validate_block_queue_config(self) -> None:
+        """Check the block queue settings are valid."""
+        try:
+            block_utils.parse_queue_rules(self.model.config.get("block-queue-settings"))
+        except ValueError as err:
+            logging.error("Invalid block queue settings: %s", err)
+            self.unit.status = BlockedStatus(f"Invalid block queue settings: {err}")
+
     def _defer_once(self, event: HookEvent) -> None:
         """Defer the given event, but only once."""
         notice_count = 0
@@ -442,31 +1396,46 @@ class StorageConnectorCharm(CharmBase):
             logging.debug("Deferring %s notice count of %d", handle, notice_count)
             event.defer()
 
-    def _create_directories(self) -> None:
-        self.MULTIPATH_CONF_DIR.mkdir(exist_ok=True, mode=0o750)
-        self.MULTIPATH_CONF_PATH.mkdir(exist_ok=True, mode=0o750)
+    def _directories(self) -> List[Path]:
+        """Return the configuration directories of the storage type."""
+        directories = [self.MULTIPATH_CONF_DIR, self.MULTIPATH_CONF_PATH]
         if self._stored.storage_type == "iscsi":
-            self.ISCSI_CONF_PATH.mkdir(exist_ok=True, mode=0o750)
+            directories.append(self.ISCSI_CONF_PATH)
+        return directories
 
-    def _iscsi_initiator(self, tenv: Environment) -> None:
-        charm_config = self.model.config
-        initiator_name = None
-        hostname = socket.getfqdn()
+    def _create_directories(self) -> bool:
+        """Create the configuration directories, and return whether it succeeded."""
+        try:
+            for directory in self._directories():
+                directory.mkdir(exist_ok=True, mode=0o750)
+        except OSError:
+            logging.exception("Failed to create the configuration directories.")
+            return False
+        return True
+
+    def _configured_initiator_name(self) -> Optional[str]:
+        """Return the initiator name of the host in initiator-dictionary, if any."""
         # Ensure it's string according to config.yaml
-        initiators: str = charm_config.get("initiator-dictionary")  # type: ignore [assignment]
+        initiators: str = self.model.config.get("initiator-dictionary")  # type: ignore [assignment]
         if initiators:
             # search for hostname in initiator-dictionary if it exists
             initiators_dict = json.loads(initiators)
+            hostname = socket.getfqdn()
             if hostname in initiators_dict.keys():
-                initiator_name = initiators_dict[hostname]
+                return initiators_dict[hostname]
+        return None
 
+    def _iscsi_initiator(self, tenv: "Environment") -> bool:
+        """Render the initiator name if needed and return whether it was rendered."""
+        initiator_name = self._configured_initiator_name()
+        hostname = socket.getfqdn()
         initiator_name_from_file = self._get_initiator_name_from_file(self.ISCSI_INITIATOR_NAME)
 
         # either initiator-dictionary not provided or hostname not present there
         # and config file doesn't contain initiator name
         if not initiator_name and not initiator_name_from_file:
             # generate random iqn
-            initiator_name = subprocess.getoutput("/sbin/iscsi-iname")
+            initiator_name = command_utils.getoutput("/sbin/iscsi-iname")
             logging.warning(
                 "Hostname was not found in initiator-dict and /etc/initiatorname.iscsi file."
                 + "The randomly generated iqn %s will be used for %s",
@@ -486,6 +1455,8 @@ class StorageConnectorCharm(CharmBase):
             # 2. no initiator name configuration but name is present in file. use
             #    the same name.
             logging.debug("/etc/initiatorname.iscsi file was not rendered")
+            return False
+        return True
 
     def _get_initiator_name_from_file(
         self, iscsi_config_file: Optional[Path] = None
@@ -518,7 +1489,7 @@ class StorageConnectorCharm(CharmBase):
                 return initiator_name
         return None
 
-    def _render_iscsi_initiator(self, initiator_name: str, tenv: Environment) -> None:
+    def _render_iscsi_initiator(self, initiator_name: str, tenv: "Environment") -> None:
         """Render /etc/iscsi/initiatorname.iscsi file with provided initiator name."""
         logging.info("Rendering initiatorname.iscsi")
         ctxt = {"initiator_name": initiator_name}
@@ -526,7 +1497,15 @@ class StorageConnectorCharm(CharmBase):
         rendered_content = template.render(ctxt)
         self.ISCSI_INITIATOR_NAME.write_text(rendered_content)
 
-    def _iscsid_configuration(self, tenv: Environment) -> None:
+    def _iscsid_configuration(self, tenv: "Environment") -> str:
+        content = self._render_iscsid_conf(tenv)
+        self.ISCSI_CONF.write_text(content)
+        self.ISCSI_CONF.chmod(0o600)
+        self._record_file(self.ISCSI_CONF, content)
+        return content
+
+    def _render_iscsid_conf(self, tenv: "Environment") -> str:
+        """Render the content of iscsid.conf."""
         charm_config = self.model.config
         ctxt = {
             "node_startup": charm_config.get("iscsi-node-startup"),
@@ -537,25 +1516,28 @@ class StorageConnectorCharm(CharmBase):
             "auth_password": charm_config.get("iscsi-node-session-auth-password"),
             "auth_username_in": charm_config.get("iscsi-node-session-auth-username-in"),
             "auth_password_in": charm_config.get("iscsi-node-session-auth-password-in"),
+            **iscsi_utils.get_iscsid_tuning(charm_config),
         }
         logging.info("Rendering iscsid.conf template.")
         template = tenv.get_template("iscsid.conf.j2")
-        rendered_content = template.render(ctxt)
-        self.ISCSI_CONF.write_text(rendered_content)
-        self.ISCSI_CONF.chmod(0o600)
+        return template.render(ctxt)
 
-    def _multipath_configuration(self, tenv: Environment) -> None:
+    def _multipath_context(self) -> Dict[str, Any]:
+        """Return the sections of the multipath configuration to render.
+
+        ValueError is raised with the status message if the configuration is invalid.
+        """
         charm_config = self.model.config
-        ctxt = {}
-        multipath_sections = ["defaults", "devices", "blacklist"]
-        for section in multipath_sections:
+        ctxt: Dict[str, Any] = {}
+        for section in self.MULTIPATH_SECTIONS:
+            option = "multipath-" + section.replace("_", "-")
             # Ensure it's string according to config.yaml
-            config: str = charm_config.get("multipath-" + section)  # type: ignore [assignment]
+            config: str = charm_config.get(option)  # type: ignore [assignment]
             if config:
                 logging.info("Gather information for the multipaths section %s", section)
-                logging.debug("multipath-%s data: %s", section, config)
+                logging.debug("%s data: %s", option, config)
                 try:
-                    ctxt[section] = json.loads(config)
+                    ctxt[section] = multipath_utils.parse_section(section, json.loads(config))
                 except json.JSONDecodeError as exception:
                     logging.info(
                         "An exception has occured. Please verify the format \
@@ -564,29 +1546,164 @@ class StorageConnectorCharm(CharmBase):
                         section,
                         exception,
                     )
-                    self.unit.status = BlockedStatus(
+                    raise ValueError(
                         "Exception occured during the multipath \
                         configuration. Please check logs."
-                    )
-                    return
+                    ) from exception
+                except ValueError as err:
+                    raise ValueError(f"Invalid {option}: {err}") from err
             else:
                 logging.debug("multipath-%s is empty.", section)  # pragma: nocover
 
+        preset: str = charm_config.get("array-preset")  # type: ignore [assignment]
+        if preset:
+            try:
+                ctxt["devices"] = multipath_utils.apply_preset(preset, ctxt.get("devices", []))
+            except ValueError as err:
+                raise ValueError(f"Invalid array-preset: {err}") from err
+
         if self._stored.storage_type == "fc":
             wwid = self._retrieve_multipath_wwid()
             if not wwid:
-                self.unit.status = BlockedStatus(
-                    "No WWID was found. Please check multipath status and logs."
-                )
-                return
+                raise ValueError("No WWID was found. Please check multipath status and logs.")
             alias = charm_config.get("fc-lun-alias")
             ctxt["multipaths"] = {"wwid": wwid, "alias": alias}
 
+        wwids_config: str = charm_config.get("multipath-wwids")  # type: ignore [assignment]
+        if wwids_config:
+            try:
+                wwids = multipath_utils.parse_wwids(json.loads(wwids_config))
+            except ValueError as err:
+                raise ValueError(f"Invalid multipath-wwids: {err}") from err
+            if "multipaths" in ctxt:
+                wwids[ctxt["multipaths"]["wwid"]] = ctxt["multipaths"]["alias"]
+            # only create maps for the managed WWIDs, named after the bindings
+            defaults = ctxt.setdefault("defaults", {})
+            defaults.setdefault("find_multipaths", "strict")
+            defaults.setdefault("user_friendly_names", "yes")
+            ctxt["wwids"] = wwids
+        return ctxt
+
+    def _render_multipath_conf(self, ctxt: Dict[str, Any]) -> str:
+        """Render the content of the multipath configuration file."""
         logging.debug("Rendering multipath json template")
-        template = tenv.get_template(self.MULTIPATH_CONF_TEMPLATE)
-        rendered_content = template.render(ctxt)
+        template = self._templates().get_template(self.MULTIPATH_CONF_TEMPLATE)
+        return template.render(ctxt)
+
+    def _multipath_configuration(self, tenv: "Environment") -> Dict[str, Any]:
+        """Render the multipath configuration and return its sections."""
+        try:
+            ctxt = self._multipath_context()
+        except ValueError as err:
+            logging.error("%s", err)
+            self.unit.status = BlockedStatus(str(err))
+            return {}
+
+        rendered_content = self._render_multipath_conf(ctxt)
+        previous_content = self.mp_path.read_text() if self.mp_path.exists() else None
         self.mp_path.write_text(rendered_content)
         self.mp_path.chmod(0o600)
+        self._record_file(self.mp_path, rendered_content)
+        self._validate_multipath_config(previous_content)
+        if "wwids" in ctxt and not isinstance(self.unit.status, BlockedStatus):
+            for path, content in self._managed_wwids_files(ctxt["wwids"]).items():
+                multipath_utils.write_atomic(path, content)
+        return ctxt
+
+    def _managed_wwids_files(self, wwids: Dict[str, Optional[str]]) -> Dict[Path, str]:
+        """Return the content of the wwids allow-list and the bindings of the managed WWIDs.
+
+        WWIDs without an alias keep the one multipath bound them to, unless it is
+        now used by another WWID, so that the map names are stable across reboots.
+        """
+        bindings_file = self.MULTIPATH_BINDINGS_FILE
+        existing = (
+            multipath_utils.parse_bindings(bindings_file.read_text())
+            if bindings_file.exists()
+            else {}
+        )
+        aliases = set(wwids.values())
+        bindings = {
+            wwid: alias or existing[wwid]
+            for wwid, alias in wwids.items()
+            if alias or existing.get(wwid) not in {None, *aliases}
+        }
+        return {
+            self.MULTIPATH_WWIDS_FILE: multipath_utils.render_wwids(wwids),
+            bindings_file: multipath_utils.render_bindings(bindings),
+        }
+
+    def _queue_rules(self, tenv: "Environment") -> Optional[str]:
+        """Return the udev rules tuning the block queues, or None if there are none."""
+        rules = block_utils.parse_queue_rules(self.model.config.get("block-queue-settings"))
+        if not rules:
+            return None
+        return tenv.get_template(self.UDEV_RULES_TEMPLATE).render({"rules": rules})
+
+    def _configure_block_queues(self, tenv: "Environment") -> bool:
+        """Render the udev rules tuning the block queues and apply them if changed.
+
+        Returns whether the rules were applied. Rules which could not be applied are
+        removed, so that they are seen as changed, and applied, on the next attempt.
+        """
+        content = self._queue_rules(tenv)
+        previous = self.UDEV_RULES_FILE.read_text() if self.UDEV_RULES_FILE.exists() else None
+        self._record_file(self.UDEV_RULES_FILE, content)
+        if content == previous:
+            return True
+        if content is not None:
+            logging.info("Rendering the block queue udev rules.")
+            self.UDEV_RULES_FILE.write_text(content)
+        else:
+            # the values in effect are kept until the devices are added again
+            logging.info("Removing the block queue udev rules.")
+            self.UDEV_RULES_FILE.unlink()
+
+        try:
+            block_utils.apply_queue_rules(
+                block_utils.parse_queue_rules(self.model.config.get("block-queue-settings"))
+            )
+        except subprocess.CalledProcessError:
+            logging.exception("Failed to apply the block queue settings.")
+            self.UDEV_RULES_FILE.unlink(missing_ok=True)
+            return False
+        return True
+
+    def _storage_devices(self) -> Dict[str, Path]:
+        """Return the PCI devices carrying the storage traffic, keyed by name.
+
+        These are the HBAs for fc storage, and the NICs the iscsi ifaces are bound
+        to, or the NIC routing to the target, for iscsi storage.
+        """
+        if self._stored.storage_type == "fc":
+            return irq_utils.get_fc_devices()
+
+        nics = sorted(set(self._stored.iscsi_ifaces.values()))
+        if not nics:
+            target = str(self.model.config.get("iscsi-target"))
+            try:
+                nic = iscsi_utils.get_route_interface(target)
+            except subprocess.CalledProcessError:
+                logging.exception("Failed to find the interface routing to %s.", target)
+                nic = None
+            nics = [nic] if nic else []
+        return irq_utils.get_nic_devices(nics)
+
+    def _configure_irq_affinity(self) -> bool:
+        """Spread the interrupts of the storage devices over their local CPUs.
+
+        Returns whether the interrupts of every device were spread.
+        """
+        if not self.model.config.get("irq-affinity"):
+            return True
+        spread = True
+        for name, device in self._storage_devices().items():
+            try:
+                irq_utils.spread_irqs(device)
+            except (OSError, ValueError):
+                logging.exception("Failed to set the irq affinity of %s.", name)
+                spread = False
+        return spread
 
     def _iscsi_discovery_and_login(self) -> None:
         """Run iscsiadm discovery and login against targets."""
@@ -595,23 +1712,32 @@ class StorageConnectorCharm(CharmBase):
         port = str(charm_config.get("iscsi-port"))
         logging.info("Launching iscsiadm discovery and login against targets")
 
+        # node records are created for each iface, so that every iface logs in
+        ifaces = [arg for name in sorted(self._stored.iscsi_ifaces) for arg in ("-I", name)]
+
         try:
-            subprocess.check_call(
+            command_utils.check_call(
                 ["iscsiadm", "-m", "discovery", "-t", "sendtargets", "-p", target + ":" + port]
+                + ifaces
             )
         except subprocess.CalledProcessError:
             logging.exception("Iscsi discovery failed.")
             return
 
         try:
-            subprocess.check_output(
+            self._apply_target_overrides()
+        except subprocess.CalledProcessError:
+            logging.exception("Failed to apply the iscsi target overrides.")
+
+        try:
+            command_utils.check_output(
                 ["iscsiadm", "-m", "node", "--login"], stderr=subprocess.STDOUT
             )
         except subprocess.CalledProcessError as err:
             logging.exception("Iscsi login failed. \n%s", err.output.decode("utf-8"))
 
     def _fc_scan_host(self) -> None:
-        hba_adapters = subprocess.getoutput("ls /sys/class/scsi_host")
+        hba_adapters = command_utils.getoutput("ls /sys/class/scsi_host")
         logging.debug("hba_adapters: %s", hba_adapters)
         if not hba_adapters:
             logging.info("No scsi devices were found. Scan aborted")
@@ -632,45 +1758,108 @@ class StorageConnectorCharm(CharmBase):
 
     def _retrieve_multipath_wwid(self) -> Optional[str]:
         logging.info("Retrive device WWID via multipath -ll")
-        result = subprocess.getoutput("multipath -ll")
+        result = command_utils.getoutput("multipath -ll")
         wwid = re.findall(r"\(([\d\w]+)\)", result)
         logging.info("WWID is %s", wwid)
         return wwid[0] if wwid else None
 
-    def _validate_multipath_config(self) -> None:
-        result = subprocess.getoutput("multipath -ll")
+    def _validate_multipath_config(self, previous_content: Optional[str] = None) -> None:
+        """Check multipath accepts the configuration written, before multipathd reloads it.
+
+        The keywords are validated before rendering, this catches what the schema
+        does not know about. A rejected configuration is replaced with the previous
+        one, so that multipathd never picks it up.
+        """
+        result = command_utils.getoutput("multipath -ll")
         error = re.findall(r"(invalid\skeyword:\s\w+)", result)
         if error:
             logging.info("Configuration is probably malformed. See output below %s", result)
             self.unit.status = BlockedStatus(f"Multipath conf error: {error}")
+            if previous_content is None:
+                self.mp_path.unlink(missing_ok=True)
+            else:
+                self.mp_path.write_text(previous_content)
+            logging.warning("Restored the previous multipath configuration")
 
     def _check_if_container(self) -> bool:
-        """Check if the charm is being deployed on a container host."""
-        if utils.is_container():
+        """Check if the charm is being deployed on a container host.
+
+        The result is cached in the stored state along with the boot ID, since a
+        machine cannot become a container without a reboot.
+        """
+        boot_id = utils.get_boot_id()
+        if boot_id is None or self._stored.is_container is None or self._stored.boot_id != boot_id:
+            self._stored.is_container = utils.is_container()
+            self._stored.boot_id = boot_id
+
+        if self._stored.is_container:
             self.unit.status = BlockedStatus("This charm is not supported on containers.")
             logging.error("This charm is not supported on containers. Stopping execution.")
             return True
         return False
 
-    def _configure_deferred_restarts(self) -> None:
-        """Set up deferred restarts in policy-rc.d."""
-        policy_rcd.install_policy_rcd()
-        os.chmod(f"/var/lib/charm/{self.app.name}/policy-rc.d", 0o755)
+    def _configure_deferred_restarts(self) -> bool:
+        """Set up deferred restarts in policy-rc.d, and return whether it succeeded."""
+        from charmhelpers.contrib.openstack import policy_rcd
 
-        charm_config = self.model.config
-        if charm_config.get("enable-auto-restarts"):
-            policy_rcd.remove_policy_file()
-        else:
-            blocked_actions = ["stop", "restart", "try-restart"]
-            for svc in self.DEFERRED_SERVICES:
-                policy_rcd.add_policy_block(svc, blocked_actions)
+        try:
+            policy_rcd.install_policy_rcd()
+            os.chmod(f"/var/lib/charm/{self.app.name}/policy-rc.d", 0o755)
+
+            charm_config = self.model.config
+            if charm_config.get("enable-auto-restarts"):
+                policy_rcd.remove_policy_file()
+            else:
+                blocked_actions = ["stop", "restart", "try-restart"]
+                for svc in self.DEFERRED_SERVICES:
+                    policy_rcd.add_policy_block(svc, blocked_actions)
+        except OSError:
+            logging.exception("Failed to set up the deferred restarts.")
+            return False
+        return True
+
+    def _hook_name(self) -> str:
+        """Return the name of the dispatched hook or action."""
+        return Path(os.environ.get("JUJU_DISPATCH_PATH", "")).name
+
+    def _skip_cos_agent(self) -> bool:
+        """Check if the cos_agent provider can be skipped for the dispatched event."""
+        if os.environ.get("JUJU_ACTION_NAME"):
+            return True
+        return self._hook_name() in self.COS_AGENT_SKIP_HOOKS
+
+    def _save_hook_profile(self) -> None:
+        """Save the profile of the hook, if it is profiled and not saved yet."""
+        if self._profiler is None:
+            return
+        from storage_connector import cprofile_utils
+
+        profiler, self._profiler = self._profiler, None
+        atexit.unregister(self._save_hook_profile)
+        try:
+            cprofile_utils.save(self.PROFILES_DIR, profiler, self._hook_name(), self.PROFILES_KEEP)
+        except OSError as err:
+            logging.warning("Failed to save the profile of the hook: %s", err)
+
+    def _on_commit(self, _: EventBase) -> None:
+        """Save the timings and the profile of the hook, once it ran."""
+        self._save_hook_profile()
+
+        history = cast(int, self.model.config.get("hook-timings-history"))
+        if history <= 0 or self._hook_name() in self.TIMINGS_SKIP_HOOKS:
+            return
+        try:
+            timing_utils.save_profile(self.TIMINGS_FILE, self._profile, history)
+        except OSError as err:
+            logging.warning("Failed to save the hook timings: %s", err)
 
     def _on_cos_agent_relation_joined(
         self, event: RelationJoinedEvent  # pylint: disable=unused-argument
     ) -> None:
         """Install and start exporter when joining cos-agent relation."""
         self.unit.status = MaintenanceStatus("Installing exporter")
-        metrics_utils.install_exporter(self.model.resources)
+        with timing_utils.span("install exporter"):
+            metrics_utils.install_exporter(self.model.resources)
 
         self._stored.grafana_agent_related = True
         self.unit.status = ActiveStatus(self.get_status_message())
@@ -681,7 +1870,8 @@ class StorageConnectorCharm(CharmBase):
         """Uninstall exporter when departing from cos-agent relation."""
         if self._stored.nrpe_related is False:
             self.unit.status = MaintenanceStatus("Removing exporter")  # type: ignore
-            metrics_utils.uninstall_exporter()
+            with timing_utils.span("uninstall exporter"):
+                metrics_utils.uninstall_exporter()
 
         self._stored.grafana_agent_related = False
         self.unit.status = ActiveStatus(self.get_status_message())
@@ -691,7 +1881,8 @@ class StorageConnectorCharm(CharmBase):
     ) -> None:
         """Relation-created event handler for nrpe-external-master."""
         self.unit.status = MaintenanceStatus("Installing exporter")
-        metrics_utils.install_exporter(self.model.resources)
+        with timing_utils.span("install exporter"):
+            metrics_utils.install_exporter(self.model.resources)
 
         self._stored.nrpe_related = True
         self.unit.status = ActiveStatus(self.get_status_message())
@@ -700,7 +1891,10 @@ class StorageConnectorCharm(CharmBase):
         self, event: RelationChangedEvent  # pylint: disable=unused-argument
     ) -> None:
         """Relation-changed event handler for nrpe-external-master."""
-        nrpe_utils.update_nrpe_config(self.model.config)
+        from storage_connector import nrpe_utils
+
+        with timing_utils.span("update nrpe config"):
+            nrpe_utils.update_nrpe_config(self.model.config)
 
     def _on_nrpe_external_master_relation_broken(
         self, event: RelationBrokenEvent  # pylint: disable=unused-argument
@@ -708,10 +1902,14 @@ class StorageConnectorCharm(CharmBase):
         """Relation-broken event handler for nrpe-external-master."""
         if self._stored.grafana_agent_related is False:
             self.unit.status = MaintenanceStatus("Removing exporter software")  # type: ignore
-            metrics_utils.uninstall_exporter()
+            with timing_utils.span("uninstall exporter"):
+                metrics_utils.uninstall_exporter()
+
+        from storage_connector import nrpe_utils
 
         self.unit.status = MaintenanceStatus("Uninstalling nrpe scripts")
-        nrpe_utils.unsync_nrpe_files()
+        with timing_utils.span("unsync nrpe files"):
+            nrpe_utils.unsync_nrpe_files()
 
         self._stored.nrpe_related = False
         self.unit.status = ActiveStatus(self.get_status_message())
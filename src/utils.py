@@ -1,11 +1,13 @@
 """Utils functions copied from charmhelpers library."""
 
 import os
-import subprocess
 from typing import Optional
 
+from storage_connector import command_utils
+
 SYSTEMD_SYSTEM = "/run/systemd/system"
 UPSTART_CONTAINER_TYPE = "/run/container_type"
+BOOT_ID = "/proc/sys/kernel/random/boot_id"
 
 
 def is_container() -> bool:
@@ -15,7 +17,7 @@ def is_container() -> bool:
     """
     if init_is_systemd():
         # Detect using systemd-detect-virt
-        return subprocess.call(["systemd-detect-virt", "--container"]) == 0
+        return command_utils.call(["systemd-detect-virt", "--container"]) == 0
     # Detect using upstart container file marker
     return os.path.exists(UPSTART_CONTAINER_TYPE)
 
@@ -28,3 +30,15 @@ def init_is_systemd(service_name: Optional[str] = None) -> bool:
     if str(service_name).startswith("snap."):
         return True
     return os.path.isdir(SYSTEMD_SYSTEM)
+
+
+def get_boot_id() -> Optional[str]:
+    """Return the ID of the current boot.
+
+    @return: boot ID as a string or None if it cannot be read
+    """
+    try:
+        with open(BOOT_ID, encoding="utf-8") as file:
+            return file.read().strip()
+    except OSError:
+        return None
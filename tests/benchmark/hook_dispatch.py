@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+"""Benchmark the cold dispatch cost of the charm hooks.
+
+Every sample runs in a fresh interpreter, the same way juju dispatches a hook: the
+charm module is imported, the charm object is created, the event is emitted and the
+state is committed. The ops framework itself is imported before the measurement
+starts, since every ops charm pays for it. External commands are replaced with no-ops
+so that only the python side of the hook is measured and nothing on the host is
+touched.
+
+The samples of a hook share a persistent state and an empty deferred events
+directory, and an untimed warm-up dispatch runs first, so that the steady state of a
+deployed unit is measured, e.g. the deferred restarts check skipped by update-status.
+
+Usage (from the root of the repository):
+
+    python3 tests/benchmark/hook_dispatch.py [--samples N] [hook ...]
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parents[2]
+
+# hook or action name: dispatch path
+HOOKS = {
+    "update-status": "hooks/update-status",
+    "start": "hooks/start",
+    "config-changed": "hooks/config-changed",
+    "show-deferred-restarts": "actions/show-deferred-restarts",
+}
+
+DRIVER = """
+import json, os, resource, sys, time
+from pathlib import Path
+from unittest import mock
+
+import logging
+
+import ops.storage
+import ops.testing
+
+logging.disable(logging.CRITICAL)
+
+state_dir = os.environ["BENCHMARK_STATE_DIR"]
+# the stored state persists across the samples, as the unit state does under juju
+sqlite_storage = ops.storage.SQLiteStorage
+mock.patch(
+    "ops.storage.SQLiteStorage",
+    lambda _: sqlite_storage(os.path.join(state_dir, "state.db")),
+).start()
+
+try:
+    import apt  # noqa
+except ImportError:
+    sys.modules["apt"] = mock.MagicMock()
+
+hook = sys.argv[1]
+for name in ("call", "check_call", "check_output"):
+    mock.patch(f"subprocess.{name}", return_value=b"").start()
+mock.patch("subprocess.getoutput", return_value="").start()
+
+usage = resource.getrusage(resource.RUSAGE_SELF)
+cpu_start = usage.ru_utime + usage.ru_stime
+wall_start = time.perf_counter()
+
+from charm import StorageConnectorCharm
+
+StorageConnectorCharm.DEFERRED_EVENTS_DIR = Path(state_dir, "policy-rc.d")
+StorageConnectorCharm.TIMINGS_FILE = Path(state_dir, "hook-timings.json")
+StorageConnectorCharm.PROFILES_DIR = Path(state_dir, "profiles")
+
+harness = ops.testing.Harness(StorageConnectorCharm)
+harness.begin()
+if os.environ.get("JUJU_ACTION_NAME"):
+    harness.run_action(hook)
+else:
+    getattr(harness.charm.on, hook.replace("-", "_")).emit()
+harness.framework.commit()
+
+usage = resource.getrusage(resource.RUSAGE_SELF)
+print(json.dumps({
+    "cpu": usage.ru_utime + usage.ru_stime - cpu_start,
+    "wall": time.perf_counter() - wall_start,
+}))
+"""
+
+
+def run_sample(hook: str, state_dir: Path) -> dict:
+    """Dispatch the hook in a fresh interpreter and return its timings."""
+    dispatch_path = HOOKS[hook]
+    env = {
+        **os.environ,
+        "PYTHONPATH": f"{ROOT / 'src'}:{ROOT / 'lib'}",
+        "JUJU_DISPATCH_PATH": dispatch_path,
+        "BENCHMARK_STATE_DIR": str(state_dir),
+    }
+    if dispatch_path.startswith("actions/"):
+        env["JUJU_ACTION_NAME"] = hook
+    output = subprocess.check_output(
+        [sys.executable, "-c", DRIVER, hook], cwd=ROOT, env=env, text=True
+    )
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main() -> None:
+    """Run the benchmark and print a summary per hook."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--samples", type=int, default=10, help="samples per hook")
+    parser.add_argument("hooks", nargs="*", help=f"hooks to run (default: {', '.join(HOOKS)})")
+    args = parser.parse_args()
+    unknown = set(args.hooks) - set(HOOKS)
+    if unknown:
+        parser.error(f"unknown hooks: {', '.join(sorted(unknown))}")
+
+    print(f"{'hook':<25} {'cpu median (ms)':>16} {'wall median (ms)':>17}")
+    for hook in args.hooks or HOOKS:
+        with tempfile.TemporaryDirectory() as state_dir:
+            deferred_events_dir = Path(state_dir, "policy-rc.d")
+            deferred_events_dir.mkdir()
+            # a directory modified within the last second is not trusted to be idle
+            an_hour_ago = time.time() - 3600
+            os.utime(deferred_events_dir, (an_hour_ago, an_hour_ago))
+            run_sample(hook, Path(state_dir))  # warm-up
+            samples = [run_sample(hook, Path(state_dir)) for _ in range(args.samples)]
+        cpu = statistics.median(sample["cpu"] for sample in samples) * 1000
+        wall = statistics.median(sample["wall"] for sample in samples) * 1000
+        print(f"{hook:<25} {cpu:>16.1f} {wall:>17.1f}")
+
+
+if __name__ == "__main__":
+    main()
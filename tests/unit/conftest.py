@@ -81,6 +81,41 @@ def harness(mocker, tmp_path):
         return_value=iscsi_conf_path / "initiatorname.iscsi",
     )
 
+    mocker.patch(
+        "charm.StorageConnectorCharm.MULTIPATH_WWIDS_FILE",
+        new_callable=PropertyMock,
+        return_value=multipath_conf_dir / "wwids",
+    )
+    mocker.patch(
+        "charm.StorageConnectorCharm.MULTIPATH_BINDINGS_FILE",
+        new_callable=PropertyMock,
+        return_value=multipath_conf_dir / "bindings",
+    )
+    mocker.patch(
+        "charm.StorageConnectorCharm.UDEV_RULES_FILE",
+        new_callable=PropertyMock,
+        return_value=tmp_path / "60-storage-connector-queue.rules",
+    )
+    mocker.patch(
+        "charm.StorageConnectorCharm.DEFERRED_EVENTS_DIR",
+        new_callable=PropertyMock,
+        return_value=tmp_path / "policy-rc.d",
+    )
+
+    mocker.patch(
+        "charm.StorageConnectorCharm.TIMINGS_FILE",
+        new_callable=PropertyMock,
+        return_value=tmp_path / "hook-timings.json",
+    )
+
+    mocker.patch(
+        "charm.StorageConnectorCharm.PROFILES_DIR",
+        new_callable=PropertyMock,
+        return_value=tmp_path / "profiles",
+    )
+
+    mocker.patch("charm.systemd_utils.wait_until_ready", return_value=[])
+
     ops.testing.SIMULATE_CAN_CONNECT = True
     harness = ops.testing.Harness(StorageConnectorCharm)
     harness.set_leader(is_leader=True)
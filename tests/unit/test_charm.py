@@ -1,15 +1,23 @@
 """Unit tests for the storage-connector charm."""
 
+import base64
+import json
+import os
 import subprocess
 import sys
+from datetime import datetime
+from pathlib import Path
 from textwrap import dedent
 from unittest.mock import call, mock_open
 
 import charmhelpers.contrib.openstack.deferred_events as deferred_events
+import ops.testing
 import pytest
+import yaml
 from jinja2 import Environment, FileSystemLoader
 from ops.framework import EventBase
 from ops.model import ActiveStatus, BlockedStatus, MaintenanceStatus
+from storage_connector import cprofile_utils, iscsi_utils, reconcile_utils
 
 import charm
 
@@ -46,10 +54,7 @@ def test_on_install(harness, mocker, iscsi_config):
     harness.update_config(iscsi_config)
     harness.enable_hooks()
     harness.charm.on.install.emit()
-    mock_check_call.assert_has_calls(
-        [call("systemctl enable iscsid".split()), call("systemctl enable open-iscsi".split())],
-        any_order=False,
-    )
+    mock_check_call.assert_called_once_with("systemctl enable iscsid open-iscsi".split())
     assert harness.charm._stored.installed
     assert harness.charm._stored.storage_type == "iscsi"
     assert harness.charm.unit.status == MaintenanceStatus("Install complete")
@@ -78,6 +83,34 @@ def test_on_config_changes_aborts_if_host_is_container(harness, mocker):
     assert not harness.charm._stored.started
 
 
+def test_check_if_container_is_cached_per_boot(harness, mocker):
+    """Test container detection runs only once per boot."""
+    mock_is_container = mocker.patch("charm.utils.is_container", return_value=False)
+    mock_get_boot_id = mocker.patch("charm.utils.get_boot_id", return_value="boot-1")
+
+    assert not harness.charm._check_if_container()
+    assert not harness.charm._check_if_container()
+    mock_is_container.assert_called_once()
+
+    # a reboot invalidates the cached result
+    mock_get_boot_id.return_value = "boot-2"
+    mock_is_container.return_value = True
+    assert harness.charm._check_if_container()
+    assert mock_is_container.call_count == 2
+    assert harness.charm._stored.boot_id == "boot-2"
+    assert harness.charm.unit.status == BlockedStatus("This charm is not supported on containers.")
+
+
+def test_check_if_container_without_boot_id(harness, mocker):
+    """Test container detection is not cached if the boot ID is unknown."""
+    mock_is_container = mocker.patch("charm.utils.is_container", return_value=False)
+    mocker.patch("charm.utils.get_boot_id", return_value=None)
+
+    harness.charm._check_if_container()
+    harness.charm._check_if_container()
+    assert mock_is_container.call_count == 2
+
+
 @pytest.mark.parametrize(
     "initiator_content, expected_initiator_name, initiatorname_file_provided",
     [
@@ -356,8 +389,8 @@ def test_on_config_changed_iscsi_defers_restart(harness, mocker, iscsi_config):
     mocker.patch("charm.Path.chmod")
 
     mocker.patch("charm.time.time", return_value=1234)
-    mocker.patch("charm.deferred_events.save_event")
-    mock_service_event = mocker.patch("charm.deferred_events.ServiceEvent")
+    mocker.patch("charmhelpers.contrib.openstack.deferred_events.save_event")
+    mock_service_event = mocker.patch("charmhelpers.contrib.openstack.deferred_events.ServiceEvent")
 
     harness.charm._stored.installed = True
     harness.update_config(iscsi_config)
@@ -387,6 +420,332 @@ def test_on_config_changed_iscsi_defers_restart(harness, mocker, iscsi_config):
     )
 
 
+FASTABORT = "node.session.iscsi.FastAbort"
+
+
+@pytest.fixture
+def configured_iscsi(harness, mocker, iscsi_config):
+    """Return a started charm with iscsid.conf rendered from iscsi_config."""
+    mocker.patch("charm.StorageConnectorCharm._iscsi_initiator", return_value=False)
+    tenv = Environment(loader=FileSystemLoader("templates"))
+    harness.disable_hooks()
+    harness.update_config(iscsi_config)
+    harness.charm._iscsid_configuration(tenv)
+    harness.charm._stored.started = True
+    return tenv
+
+
+@pytest.mark.parametrize(
+    "auto_restarts, config, expected_changes, relogin",
+    [
+        (True, {"iscsi-node-session-iscsi-fastabort": "No"}, {FASTABORT: "No"}, True),
+        (False, {"iscsi-node-session-iscsi-fastabort": "No"}, {FASTABORT: "No"}, False),
+        (True, {"iscsi-node-startup": "manual"}, {"node.startup": "manual"}, False),
+    ],
+    ids=["relogin", "relogin-pending", "node-record-only"],
+)
+def test_configure_iscsi_applies_node_settings_live(
+    harness, mocker, configured_iscsi, auto_restarts, config, expected_changes, relogin
+):
+    """Test node settings are applied without restarting the iscsi services."""
+    mock_update = mocker.patch("charm.iscsi_utils.update_node_settings")
+    mock_relogin = mocker.patch("charm.iscsi_utils.rolling_relogin")
+    mock_restart = mocker.patch("charm.StorageConnectorCharm._restart_services")
+    mock_defer = mocker.patch("charm.StorageConnectorCharm._defer_service_restart")
+    mocker.patch("charm.StorageConnectorCharm._get_deferred_restarts", return_value=[])
+
+    harness.update_config({"enable-auto-restarts": auto_restarts, **config})
+    harness.charm._configure_iscsi(configured_iscsi, "config changed")
+
+    mock_update.assert_called_once_with(expected_changes)
+    assert mock_relogin.called is relogin
+    pending = FASTABORT in expected_changes and not auto_restarts
+    assert harness.charm._stored.iscsi_relogin_pending is pending
+    assert harness.charm.get_status_message().endswith("pending relogin") is pending
+    mock_restart.assert_not_called()
+    mock_defer.assert_not_called()
+
+
+def test_configure_iscsi_unchanged_settings(harness, mocker, configured_iscsi):
+    """Test nothing is applied if iscsid.conf did not change."""
+    mock_update = mocker.patch("charm.iscsi_utils.update_node_settings")
+    mock_restart = mocker.patch("charm.StorageConnectorCharm._restart_services")
+    mock_defer = mocker.patch("charm.StorageConnectorCharm._defer_service_restart")
+
+    harness.charm._configure_iscsi(configured_iscsi, "config changed")
+
+    mock_update.assert_not_called()
+    mock_restart.assert_not_called()
+    mock_defer.assert_not_called()
+
+
+def test_configure_iscsi_restarts_for_removed_settings(harness, mocker, iscsi_config):
+    """Test settings removed from iscsid.conf still need a restart."""
+    iscsi_config["iscsi-node-session-auth-authmethod"] = "CHAP"
+    iscsi_config["iscsi-node-session-auth-username"] = "user"
+    mocker.patch("charm.StorageConnectorCharm._iscsi_initiator", return_value=False)
+    mock_update = mocker.patch("charm.iscsi_utils.update_node_settings")
+    mock_defer = mocker.patch("charm.StorageConnectorCharm._defer_service_restart")
+    tenv = Environment(loader=FileSystemLoader("templates"))
+    harness.disable_hooks()
+    harness.update_config(iscsi_config)
+    harness.charm._iscsid_configuration(tenv)
+    harness.charm._stored.started = True
+
+    harness.update_config({"iscsi-node-session-auth-authmethod": "None"})
+    harness.charm._configure_iscsi(tenv, "config changed")
+
+    mock_update.assert_not_called()
+    mock_defer.assert_called_once_with(services=["iscsid", "open-iscsi"], reason="config changed")
+
+
+def test_configure_iscsi_restarts_if_node_update_fails(harness, mocker, configured_iscsi):
+    """Test the services are restarted if the node records cannot be updated."""
+    mocker.patch(
+        "charm.iscsi_utils.update_node_settings",
+        side_effect=subprocess.CalledProcessError(returncode=1, cmd=["iscsiadm"]),
+    )
+    mock_restart = mocker.patch("charm.StorageConnectorCharm._restart_services")
+
+    harness.update_config({"enable-auto-restarts": True, "iscsi-node-session-scan": "manual"})
+    harness.charm._configure_iscsi(configured_iscsi, "config changed")
+
+    mock_restart.assert_called_once_with(services=["iscsid", "open-iscsi"])
+
+
+def test_configure_iscsi_rolling_relogin_mode(harness, mocker, configured_iscsi):
+    """Test the rolling relogin mode relogs sessions without auto restarts."""
+    mocker.patch("charm.iscsi_utils.update_node_settings")
+    mock_relogin = mocker.patch("charm.iscsi_utils.rolling_relogin")
+
+    harness.update_config(
+        {
+            "enable-auto-restarts": False,
+            "iscsi-rolling-relogin": True,
+            "iscsi-node-session-iscsi-fastabort": "No",
+        }
+    )
+    harness.charm._configure_iscsi(configured_iscsi, "config changed")
+
+    mock_relogin.assert_called_once_with(charm.multipath_utils.count_active_paths, 120)
+    assert not harness.charm._stored.iscsi_relogin_pending
+
+
+TARGET = "iqn.2024-01.test:t1"
+OVERRIDES = f'{{"{TARGET}": {{"node.session.queue_depth": 128}}}}'
+
+
+def test_configure_iscsi_applies_target_overrides_live(harness, mocker, configured_iscsi):
+    """Test changed target overrides are applied without restarting the services."""
+    mock_update = mocker.patch("charm.iscsi_utils.update_node_settings")
+    mock_relogin = mocker.patch("charm.StorageConnectorCharm._relogin_iscsi_sessions")
+    mock_restart = mocker.patch("charm.StorageConnectorCharm._restart_services")
+
+    harness.update_config({"enable-auto-restarts": True, "iscsi-target-overrides": OVERRIDES})
+    harness.charm._configure_iscsi(configured_iscsi, "config changed")
+
+    mock_update.assert_has_calls(
+        [call({}), call({"node.session.queue_depth": "128"}, target=TARGET)]
+    )
+    mock_relogin.assert_called_once_with()
+    mock_restart.assert_not_called()
+    assert harness.charm._stored.iscsi_target_overrides == {
+        TARGET: {"node.session.queue_depth": "128"}
+    }
+
+
+def test_iscsi_discovery_applies_target_overrides(harness, mocker, iscsi_config):
+    """Test target overrides are applied to the discovered node records before login."""
+    manager = mocker.Mock()
+    mocker.patch("charm.subprocess.check_call", manager.check_call)
+    mocker.patch("charm.subprocess.check_output", manager.check_output)
+    mocker.patch("charm.iscsi_utils.update_node_settings", manager.update_node_settings)
+    harness.disable_hooks()
+    harness.update_config({**iscsi_config, "iscsi-target-overrides": OVERRIDES})
+
+    harness.charm._iscsi_discovery_and_login()
+
+    assert [name for name, _, _ in manager.mock_calls] == [
+        "check_call",
+        "update_node_settings",
+        "check_output",
+    ]
+
+
+def test_iscsi_discovery_target_overrides_failure(harness, mocker, iscsi_config):
+    """Test the sessions are logged in even if the overrides could not be applied."""
+    mocker.patch("charm.subprocess.check_call")
+    mock_check_output = mocker.patch("charm.subprocess.check_output")
+    mocker.patch(
+        "charm.iscsi_utils.update_node_settings",
+        side_effect=subprocess.CalledProcessError(returncode=1, cmd=["iscsiadm"]),
+    )
+    mock_exception = mocker.patch("charm.logging.exception")
+    harness.disable_hooks()
+    harness.update_config({**iscsi_config, "iscsi-target-overrides": OVERRIDES})
+
+    harness.charm._iscsi_discovery_and_login()
+
+    mock_exception.assert_called_once_with("Failed to apply the iscsi target overrides.")
+    mock_check_output.assert_called_once()
+    assert harness.charm._stored.iscsi_target_overrides == {}
+
+
+def test_on_config_changed_blocks_upon_invalid_target_overrides(harness, mocker, iscsi_config):
+    """Test the charm is blocked by malformed target overrides."""
+    mocker.patch("charm.StorageConnectorCharm._check_if_container", return_value=False)
+    iscsi_config["iscsi-target-overrides"] = '{"10.0.0.1": {"iscsid.startup": "x"}}'
+    harness.update_config(iscsi_config)
+
+    assert harness.charm.unit.status == BlockedStatus(
+        "Invalid iscsi target overrides: iscsid.startup of 10.0.0.1 is not a node setting"
+    )
+
+
+IFACES = {"storage-connector-ens1f0": "ens1f0"}
+
+
+def test_configure_iscsi_ifaces(harness, mocker):
+    """Test the ifaces are only configured when the bindings change."""
+    mocker.patch("charm.iscsi_utils.resolve_iface_bindings", return_value=IFACES)
+    mock_configure_ifaces = mocker.patch("charm.iscsi_utils.configure_ifaces")
+
+    assert harness.charm._configure_iscsi_ifaces()
+    assert not harness.charm._configure_iscsi_ifaces()
+
+    mock_configure_ifaces.assert_called_once_with(IFACES)
+    assert harness.charm._stored.iscsi_ifaces == IFACES
+
+
+def test_configure_iscsi_ifaces_failure(harness, mocker):
+    """Test failed iface changes are retried by the next hook."""
+    mocker.patch("charm.iscsi_utils.resolve_iface_bindings", return_value=IFACES)
+    mocker.patch(
+        "charm.iscsi_utils.configure_ifaces",
+        side_effect=subprocess.CalledProcessError(returncode=1, cmd=["iscsiadm"]),
+    )
+
+    assert not harness.charm._configure_iscsi_ifaces()
+    assert harness.charm._stored.iscsi_ifaces == {}
+
+
+@pytest.mark.parametrize("fastabort", ["Yes", "No"], ids=["unchanged", "live-apply"])
+def test_configure_iscsi_logs_in_new_ifaces(harness, mocker, configured_iscsi, fastabort):
+    """Test sessions of new ifaces are opened without restarting the services."""
+    mocker.patch("charm.StorageConnectorCharm._configure_iscsi_ifaces", return_value=True)
+    mocker.patch("charm.iscsi_utils.update_node_settings")
+    mocker.patch("charm.StorageConnectorCharm._relogin_iscsi_sessions")
+    mock_discovery = mocker.patch("charm.StorageConnectorCharm._iscsi_discovery_and_login")
+    mock_restart = mocker.patch("charm.StorageConnectorCharm._restart_services")
+
+    harness.update_config({"iscsi-node-session-iscsi-fastabort": fastabort})
+    harness.charm._configure_iscsi(configured_iscsi, "config changed")
+
+    mock_discovery.assert_called_once_with()
+    mock_restart.assert_not_called()
+
+
+def test_configure_iscsi_logs_in_new_ifaces_deferred_restart(
+    harness, mocker, configured_iscsi
+):
+    """Test sessions of new ifaces are opened while the restart is deferred."""
+    mocker.patch("charm.StorageConnectorCharm._configure_iscsi_ifaces", return_value=True)
+    mock_defer = mocker.patch("charm.StorageConnectorCharm._defer_service_restart")
+    mock_discovery = mocker.patch("charm.StorageConnectorCharm._iscsi_discovery_and_login")
+
+    harness.update_config({"iscsi-discovery-and-login": True, "enable-auto-restarts": False})
+    # iscsid settings like iscsid.startup need a restart
+    harness.charm.ISCSI_CONF.write_text("")
+    harness.charm._configure_iscsi(configured_iscsi, "config changed")
+
+    mock_defer.assert_called_once()
+    mock_discovery.assert_called_once_with()
+
+
+def test_on_config_changed_blocks_upon_invalid_iface_bindings(harness, mocker, iscsi_config):
+    """Test the charm is blocked by bindings to unknown NICs."""
+    mocker.patch("charm.StorageConnectorCharm._check_if_container", return_value=False)
+    mocker.patch("charm.iscsi_utils.SYS_CLASS_NET", Path("/nonexistent"))
+    iscsi_config["iscsi-iface-bindings"] = "ens9"
+    harness.update_config(iscsi_config)
+
+    assert harness.charm.unit.status == BlockedStatus(
+        "Invalid iscsi iface bindings: no network interface ens9"
+    )
+
+
+@pytest.mark.parametrize(
+    "error",
+    [subprocess.CalledProcessError(returncode=1, cmd=["iscsiadm"]), TimeoutError("paths")],
+)
+def test_relogin_iscsi_sessions_failure(harness, mocker, error):
+    """Test a failed relogin leaves the relogin pending."""
+    mocker.patch("charm.iscsi_utils.rolling_relogin", side_effect=error)
+    harness.charm._stored.idle_deferred_events_state = 1234
+
+    assert not harness.charm._relogin_iscsi_sessions()
+    assert harness.charm._stored.iscsi_relogin_pending
+    # status message changed, so the next status assessment is not skipped
+    assert harness.charm._stored.idle_deferred_events_state is None
+
+
+@pytest.mark.parametrize(
+    "params, expected_timeout", [({}, 120), ({"path-timeout": 30}, 30)], ids=["default", "param"]
+)
+def test_on_rolling_relogin_action(harness, mocker, params, expected_timeout):
+    """Test the rolling relogin action."""
+    mock_relogin = mocker.patch("charm.iscsi_utils.rolling_relogin")
+    mocker.patch("charm.StorageConnectorCharm._check_restart_timestamps")
+    harness.charm._stored.storage_type = "iscsi"
+    harness.charm._stored.iscsi_relogin_pending = True
+
+    action_event = FakeActionEvent(params=params)
+    harness.charm._on_rolling_relogin_action(action_event)
+
+    mock_relogin.assert_called_once_with(
+        charm.multipath_utils.count_active_paths, expected_timeout
+    )
+    assert action_event.results["success"] == "True"
+    assert not harness.charm._stored.iscsi_relogin_pending
+
+
+def test_on_rolling_relogin_action_failed(harness, mocker):
+    """Test the rolling relogin action reports failures."""
+    mocker.patch("charm.iscsi_utils.rolling_relogin", side_effect=TimeoutError("paths"))
+    mocker.patch("charm.StorageConnectorCharm._check_restart_timestamps")
+    harness.charm._stored.storage_type = "iscsi"
+
+    action_event = FakeActionEvent(params={})
+    harness.charm._on_rolling_relogin_action(action_event)
+
+    assert action_event.results["failed"] == "Relogin failed, see the unit logs for details"
+
+
+def test_on_rolling_relogin_action_fc(harness):
+    """Test the rolling relogin action is not supported for fibre channel."""
+    harness.charm._stored.storage_type = "fc"
+
+    action_event = FakeActionEvent(params={})
+    harness.charm._on_rolling_relogin_action(action_event)
+
+    assert action_event.results["failed"] == (
+        "Rolling relogin is only supported for iscsi storage"
+    )
+
+
+def test_restart_iscsi_services_clears_pending_relogin(harness, mocker):
+    """Test restarting the iscsi services clears the pending relogin."""
+    mocker.patch("charm.subprocess.check_call")
+    harness.update_config({"iscsi-discovery-and-login": False})
+    harness.charm._stored.iscsi_relogin_pending = True
+
+    harness.charm._restart_services(services=["multipathd"])
+    assert harness.charm._stored.iscsi_relogin_pending
+
+    harness.charm._restart_services(services=["iscsid"])
+    assert not harness.charm._stored.iscsi_relogin_pending
+
+
 def test_on_config_changed_blocks_upon_invalid_multipath_config(harness, mocker, iscsi_config):
     """Test config changed handler blocks the charm in case of invalid mp config."""
     mocker.patch("charm.utils.is_container", return_value=False)
@@ -404,6 +763,149 @@ def test_on_config_changed_blocks_upon_invalid_multipath_config(harness, mocker,
     assert harness.charm.unit.status == BlockedStatus(
         "Multipath conf error: ['invalid keyword: user_friendly_name']"
     )
+    assert not harness.charm.mp_path.exists()
+
+
+def test_on_config_changed_restores_multipath_config_upon_invalid_config(
+    harness, mocker, iscsi_config
+):
+    """Test a multipath config rejected by multipath is replaced by the previous one."""
+    mocker.patch("charm.utils.is_container", return_value=False)
+    mocker.patch("charm.socket.getfqdn", return_value="testhost.testdomain")
+    mocker.patch("charm.subprocess.check_call")
+    mocker.patch("charm.subprocess.check_output")
+    mocker.patch("charm.StorageConnectorCharm._configure_deferred_restarts")
+    mock_reload = mocker.patch("charm.systemd_utils.reload")
+    mocker.patch(
+        "charm.subprocess.getoutput",
+        return_value="multipath.conf line 18, invalid keyword: bogus",
+    )
+    harness.disable_hooks()
+    harness.update_config(iscsi_config)
+    harness.enable_hooks()
+    harness.charm.mp_path.parent.mkdir(parents=True)
+    harness.charm.mp_path.write_text("defaults {\n}\n")
+    harness.charm._stored.installed = True
+    harness.charm.on.config_changed.emit()
+
+    assert harness.charm.unit.status == BlockedStatus(
+        "Multipath conf error: ['invalid keyword: bogus']"
+    )
+    assert harness.charm.mp_path.read_text() == "defaults {\n}\n"
+    mock_reload.assert_not_called()
+
+
+def test_on_config_changed_managed_wwids(harness, mocker, iscsi_config):
+    """Test the wwids allow-list and the bindings are written from the managed WWIDs."""
+    mocker.patch("charm.utils.is_container", return_value=False)
+    mocker.patch("charm.socket.getfqdn", return_value="testhost.testdomain")
+    mocker.patch("charm.subprocess.check_call")
+    mocker.patch("charm.subprocess.check_output")
+    mocker.patch("charm.subprocess.getoutput", return_value="")
+    mocker.patch("charm.StorageConnectorCharm._configure_deferred_restarts")
+    iscsi_config["multipath-wwids"] = '{"3600c": "data2", "3600a": "data1", "3600b": null}'
+    harness.disable_hooks()
+    harness.update_config(iscsi_config)
+    harness.enable_hooks()
+    harness.charm.MULTIPATH_BINDINGS_FILE.write_text(
+        "mpatha 3600b\nmpathb 3600d\ndata2 3600e\n"
+    )
+    harness.charm._stored.installed = True
+    harness.charm.on.config_changed.emit()
+
+    assert isinstance(harness.charm.unit.status, ActiveStatus)
+    assert harness.charm.MULTIPATH_WWIDS_FILE.read_text().endswith(
+        "# Valid WWIDs:\n/3600a/\n/3600b/\n/3600c/\n"
+    )
+    assert harness.charm.MULTIPATH_BINDINGS_FILE.read_text().endswith(
+        "#\ndata1 3600a\ndata2 3600c\nmpatha 3600b\n"
+    )
+    multipath_conf = harness.charm.mp_path.read_text()
+    assert 'find_multipaths "strict"' in multipath_conf
+    assert 'user_friendly_names "yes"' in multipath_conf
+
+
+def test_on_config_changed_blocks_upon_invalid_managed_wwids(harness, mocker, iscsi_config):
+    """Test invalid managed WWIDs block the charm before anything is written."""
+    mocker.patch("charm.utils.is_container", return_value=False)
+    mocker.patch("charm.socket.getfqdn", return_value="testhost.testdomain")
+    mocker.patch("charm.subprocess.check_call")
+    mocker.patch("charm.subprocess.check_output")
+    mocker.patch("charm.subprocess.getoutput", return_value="")
+    mocker.patch("charm.StorageConnectorCharm._configure_deferred_restarts")
+    iscsi_config["multipath-wwids"] = '{"3600a": "data1", "3600b": "data1"}'
+    harness.disable_hooks()
+    harness.update_config(iscsi_config)
+    harness.enable_hooks()
+    harness.charm._stored.installed = True
+    harness.charm.on.config_changed.emit()
+
+    assert harness.charm.unit.status == BlockedStatus(
+        "Invalid multipath-wwids: alias data1 is used more than once"
+    )
+    assert not harness.charm.MULTIPATH_WWIDS_FILE.exists()
+
+
+def test_on_config_changed_only_applies_changed_resources(harness, mocker, iscsi_config):
+    """Test a config change only applies the resources depending on the changed options."""
+    mocker.patch("charm.utils.is_container", return_value=False)
+    mocker.patch("charm.socket.getfqdn", return_value="testhost.testdomain")
+    mocker.patch("charm.subprocess.check_call")
+    mocker.patch("charm.subprocess.check_output")
+    mocker.patch("charm.subprocess.getoutput", return_value="")
+    mocker.patch("charm.StorageConnectorCharm._configure_deferred_restarts")
+    mock_configure_iscsi = mocker.patch(
+        "charm.StorageConnectorCharm._configure_iscsi",
+        side_effect=lambda *_: harness.charm.ISCSI_CONF.touch()
+        or harness.charm.ISCSI_INITIATOR_NAME.touch(),
+    )
+    mock_multipath = mocker.patch(
+        "charm.StorageConnectorCharm._multipath_configuration",
+        side_effect=lambda _: harness.charm.mp_path.touch() or {},
+    )
+    mocker.patch("charm.StorageConnectorCharm._apply_multipath_config")
+    mock_irq_affinity = mocker.patch("charm.StorageConnectorCharm._configure_irq_affinity")
+    harness.charm._stored.installed = True
+    harness.update_config(iscsi_config)
+    assert mock_configure_iscsi.call_count == mock_multipath.call_count == 1
+    assert isinstance(harness.charm.unit.status, ActiveStatus)
+
+    harness.update_config({"irq-affinity": True})
+    assert mock_configure_iscsi.call_count == mock_multipath.call_count == 1
+    assert mock_irq_affinity.call_count == 2
+
+    # the live state drifted
+    harness.charm.mp_path.unlink()
+    harness.charm.on.config_changed.emit()
+    assert mock_multipath.call_count == 2
+    assert mock_configure_iscsi.call_count == 1
+
+    harness.charm.on.upgrade_charm.emit()
+    harness.charm.on.config_changed.emit()
+    assert mock_configure_iscsi.call_count == 2
+    assert mock_multipath.call_count == 3
+
+
+def test_on_config_changed_blocks_upon_unknown_multipath_keyword(harness, mocker, iscsi_config):
+    """Test unknown multipath keywords block the charm before the config is written."""
+    mocker.patch("charm.utils.is_container", return_value=False)
+    mocker.patch("charm.socket.getfqdn", return_value="testhost.testdomain")
+    mocker.patch("charm.subprocess.check_call")
+    mocker.patch("charm.subprocess.check_output")
+    mocker.patch("charm.StorageConnectorCharm._configure_deferred_restarts")
+    mock_getoutput = mocker.patch("charm.subprocess.getoutput", return_value="")
+    iscsi_config["multipath-defaults"] = '{"user_friendly_name": "yes"}'
+    harness.disable_hooks()
+    harness.update_config(iscsi_config)
+    harness.enable_hooks()
+    harness.charm._stored.installed = True
+    harness.charm.on.config_changed.emit()
+
+    assert harness.charm.unit.status == BlockedStatus(
+        "Invalid multipath-defaults: invalid keyword user_friendly_name in defaults"
+    )
+    assert not harness.charm.mp_path.exists()
+    assert call("multipath -ll") not in mock_getoutput.call_args_list
 
 
 def test_on_config_changed_exception_logged_upon_iscsi_login_failure(
@@ -441,6 +943,45 @@ def test_on_config_changed_random_iqn(harness, mocker, iscsi_config):
     assert call("/sbin/iscsi-iname") in mock_getoutput.mock_calls
 
 
+def test_on_config_changed_iscsid_tuning(harness, mocker, iscsi_config):
+    """Test the performance settings are rendered in iscsid.conf."""
+    harness.disable_hooks()
+    harness.update_config(
+        {
+            **iscsi_config,
+            "iscsi-tuning-preset": "pure",
+            "iscsi-node-session-nr-sessions": 4,
+            "iscsi-node-conn-iscsi-max-recv-data-segment-length": 131072,
+        }
+    )
+    tenv = Environment(loader=FileSystemLoader("templates"))
+
+    content = harness.charm._iscsid_configuration(tenv)
+
+    settings = iscsi_utils.parse_iscsid_conf(content)
+    assert settings["node.session.cmds_max"] == "1024"
+    assert settings["node.session.queue_depth"] == "128"
+    assert settings["node.session.timeo.replacement_timeout"] == "20"
+    assert settings["node.session.nr_sessions"] == "4"
+    assert settings["node.conn[0].iscsi.MaxRecvDataSegmentLength"] == "131072"
+    assert settings["discovery.sendtargets.iscsi.MaxRecvDataSegmentLength"] == "32768"
+
+
+def test_on_config_changed_blocks_upon_invalid_iscsid_tuning(harness, mocker, iscsi_config):
+    """Test the charm is blocked by invalid performance settings."""
+    mocker.patch("charm.StorageConnectorCharm._check_if_container", return_value=False)
+    mock_iscsid_configuration = mocker.patch(
+        "charm.StorageConnectorCharm._iscsid_configuration"
+    )
+    iscsi_config["iscsi-node-session-cmds-max"] = 100
+    harness.update_config(iscsi_config)
+
+    assert harness.charm.unit.status == BlockedStatus(
+        "Invalid iscsid tuning: iscsi-node-session-cmds-max must be a power of 2"
+    )
+    mock_iscsid_configuration.assert_not_called()
+
+
 def test_on_config_changed_blocks_upon_missing_config(harness, mocker, iscsi_config):
     """Test if config changed handler blocks the charm upon missing mandatory config."""
     mocker.patch("charm.utils.is_container", return_value=False)
@@ -491,6 +1032,85 @@ def test_on_config_changed_logs_exception_upon_reload_multipathd_service_fails(
     )
 
 
+def test_apply_multipath_config(harness, mocker):
+    """Test multipathd is only reloaded when the defaults, devices or blacklists change."""
+    mock_reload = mocker.patch("charm.systemd_utils.reload")
+    mock_apply = mocker.patch("charm.multipath_utils.apply_map_changes", return_value=["3600a"])
+    ctxt = {
+        "defaults": {"user_friendly_names": "yes"},
+        "multipaths": {"wwid": "3600a", "alias": "data1"},
+    }
+
+    harness.charm._apply_multipath_config(ctxt)
+    mock_reload.assert_called_once_with(["multipathd"])
+    assert harness.charm._stored.multipath_sections["multipaths"] == (
+        '{"alias": "data1", "wwid": "3600a"}'
+    )
+
+    mock_reload.reset_mock()
+    harness.charm._apply_multipath_config(ctxt)
+    mock_reload.assert_not_called()
+    mock_apply.assert_not_called()
+
+    harness.charm._apply_multipath_config({**ctxt, "multipaths": {"wwid": "3600a", "alias": "data2"}})
+    mock_reload.assert_not_called()
+    mock_apply.assert_called_once_with({"3600a": "data1"}, {"3600a": "data2"})
+
+    harness.charm._apply_multipath_config(
+        {**ctxt, "multipaths": {"wwid": "3600a", "alias": "data2"}, "wwids": {"3600b": None}}
+    )
+    mock_reload.assert_not_called()
+    mock_apply.assert_called_with({"3600a": "data2"}, {"3600a": "data2", "3600b": None})
+
+    harness.charm._apply_multipath_config({**ctxt, "defaults": {"find_multipaths": "yes"}})
+    mock_reload.assert_called_once_with(["multipathd"])
+    assert mock_apply.call_count == 2
+
+
+def test_apply_multipath_config_falls_back_to_reload(harness, mocker):
+    """Test multipathd is reloaded if a map update fails, and retried if the reload fails."""
+    mock_reload = mocker.patch(
+        "charm.systemd_utils.reload",
+        side_effect=[subprocess.CalledProcessError(1, ["systemctl"]), None],
+    )
+    mocker.patch(
+        "charm.multipath_utils.apply_map_changes",
+        side_effect=subprocess.CalledProcessError(1, ["multipath"]),
+    )
+    harness.charm._stored.multipath_sections = {
+        "defaults": "null",
+        "devices": "null",
+        "blacklist": "null",
+        "blacklist_exceptions": "null",
+        "multipaths": "null",
+    }
+    ctxt = {"multipaths": {"wwid": "3600a", "alias": "data1"}}
+
+    harness.charm._apply_multipath_config(ctxt)
+    assert harness.charm._stored.multipath_sections["multipaths"] == "null"
+
+    harness.charm._apply_multipath_config(ctxt)
+    assert mock_reload.call_count == 2
+    assert harness.charm._stored.multipath_sections["multipaths"] != "null"
+
+
+def test_apply_multipath_config_removes_stale_benchmark_conf(harness, mocker):
+    """Test a benchmark configuration left behind is removed and multipathd reloaded."""
+    mock_reload = mocker.patch("charm.systemd_utils.reload")
+    mock_apply = mocker.patch("charm.multipath_utils.apply_map_changes")
+    ctxt = {"multipaths": {"wwid": "3600a", "alias": "data1"}}
+    harness.charm._apply_multipath_config(ctxt)
+    mock_reload.reset_mock()
+    harness.charm.MULTIPATH_CONF_PATH.mkdir(exist_ok=True)
+    harness.charm.benchmark_conf.write_text("multipaths {}")
+
+    harness.charm._apply_multipath_config(ctxt)
+
+    assert not harness.charm.benchmark_conf.exists()
+    mock_reload.assert_called_once_with(["multipathd"])
+    mock_apply.assert_not_called()
+
+
 def test_on_config_changed_logs_exception_upon_service_restart_fails(
     harness, mocker, iscsi_config
 ):
@@ -663,16 +1283,122 @@ def test_on_config_change_blocks_upon_bad_multipath_config(
     )
 
 
-def test_on_install_blocks_for_invalid_storage_types(harness, mocker):
-    """Test installation gets blocked for invalid storage types."""
-    mocker.patch("charm.utils.is_container", return_value=False)
-    harness.update_config({"storage-type": "foo"})
-    harness.charm.on.install.emit()
-    assert not harness.charm._stored.installed
-
-
-def test_on_install_logs_exception_upon_service_enable_fails(harness, mocker, iscsi_config):
-    """Test exception is logged during install if service enable fails."""
+def test_on_config_changed_fc_multipath_lists(harness, mocker, fc_config, multipath_topology):
+    """Test lists of multipath devices, blacklist and exceptions are rendered."""
+    mocker.patch("charm.utils.is_container", return_value=False)
+    mocker.patch("charm.open", new_callable=mock_open)
+    mocker.patch("charm.StorageConnectorCharm._configure_deferred_restarts")
+    mock_write_text = mocker.patch("charm.Path.write_text")
+    mocker.patch("charm.Path.chmod")
+    mocker.patch(
+        "charm.subprocess.getoutput",
+        side_effect=["host0", multipath_topology, multipath_topology],
+    )
+    mocker.patch("charm.subprocess.check_call")
+    fc_config["multipath-devices"] = (
+        '[{"vendor": "PURE", "product": "FlashArray"}, {"vendor": "NETAPP", "product": "LUN"}]'
+    )
+    fc_config["multipath-blacklist"] = '[{"wwid": ".*"}, {"vendor": "QEMU"}]'
+    fc_config["multipath-blacklist-exceptions"] = '{"wwid": "3624a9370.*"}'
+    fc_config["multipath-wwids"] = '["3600b"]'
+    harness.charm._stored.installed = True
+    harness.update_config(fc_config)
+
+    assert isinstance(harness.charm.unit.status, ActiveStatus)
+    multipath_conf = mock_write_text.call_args[0][0]
+    assert (
+        "blacklist {\n"
+        '     wwid ".*"\n'
+        "    device {\n"
+        '         vendor "QEMU"\n'
+    ) in multipath_conf
+    assert 'blacklist_exceptions {\n     wwid "3624a9370.*"\n' in multipath_conf
+    assert multipath_conf.count("    device {\n") == 3
+    assert '         vendor "NETAPP"\n         product "LUN"\n' in multipath_conf
+    assert harness.charm.MULTIPATH_BINDINGS_FILE.read_text().endswith(
+        "#\ndata1 360014380056efd060000d00000510000\n"
+    )
+
+
+def test_on_config_changed_fc_array_preset(harness, mocker, fc_config, multipath_topology):
+    """Test the array preset is rendered with the overrides of multipath-devices."""
+    mocker.patch("charm.utils.is_container", return_value=False)
+    mocker.patch("charm.open", new_callable=mock_open)
+    mocker.patch("charm.StorageConnectorCharm._configure_deferred_restarts")
+    mock_write_text = mocker.patch("charm.Path.write_text")
+    mocker.patch("charm.Path.chmod")
+    mocker.patch(
+        "charm.subprocess.getoutput",
+        side_effect=["host0", *[multipath_topology] * 4],
+    )
+    mocker.patch("charm.subprocess.check_call")
+    del fc_config["multipath-devices"]
+    fc_config["array-preset"] = "hpe-3par"
+    harness.charm._stored.installed = True
+    harness.update_config(fc_config)
+    assert isinstance(harness.charm.unit.status, ActiveStatus)
+    assert '         dev_loss_tmo "infinity"\n' in mock_write_text.call_args[0][0]
+
+    harness.update_config(
+        {"multipath-devices": '{"vendor": "3PARdata", "product": "VV", "dev_loss_tmo": "60"}'}
+    )
+    multipath_conf = mock_write_text.call_args[0][0]
+    assert '         dev_loss_tmo "60"\n' in multipath_conf
+    assert '         no_path_retry "18"\n' in multipath_conf
+    assert multipath_conf.count("    device {\n") == 2  # the preset and the blacklist
+
+
+def test_on_config_changed_fc_blocks_upon_unknown_array_preset(
+    harness, mocker, fc_config, multipath_topology
+):
+    """Test config changed handler blocks the charm if the array preset is unknown."""
+    mocker.patch("charm.utils.is_container", return_value=False)
+    mocker.patch("charm.open", new_callable=mock_open)
+    mocker.patch("charm.StorageConnectorCharm._configure_deferred_restarts")
+    mocker.patch(
+        "charm.subprocess.getoutput",
+        side_effect=["host0", multipath_topology, multipath_topology],
+    )
+    fc_config["array-preset"] = "acme"
+    harness.charm._stored.installed = True
+    harness.update_config(fc_config)
+
+    assert harness.charm.unit.status.message.startswith(
+        "Invalid array-preset: unknown preset acme, valid presets are pure,"
+    )
+
+
+def test_on_config_changed_fc_blocks_upon_invalid_multipath_devices(
+    harness, mocker, fc_config, multipath_topology
+):
+    """Test config changed handler blocks the charm if a device has no product."""
+    mocker.patch("charm.utils.is_container", return_value=False)
+    mocker.patch("charm.open", new_callable=mock_open)
+    mocker.patch("charm.StorageConnectorCharm._configure_deferred_restarts")
+    mocker.patch(
+        "charm.subprocess.getoutput",
+        side_effect=["host0", multipath_topology, multipath_topology],
+    )
+    fc_config["multipath-devices"] = '[{"vendor": "PURE"}]'
+    harness.charm._stored.installed = True
+    harness.update_config(fc_config)
+
+    assert not harness.charm._stored.configured
+    assert harness.charm.unit.status == BlockedStatus(
+        "Invalid multipath-devices: devices entries need a vendor and a product"
+    )
+
+
+def test_on_install_blocks_for_invalid_storage_types(harness, mocker):
+    """Test installation gets blocked for invalid storage types."""
+    mocker.patch("charm.utils.is_container", return_value=False)
+    harness.update_config({"storage-type": "foo"})
+    harness.charm.on.install.emit()
+    assert not harness.charm._stored.installed
+
+
+def test_on_install_logs_exception_upon_service_enable_fails(harness, mocker, iscsi_config):
+    """Test exception is logged during install if service enable fails."""
     mocker.patch("charm.utils.is_container", return_value=False)
     mock_log_exception = mocker.patch("charm.logging.exception")
     mocker.patch(
@@ -683,17 +1409,14 @@ def test_on_install_logs_exception_upon_service_enable_fails(harness, mocker, is
     harness.update_config(iscsi_config)
     harness.enable_hooks()
     harness.charm.on.install.emit()
-    mock_log_exception.assert_has_calls(
-        [
-            call("Failed to enable %s.", "iscsid"),
-            call("Failed to enable %s.", "open-iscsi"),
-        ],
-        any_order=False,
-    )
+    mock_log_exception.assert_called_once_with("Failed to enable %s.", "iscsid, open-iscsi")
 
 
-def test_on_start(harness):
+def test_on_start(harness, mocker):
     """Test on start hook."""
+    mock_configure_irq_affinity = mocker.patch(
+        "charm.StorageConnectorCharm._configure_irq_affinity"
+    )
     assert not harness.charm._stored.started
     harness.charm.on.start.emit()
     # event deferred as charm not configured yet
@@ -702,6 +1425,7 @@ def test_on_start(harness):
     harness.charm._stored.configured = True
     harness.charm.on.start.emit()
     assert harness.charm._stored.started
+    mock_configure_irq_affinity.assert_called_once_with()
 
 
 def test_retrieve_multipath_wwid(harness, mocker, multipath_topology):
@@ -716,8 +1440,8 @@ def test_retrieve_multipath_wwid(harness, mocker, multipath_topology):
 
 def test_defer_service_restart(harness, mocker):
     mocker.patch("charm.time.time", return_value=1234)
-    mock_service_event = mocker.patch("charm.deferred_events.ServiceEvent")
-    mock_save_event = mocker.patch("charm.deferred_events.save_event")
+    mock_service_event = mocker.patch("charmhelpers.contrib.openstack.deferred_events.ServiceEvent")
+    mock_save_event = mocker.patch("charmhelpers.contrib.openstack.deferred_events.save_event")
     harness.charm._defer_service_restart(services=["testservice"], reason="testreason")
     mock_save_event.assert_called_once_with(mock_service_event.return_value)
     mock_service_event.assert_called_once_with(
@@ -725,6 +1449,49 @@ def test_defer_service_restart(harness, mocker):
     )
 
 
+def test_defer_service_restart_skips_duplicates(harness, mocker):
+    mocker.patch("charm.time.time", return_value=1234)
+    mocker.patch(
+        "charmhelpers.contrib.openstack.deferred_events.get_deferred_restarts",
+        return_value=[
+            deferred_events.ServiceEvent(
+                timestamp=1000,
+                service="iscsid",
+                reason="Charm event: testreason",
+                action="restart",
+                policy_requestor_name="storage-connector",
+                policy_requestor_type="charm",
+            )
+        ],
+    )
+    mock_save_event = mocker.patch("charmhelpers.contrib.openstack.deferred_events.save_event")
+    mocker.patch("charmhelpers.contrib.openstack.deferred_events.hookenv.service_name")
+
+    harness.charm._defer_service_restart(services=["iscsid", "open-iscsi"], reason="testreason")
+
+    mock_save_event.assert_called_once()
+    assert mock_save_event.call_args[0][0].service == "open-iscsi"
+
+
+def test_get_deferred_restarts_is_cached(harness, mocker):
+    """Test deferred events are parsed once until they are saved or cleared."""
+    mock_get_deferred_restarts = mocker.patch(
+        "charmhelpers.contrib.openstack.deferred_events.get_deferred_restarts", return_value=[]
+    )
+    mock_clear = mocker.patch(
+        "charmhelpers.contrib.openstack.deferred_events.clear_deferred_restarts"
+    )
+
+    harness.charm._get_deferred_restarts()
+    harness.charm.get_status_message()
+    mock_get_deferred_restarts.assert_called_once()
+
+    harness.charm._clear_deferred_restarts(["iscsid"])
+    harness.charm._get_deferred_restarts()
+    mock_clear.assert_called_once_with(["iscsid"])
+    assert mock_get_deferred_restarts.call_count == 2
+
+
 def test_on_restart_services_action_mutually_exclusive_params(harness):
     """Test on restart servcices action with both deferred-only and services."""
     action_event = FakeActionEvent(params={"deferred-only": True, "services": "test_service"})
@@ -742,7 +1509,7 @@ def test_on_restart_services_action_no_params(harness):
 def test_on_restart_services_action_deferred_only_failed(harness, mocker):
     """Test on restart servcices action empty list of deferred restarts."""
     mocker.patch("charm.subprocess.check_call")
-    mocker.patch("charm.deferred_events.get_deferred_restarts", return_value=[])
+    mocker.patch("charmhelpers.contrib.openstack.deferred_events.get_deferred_restarts", return_value=[])
     action_event = FakeActionEvent(params={"deferred-only": True, "services": ""})
     harness.charm._on_restart_services_action(action_event)
     assert action_event.results["failed"] == "No deferred services to restart"
@@ -751,9 +1518,9 @@ def test_on_restart_services_action_deferred_only_failed(harness, mocker):
 def test_on_restart_services_action_deferred_only_success(harness, mocker):
     """Test on restart servcices action with deferred only param."""
     mock_check_call = mocker.patch("charm.subprocess.check_call")
-    mocker.patch("charm.deferred_events.check_restart_timestamps")
+    mocker.patch("charm.StorageConnectorCharm._check_restart_timestamps")
     mocker.patch(
-        "charm.deferred_events.get_deferred_restarts",
+        "charmhelpers.contrib.openstack.deferred_events.get_deferred_restarts",
         return_value=[
             deferred_events.ServiceEvent(
                 timestamp=123456,
@@ -792,11 +1559,10 @@ def test_on_restart_services_action_services_success(harness, mocker):
     harness.charm._on_restart_services_action(action_event)
     mock_check_call.assert_has_calls(
         [
-            call(["systemctl", "restart", "iscsid"]),
+            call(["systemctl", "restart", "iscsid", "multipathd"]),
             call(["systemctl", "restart", "open-iscsi"]),
-            call(["systemctl", "restart", "multipathd"]),
         ],
-        any_order=True,
+        any_order=False,
     )
     assert action_event.results["success"] == "True"
     mock_iscsi_discovery_and_login.assert_called_once()
@@ -805,7 +1571,7 @@ def test_on_restart_services_action_services_success(harness, mocker):
 def test_on_show_deferred_restarts_action(harness, mocker):
     """Test on show deferred restarts action."""
     mocker.patch(
-        "charm.deferred_events.get_deferred_restarts",
+        "charmhelpers.contrib.openstack.deferred_events.get_deferred_restarts",
         return_value=[
             deferred_events.ServiceEvent(
                 timestamp=123456,
@@ -854,13 +1620,1009 @@ def test_on_iscsi_discovery_and_login_action(harness, mocker):
     assert action_event.results["success"] == "True"
 
 
+def test_iscsi_discovery_and_login_with_ifaces(harness, mocker):
+    """Test targets are discovered through every managed iface."""
+    mock_check_call = mocker.patch("charm.subprocess.check_call")
+    mocker.patch("charm.subprocess.check_output")
+    harness.update_config({"iscsi-target": "abc", "iscsi-port": "443"})
+    harness.charm._stored.iscsi_ifaces = {
+        "storage-connector-ens1f1": "ens1f1",
+        "storage-connector-ens1f0": "ens1f0",
+    }
+
+    harness.charm._iscsi_discovery_and_login()
+
+    mock_check_call.assert_called_once_with(
+        ["iscsiadm", "-m", "discovery", "-t", "sendtargets", "-p", "abc:443"]
+        + ["-I", "storage-connector-ens1f0", "-I", "storage-connector-ens1f1"]
+    )
+
+
+QUEUE_SETTINGS = '[{"vendor": "PURE", "scheduler": "none"}]'
+
+
+def test_configure_block_queues(harness, mocker):
+    """Test the udev rules are rendered and applied only when they change."""
+    mock_apply = mocker.patch("charm.block_utils.apply_queue_rules")
+    tenv = Environment(loader=FileSystemLoader("templates"))
+    harness.disable_hooks()
+    harness.update_config({"block-queue-settings": QUEUE_SETTINGS})
+
+    harness.charm._configure_block_queues(tenv)
+    harness.charm._configure_block_queues(tenv)
+
+    assert harness.charm.UDEV_RULES_FILE.read_text().splitlines()[-1] == (
+        'ACTION=="add|change", SUBSYSTEM=="block", KERNEL=="sd*[!0-9]", '
+        'ATTRS{vendor}=="PURE*", ATTR{queue/scheduler}="none"'
+    )
+    mock_apply.assert_called_once_with(
+        [charm.block_utils.QueueRule("PURE", None, None, {"scheduler": "none"})]
+    )
+
+    harness.update_config({"block-queue-settings": "[]"})
+    harness.charm._configure_block_queues(tenv)
+    harness.charm._configure_block_queues(tenv)
+
+    assert not harness.charm.UDEV_RULES_FILE.exists()
+    mock_apply.assert_called_with([])
+    assert mock_apply.call_count == 2
+
+
+def test_configure_block_queues_apply_failure(harness, mocker):
+    """Test a failure to apply the udev rules is logged."""
+    mocker.patch(
+        "charm.block_utils.apply_queue_rules",
+        side_effect=subprocess.CalledProcessError(returncode=1, cmd=["udevadm"]),
+    )
+    mock_exception = mocker.patch("charm.logging.exception")
+    harness.disable_hooks()
+    harness.update_config({"block-queue-settings": QUEUE_SETTINGS})
+
+    tenv = Environment(loader=FileSystemLoader("templates"))
+    assert harness.charm._configure_block_queues(tenv) is False
+
+    mock_exception.assert_called_once_with("Failed to apply the block queue settings.")
+    # the rules are seen as changed on the next attempt
+    assert not harness.charm.UDEV_RULES_FILE.exists()
+
+
+def test_on_config_changed_retries_failed_resources(harness, mocker, iscsi_config):
+    """Test a resource which failed to apply is applied again on the next config change."""
+    mocker.patch("charm.utils.is_container", return_value=False)
+    mocker.patch("charm.StorageConnectorCharm._configure_deferred_restarts")
+    mocker.patch(
+        "charm.StorageConnectorCharm._configure_iscsi",
+        side_effect=lambda *_: harness.charm.ISCSI_CONF.touch()
+        or harness.charm.ISCSI_INITIATOR_NAME.touch(),
+    )
+    mocker.patch(
+        "charm.StorageConnectorCharm._multipath_configuration",
+        side_effect=lambda _: harness.charm.mp_path.touch() or {},
+    )
+    mocker.patch("charm.StorageConnectorCharm._apply_multipath_config")
+    mock_apply = mocker.patch(
+        "charm.block_utils.apply_queue_rules",
+        side_effect=[subprocess.CalledProcessError(returncode=1, cmd=["udevadm"]), None],
+    )
+    harness.charm._stored.installed = True
+    iscsi_config["block-queue-settings"] = QUEUE_SETTINGS
+    harness.update_config(iscsi_config)
+    assert "block-queues" not in harness.charm._stored.reconciled
+
+    harness.charm.on.config_changed.emit()
+
+    assert mock_apply.call_count == 2
+    assert "block-queues" in harness.charm._stored.reconciled
+    assert harness.charm.UDEV_RULES_FILE.exists()
+
+
+def test_on_config_changed_blocks_upon_invalid_block_queue_settings(
+    harness, mocker, iscsi_config
+):
+    """Test the charm is blocked by invalid queue settings."""
+    mocker.patch("charm.StorageConnectorCharm._check_if_container", return_value=False)
+    iscsi_config["block-queue-settings"] = '[{"vendor": "PURE", "rq_affinity": 3}]'
+    harness.update_config(iscsi_config)
+
+    assert harness.charm.unit.status == BlockedStatus(
+        "Invalid block queue settings: rq_affinity must be between 0 and 2"
+    )
+
+
+def test_on_show_queue_settings_action(harness, mocker):
+    """Test the queue settings in effect are reported."""
+    mocker.patch(
+        "charm.block_utils.get_queue_settings",
+        return_value={"sda": {"vendor": "PURE", "scheduler": "none"}},
+    )
+    action_event = FakeActionEvent()
+
+    harness.charm._on_show_queue_settings_action(action_event)
+
+    assert action_event.results["queue-settings"] == "sda:\n  scheduler: none\n  vendor: PURE\n"
+
+
+HBA = Path("/sys/devices/pci0000:3a/0000:3b:00.0")
+
+
+@pytest.mark.parametrize(
+    "storage_type, ifaces, route_nic, expected_nics",
+    [
+        ("iscsi", {"storage-connector-ens1f1": "ens1f1"}, None, ["ens1f1"]),
+        ("iscsi", {}, "ens1f0", ["ens1f0"]),
+        ("iscsi", {}, None, []),
+    ],
+    ids=["ifaces", "route", "no-route"],
+)
+def test_storage_devices_iscsi(harness, mocker, storage_type, ifaces, route_nic, expected_nics):
+    """Test the NICs of the iscsi sessions are used."""
+    mocker.patch("charm.iscsi_utils.get_route_interface", return_value=route_nic)
+    mock_get_nic_devices = mocker.patch(
+        "charm.irq_utils.get_nic_devices", return_value={HBA.name: HBA}
+    )
+    harness.charm._stored.storage_type = storage_type
+    harness.charm._stored.iscsi_ifaces = ifaces
+
+    assert harness.charm._storage_devices() == {HBA.name: HBA}
+    mock_get_nic_devices.assert_called_once_with(expected_nics)
+
+
+def test_storage_devices_iscsi_route_failure(harness, mocker):
+    """Test a failure to find the route to the target is logged."""
+    mocker.patch(
+        "charm.iscsi_utils.get_route_interface",
+        side_effect=subprocess.CalledProcessError(returncode=2, cmd=["ip"]),
+    )
+    mocker.patch("charm.irq_utils.get_nic_devices", return_value={})
+    mock_exception = mocker.patch("charm.logging.exception")
+    harness.charm._stored.storage_type = "iscsi"
+    harness.update_config({"iscsi-target": "abc"})
+
+    assert harness.charm._storage_devices() == {}
+    mock_exception.assert_called_once_with("Failed to find the interface routing to %s.", "abc")
+
+
+def test_storage_devices_fc(harness, mocker):
+    """Test the HBAs are used for fc storage."""
+    mocker.patch("charm.irq_utils.get_fc_devices", return_value={HBA.name: HBA})
+    harness.charm._stored.storage_type = "fc"
+
+    assert harness.charm._storage_devices() == {HBA.name: HBA}
+
+
+@pytest.mark.parametrize("enabled", [True, False], ids=["enabled", "opt-out"])
+def test_configure_irq_affinity(harness, mocker, enabled):
+    """Test the interrupts are only spread if enabled."""
+    mocker.patch("charm.StorageConnectorCharm._storage_devices", return_value={HBA.name: HBA})
+    mock_spread_irqs = mocker.patch("charm.irq_utils.spread_irqs")
+    harness.disable_hooks()
+    harness.update_config({"irq-affinity": enabled})
+
+    assert harness.charm._configure_irq_affinity() is True
+
+    assert mock_spread_irqs.called is enabled
+
+
+def test_configure_irq_affinity_failure(harness, mocker):
+    """Test failures to read the device topology are logged."""
+    mocker.patch("charm.StorageConnectorCharm._storage_devices", return_value={HBA.name: HBA})
+    mocker.patch("charm.irq_utils.spread_irqs", side_effect=OSError("no numa node"))
+    mock_exception = mocker.patch("charm.logging.exception")
+    harness.disable_hooks()
+    harness.update_config({"irq-affinity": True})
+
+    assert harness.charm._configure_irq_affinity() is False
+
+    mock_exception.assert_called_once_with("Failed to set the irq affinity of %s.", HBA.name)
+
+
+def test_on_show_irq_affinity_action(harness, mocker):
+    """Test the affinity of the storage devices is reported."""
+    mocker.patch("charm.StorageConnectorCharm._storage_devices", return_value={HBA.name: HBA})
+    mocker.patch(
+        "charm.irq_utils.describe",
+        return_value={"numa-node": 1, "local-cpus": "8-9", "irqs": {120: "8"}},
+    )
+    action_event = FakeActionEvent()
+
+    harness.charm._on_show_irq_affinity_action(action_event)
+
+    assert action_event.results["irq-affinity"] == (
+        "0000:3b:00.0:\n  irqs:\n    120: '8'\n  local-cpus: 8-9\n  numa-node: 1\n"
+    )
+
+
+def test_on_show_irq_affinity_action_unreadable_device(harness, mocker):
+    """Test a device whose affinity cannot be read is reported with the error."""
+    mocker.patch(
+        "charm.StorageConnectorCharm._storage_devices",
+        return_value={"virtio1": HBA.parent / "virtio1", HBA.name: HBA},
+    )
+    mocker.patch(
+        "charm.irq_utils.describe",
+        side_effect=[
+            FileNotFoundError("No such file or directory: 'local_cpulist'"),
+            {"numa-node": 1, "local-cpus": "8-9", "irqs": {120: "8"}},
+        ],
+    )
+    action_event = FakeActionEvent()
+
+    harness.charm._on_show_irq_affinity_action(action_event)
+
+    assert yaml.safe_load(action_event.results["irq-affinity"]) == {
+        "virtio1": {"error": "No such file or directory: 'local_cpulist'"},
+        HBA.name: {"numa-node": 1, "local-cpus": "8-9", "irqs": {120: "8"}},
+    }
+
+
+@pytest.fixture
+def applied_iscsi(harness, mocker, iscsi_config):
+    """Return a started charm whose managed state matches iscsi_config."""
+    mocker.patch("charm.socket.getfqdn", return_value="testhost.testdomain")
+    harness.disable_hooks()
+    harness.update_config(iscsi_config)
+    harness.charm._stored.storage_type = "iscsi"
+    harness.charm.ISCSI_INITIATOR_NAME.write_text(
+        "InitiatorName=iqn.2020-07.canonical.com:lun1\n"
+    )
+    harness.charm.ISCSI_CONF.write_text(harness.charm._render_iscsid_conf(harness.charm._templates()))
+    harness.charm.MULTIPATH_CONF_PATH.mkdir()
+    record_managed_state(harness)
+    harness.charm._stored.started = True
+    return harness
+
+
+def record_managed_state(harness):
+    """Write the multipath configuration and record every resource as applied."""
+    ctxt = harness.charm._multipath_context()
+    harness.charm.mp_path.write_text(harness.charm._render_multipath_conf(ctxt))
+    for path, content in harness.charm._managed_wwids_files(ctxt.get("wwids", {})).items():
+        path.write_text(content)
+    for path in [harness.charm.mp_path, harness.charm.ISCSI_CONF]:
+        if path.exists():
+            harness.charm._record_file(path, path.read_text())
+    harness.charm._stored.multipath_sections = harness.charm._multipath_changes(ctxt)[0]
+    harness.charm._stored.reconciled = {
+        resource.name: reconcile_utils.digest(resource.inputs())
+        for resource in harness.charm._resources()
+    }
+
+
+def test_file_intact(harness, tmp_path):
+    """Test files are compared with the content the charm last wrote."""
+    path = tmp_path / "managed.conf"
+    assert not harness.charm._file_intact(path)
+    assert harness.charm._file_intact(path, required=False)
+    path.write_text("written by an older revision")
+    assert harness.charm._file_intact(path)
+
+    harness.charm._record_file(path, "rendered")
+    assert not harness.charm._file_intact(path)
+    path.write_text("rendered")
+    assert harness.charm._file_intact(path)
+    path.unlink()
+    assert not harness.charm._file_intact(path)
+
+    harness.charm._record_file(path, None)
+    assert harness.charm._file_intact(path)
+    path.write_text("created by hand")
+    assert not harness.charm._file_intact(path)
+
+
+def test_edited_files_drift(applied_iscsi):
+    """Test the configuration files edited by hand are applied again."""
+    charm_ = applied_iscsi.charm
+
+    def pending():
+        steps = reconcile_utils.get_pending(charm_._resources(), charm_._stored.reconciled)
+        return [(resource.name, reason) for resource, reason in steps]
+
+    assert pending() == []
+
+    charm_._record_file(charm_.UDEV_RULES_FILE, None)
+    charm_.UDEV_RULES_FILE.write_text("# created by hand\n")
+    assert pending() == [("block-queues", reconcile_utils.REASON_DRIFT)]
+
+    with charm_.ISCSI_CONF.open("a") as file:
+        file.write("node.session.timeo.replacement_timeout = 5\n")
+    with charm_.mp_path.open("a") as file:
+        file.write("defaults {\n    polling_interval 5\n}\n")
+    assert pending() == [
+        ("iscsi", reconcile_utils.REASON_DRIFT),
+        ("multipath", reconcile_utils.REASON_DRIFT),
+        ("block-queues", reconcile_utils.REASON_DEPENDENCY),
+        ("irq-affinity", reconcile_utils.REASON_DEPENDENCY),
+    ]
+
+
+def test_reconcile_multipath_reloads_edited_conf(applied_iscsi, mocker):
+    """Test multipathd is reloaded when its configuration was edited by hand."""
+    mocker.patch("charm.command_utils.getoutput", return_value="")
+    mock_reload = mocker.patch("charm.systemd_utils.reload")
+    charm_ = applied_iscsi.charm
+    content = charm_.mp_path.read_text()
+
+    assert charm_._reconcile_multipath()
+    mock_reload.assert_not_called()
+
+    charm_.mp_path.write_text("defaults {\n    polling_interval 5\n}\n")
+    assert charm_._reconcile_multipath()
+    mock_reload.assert_called_once_with(["multipathd"])
+    assert charm_.mp_path.read_text() == content
+    assert charm_._file_intact(charm_.mp_path)
+
+
+def run_plan_action(harness):
+    """Run the plan action and return its results, with the plan parsed."""
+    action_event = FakeActionEvent()
+    harness.charm._on_plan_action(action_event)
+    results = action_event.results
+    if "plan" in results:
+        results["plan"] = yaml.safe_load(results["plan"])
+    return results
+
+
+def test_on_plan_action_first_configuration(harness, mocker, iscsi_config, tmp_path):
+    """Test the first configuration plans every resource, without touching the system."""
+    mocker.patch("charm.socket.getfqdn", return_value="testhost.testdomain")
+    mock_check_call = mocker.patch("charm.subprocess.check_call")
+    mock_getoutput = mocker.patch("charm.subprocess.getoutput")
+    harness.disable_hooks()
+    harness.update_config(iscsi_config)
+    harness.charm._stored.storage_type = "iscsi"
+    files = sorted(tmp_path.rglob("*"))
+
+    results = run_plan_action(harness)
+
+    assert results["disruption"] == "restart"
+    assert [step["resource"] for step in results["plan"]] == [
+        "directories",
+        "deferred-restarts",
+        "iscsi",
+        "multipath",
+        "block-queues",
+        "irq-affinity",
+    ]
+    assert {step["reason"] for step in results["plan"]} == {"inputs changed"}
+    iscsi, multipath = results["plan"][2:4]
+    assert iscsi["operations"] == [
+        f"write {harness.charm.ISCSI_INITIATOR_NAME} (none)",
+        f"write {harness.charm.ISCSI_CONF} (none)",
+        "restart iscsid, open-iscsi (restart)",
+    ]
+    assert multipath["operations"] == [
+        f"write {harness.charm.mp_path} (none)",
+        "reload multipathd (reload)",
+    ]
+    assert results["plan"][0]["operations"] == [
+        f"create {harness.charm.MULTIPATH_CONF_PATH} (none)"
+    ]
+    assert sorted(tmp_path.rglob("*")) == files
+    mock_check_call.assert_not_called()
+    mock_getoutput.assert_not_called()
+
+
+def test_on_plan_action_no_changes(applied_iscsi):
+    """Test nothing is planned when the managed state matches the configuration."""
+    assert run_plan_action(applied_iscsi) == {"plan": [], "disruption": "none"}
+
+
+@pytest.mark.parametrize(
+    "config, operations, disruption",
+    [
+        (
+            {"iscsi-node-session-iscsi-fastabort": "No"},
+            ["update iscsi node records (none)", "mark iscsi sessions pending relogin (none)"],
+            "none",
+        ),
+        (
+            {"iscsi-node-session-iscsi-fastabort": "No", "enable-auto-restarts": True},
+            ["update iscsi node records (none)", "relogin iscsi sessions (relogin)"],
+            "relogin",
+        ),
+        (
+            {"iscsi-node-session-iscsi-fastabort": "No", "iscsi-rolling-relogin": True},
+            ["update iscsi node records (none)", "relogin iscsi sessions (relogin)"],
+            "relogin",
+        ),
+        ({"iscsi-node-startup": "manual"}, ["update iscsi node records (none)"], "none"),
+        (
+            {"initiator-dictionary": '{"testhost.testdomain": "iqn.2020-07.canonical.com:lun2"}'},
+            ["defer restart iscsid, open-iscsi (none)"],
+            "none",
+        ),
+        (
+            {
+                "enable-auto-restarts": True,
+                "initiator-dictionary": '{"testhost.testdomain": "iqn.2020-07.canonical.com:lun2"}',
+            },
+            ["restart iscsid, open-iscsi (restart)"],
+            "restart",
+        ),
+    ],
+    ids=[
+        "pending-relogin",
+        "auto-restarts-relogin",
+        "rolling-relogin",
+        "node-record-only",
+        "deferred-restart",
+        "restart",
+    ],
+)
+def test_on_plan_action_iscsi(applied_iscsi, config, operations, disruption):
+    """Test iscsi changes are planned with their disruption."""
+    applied_iscsi.update_config({"enable-auto-restarts": False, **config})
+
+    results = run_plan_action(applied_iscsi)
+
+    iscsi = next(step for step in results["plan"] if step["resource"] == "iscsi")
+    assert iscsi["operations"][-len(operations):] == operations
+    assert results["disruption"] == disruption
+
+
+def test_on_plan_action_multipath_reload(applied_iscsi):
+    """Test a change of the multipath defaults plans a reload of multipathd."""
+    applied_iscsi.update_config({"multipath-defaults": '{"user_friendly_names": "no"}'})
+
+    results = run_plan_action(applied_iscsi)
+
+    assert results["plan"] == [
+        {
+            "resource": "multipath",
+            "reason": "inputs changed",
+            "operations": [
+                f"write {applied_iscsi.charm.mp_path} (none)",
+                "reload multipathd (reload)",
+            ],
+        },
+        {"resource": "block-queues", "reason": "dependency applied", "operations": []},
+    ]
+    assert results["disruption"] == "reload"
+
+
+def test_on_plan_action_stale_benchmark_conf(applied_iscsi):
+    """Test a benchmark configuration left behind plans its removal and a reload."""
+    applied_iscsi.charm.benchmark_conf.write_text("multipaths {}")
+
+    results = run_plan_action(applied_iscsi)
+
+    assert results["plan"][0] == {
+        "resource": "multipath",
+        "reason": "live state drifted",
+        "operations": [
+            f"remove {applied_iscsi.charm.benchmark_conf} (none)",
+            "reload multipathd (reload)",
+        ],
+    }
+    assert results["disruption"] == "reload"
+
+
+def test_on_plan_action_edited_files(applied_iscsi):
+    """Test the configuration files edited by hand are planned to be written again."""
+    charm_ = applied_iscsi.charm
+    iscsi_conf = charm_.ISCSI_CONF.read_text()
+    charm_.ISCSI_CONF.write_text(
+        iscsi_conf.replace("node.session.iscsi.FastAbort = Yes", "node.session.iscsi.FastAbort = No")
+    )
+    charm_.mp_path.write_text("defaults {\n    polling_interval 5\n}\n")
+    charm_.UDEV_RULES_FILE.write_text("# created by hand\n")
+    charm_._record_file(charm_.UDEV_RULES_FILE, None)
+
+    results = run_plan_action(applied_iscsi)
+
+    assert results["plan"][:3] == [
+        {
+            "resource": "iscsi",
+            "reason": "live state drifted",
+            "operations": [
+                f"write {charm_.ISCSI_CONF} (none)",
+                "update iscsi node records (none)",
+                "mark iscsi sessions pending relogin (none)",
+            ],
+        },
+        {
+            "resource": "multipath",
+            "reason": "live state drifted",
+            "operations": [f"write {charm_.mp_path} (none)", "reload multipathd (reload)"],
+        },
+        {
+            "resource": "block-queues",
+            "reason": "dependency applied",
+            "operations": [
+                f"remove {charm_.UDEV_RULES_FILE} (none)",
+                "trigger udev rules of the matching block devices (none)",
+            ],
+        },
+    ]
+    assert results["disruption"] == "reload"
+    assert charm_.ISCSI_CONF.read_text() != iscsi_conf
+
+
+def test_on_plan_action_multipath_maps(applied_iscsi, mocker):
+    """Test a change of the managed WWIDs plans updates of the affected maps only."""
+    mocker.patch("storage_connector.command_utils.subprocess.check_output", return_value=b"")
+    applied_iscsi.update_config({"multipath-wwids": '{"3600a": "data2", "3600b": "data3"}'})
+    record_managed_state(applied_iscsi)
+    applied_iscsi.update_config({"multipath-wwids": '{"3600a": "data2", "3600b": "data4"}'})
+
+    results = run_plan_action(applied_iscsi)
+
+    assert results["plan"][0]["operations"] == [
+        f"write {applied_iscsi.charm.MULTIPATH_BINDINGS_FILE} (none)",
+        "update multipath map 3600b (none)",
+    ]
+    assert results["disruption"] == "none"
+
+
+def test_on_plan_action_block_queues_and_irq_affinity(applied_iscsi, mocker):
+    """Test the udev rules and the interrupts of the storage devices are planned."""
+    mocker.patch("charm.StorageConnectorCharm._storage_devices", return_value={HBA.name: HBA})
+    applied_iscsi.update_config({"block-queue-settings": QUEUE_SETTINGS, "irq-affinity": True})
+
+    results = run_plan_action(applied_iscsi)
+
+    assert results["plan"] == [
+        {
+            "resource": "block-queues",
+            "reason": "inputs changed",
+            "operations": [
+                f"write {applied_iscsi.charm.UDEV_RULES_FILE} (none)",
+                "trigger udev rules of the matching block devices (none)",
+            ],
+        },
+        {
+            "resource": "irq-affinity",
+            "reason": "inputs changed",
+            "operations": [f"spread interrupts of {HBA.name} (none)"],
+        },
+    ]
+
+
+def test_on_plan_action_iscsi_ifaces(applied_iscsi, mocker):
+    """Test changed iface bindings are planned, with the login of the new ifaces."""
+    mocker.patch("charm.iscsi_utils.resolve_iface_bindings", return_value={"iface0": "eth1"})
+    applied_iscsi.update_config({"iscsi-iface-bindings": "iface0=eth1"})
+
+    results = run_plan_action(applied_iscsi)
+
+    iscsi = next(step for step in results["plan"] if step["resource"] == "iscsi")
+    assert iscsi["operations"] == [
+        "update iscsi ifaces (none)",
+        "login iscsi ifaces (none)",
+    ]
+
+
+def test_on_plan_action_fc_scan(harness, mocker, fc_config, multipath_topology):
+    """Test the scan of the HBAs is planned until it ran once."""
+    mocker.patch("charm.subprocess.getoutput", return_value=multipath_topology)
+    harness.disable_hooks()
+    harness.update_config(fc_config)
+    harness.charm._stored.storage_type = "fc"
+
+    results = run_plan_action(harness)
+
+    assert results["plan"][0] == {
+        "resource": "fc-scan",
+        "reason": "inputs changed",
+        "operations": ["rescan scsi hosts (none)"],
+    }
+
+
+def test_on_plan_action_invalid_config(applied_iscsi):
+    """Test an invalid configuration fails the action."""
+    applied_iscsi.update_config({"multipath-defaults": '{"user_friendly_name": "yes"}'})
+
+    results = run_plan_action(applied_iscsi)
+
+    assert results["failed"].startswith("Cannot plan the changes: ")
+
+
+def test_on_commit_saves_hook_timings(harness, mocker, monkeypatch):
+    """Test the timings of the steps are saved once the hook ran."""
+    monkeypatch.setenv("JUJU_DISPATCH_PATH", "hooks/config-changed")
+    mocker.patch("charm.subprocess.check_call")
+    mocker.patch("charm.StorageConnectorCharm._clear_deferred_restarts")
+    mocker.patch("charm.StorageConnectorCharm._iscsi_discovery_and_login")
+    harness.charm._profile = charm.timing_utils.start(harness.charm._hook_name())
+
+    harness.charm._restart_services(["iscsid", "open-iscsi"])
+    harness.framework.on.commit.emit()
+
+    (profile,) = json.loads(harness.charm.TIMINGS_FILE.read_text())
+    assert profile["hook"] == "config-changed"
+    assert [name for name, _ in profile["spans"]] == [
+        "restart iscsid",
+        "restart iscsid/wait until ready",
+        "restart open-iscsi",
+        "restart open-iscsi/wait until ready",
+        "clear deferred restarts",
+        "iscsi discovery and login",
+    ]
+
+
+def test_on_commit_hook_timings_disabled(harness):
+    """Test no timings are saved if the history is disabled."""
+    harness.update_config({"hook-timings-history": 0})
+
+    harness.framework.on.commit.emit()
+
+    assert not harness.charm.TIMINGS_FILE.exists()
+
+
+@pytest.mark.parametrize("path", ["hooks/update-status", "actions/show-timings", "actions/plan"])
+def test_on_commit_hook_timings_skipped(harness, monkeypatch, path):
+    """Test the timings of update-status and the read-only actions are not saved."""
+    monkeypatch.setenv("JUJU_DISPATCH_PATH", path)
+
+    harness.framework.on.commit.emit()
+
+    assert not harness.charm.TIMINGS_FILE.exists()
+
+
+def test_on_commit_hook_timings_error(harness, mocker):
+    """Test a failure to save the timings does not fail the hook."""
+    mocker.patch("charm.timing_utils.save_profile", side_effect=PermissionError("denied"))
+    mock_warning = mocker.patch("charm.logging.warning")
+
+    harness.framework.on.commit.emit()
+
+    mock_warning.assert_called_once_with("Failed to save the hook timings: %s", mocker.ANY)
+
+
+def test_on_show_timings_action(harness):
+    """Test the most recent timings of the requested hooks are shown."""
+    harness.charm.TIMINGS_FILE.write_text(
+        json.dumps(
+            [
+                {"hook": "config-changed", "started": 0, "duration": 9.0, "spans": []},
+                {"hook": "update-status", "started": 0, "duration": 0.1, "spans": []},
+                {
+                    "hook": "config-changed",
+                    "started": 1700000000,
+                    "duration": 3.5,
+                    "spans": [
+                        ["reconcile", 3.0],
+                        ["reconcile/iscsi", 1.25],
+                        ["reconcile/iscsi", 1.5],
+                    ],
+                    "commands": {
+                        "systemctl": {"count": 2, "duration": 0.5, "failures": 0, "output": 0},
+                        "iscsiadm": {"count": 4, "duration": 2.0, "failures": 1, "output": 80},
+                    },
+                },
+            ]
+        )
+    )
+    action_event = FakeActionEvent(params={"count": 1, "hook": "config-changed"})
+
+    harness.charm._on_show_timings_action(action_event)
+
+    (timings,) = yaml.safe_load(action_event.results["timings"])
+    assert timings["hook"] == "config-changed"
+    assert timings["started"] == datetime.fromtimestamp(1700000000).isoformat()
+    assert timings["duration"] == 3.5
+    assert timings["spans"] == {"reconcile": 3.0, "reconcile/iscsi": 2.75}
+    assert list(timings["commands"]) == ["iscsiadm", "systemctl"]
+
+
+def test_on_show_timings_action_no_timings(harness):
+    """Test an empty list is shown if no hook was timed yet."""
+    action_event = FakeActionEvent(params={"count": 5})
+
+    harness.charm._on_show_timings_action(action_event)
+
+    assert action_event.results["timings"] == "[]\n"
+
+
+@pytest.mark.parametrize(
+    "config, env", [({"profile-hooks": True}, {}), ({}, {"STORAGE_CONNECTOR_PROFILE": "1"})]
+)
+def test_on_commit_saves_hook_profile(harness, monkeypatch, config, env):
+    """Test hooks are profiled if the config option or the environment flag is set."""
+    monkeypatch.setenv("JUJU_DISPATCH_PATH", "hooks/update-status")
+    for key, value in env.items():
+        monkeypatch.setenv(key, value)
+    profiled = ops.testing.Harness(charm.StorageConnectorCharm)
+    profiled.update_config(config)
+    profiled.begin()
+
+    profiled.framework.on.commit.emit()
+    profiled.cleanup()
+
+    (path,) = cprofile_utils.list_profiles(harness.charm.PROFILES_DIR)
+    assert path.name.endswith("-update-status.pstats.gz")
+
+
+def test_hook_profile_saved_on_failure(harness, mocker, monkeypatch):
+    """Test the profile of a failed hook is saved on exit, and only once."""
+    monkeypatch.setenv("JUJU_DISPATCH_PATH", "hooks/config-changed")
+    monkeypatch.setenv(charm.StorageConnectorCharm.PROFILE_ENV, "1")
+    mock_register = mocker.patch("charm.atexit.register")
+    profiled = ops.testing.Harness(charm.StorageConnectorCharm)
+    profiled.begin()
+    mock_register.assert_called_once_with(profiled.charm._save_hook_profile)
+
+    # the hook raised, the exit handler runs without a commit event
+    profiled.charm._save_hook_profile()
+    profiled.charm._save_hook_profile()
+    profiled.cleanup()
+
+    (path,) = cprofile_utils.list_profiles(harness.charm.PROFILES_DIR)
+    assert path.name.endswith("-config-changed.pstats.gz")
+
+
+def test_on_commit_hook_profile_not_enabled(harness):
+    """Test hooks are not profiled by default."""
+    assert harness.charm._profiler is None
+
+    harness.framework.on.commit.emit()
+
+    assert not harness.charm.PROFILES_DIR.exists()
+
+
+def test_on_commit_hook_profile_error(harness, mocker):
+    """Test a failure to save the profile does not fail the hook."""
+    harness.charm._profiler = mocker.Mock()
+    mocker.patch("storage_connector.cprofile_utils.save", side_effect=OSError("No space"))
+    mock_warning = mocker.patch("charm.logging.warning")
+
+    harness.framework.on.commit.emit()
+
+    mock_warning.assert_called_once_with(
+        "Failed to save the profile of the hook: %s", mocker.ANY
+    )
+
+
+@pytest.fixture
+def saved_profiles(harness):
+    """Return the paths of two saved hook profiles, the most recent first."""
+    paths = []
+    for hook in ["install", "config-changed"]:
+        profiler = cprofile_utils.start()
+        sorted(range(10))
+        paths.append(cprofile_utils.save(harness.charm.PROFILES_DIR, profiler, hook, keep=5))
+    return paths[::-1]
+
+
+def test_on_show_profiles_action_list(harness, saved_profiles):
+    """Test the most recent profiles are listed."""
+    action_event = FakeActionEvent(params={"count": 1})
+
+    harness.charm._on_show_profiles_action(action_event)
+
+    assert yaml.safe_load(action_event.results["profiles"]) == [
+        {"name": saved_profiles[0].name, "size": saved_profiles[0].stat().st_size}
+    ]
+
+
+def test_on_show_profiles_action_fetch(harness, saved_profiles):
+    """Test a profile is fetched along with a summary of its slowest functions."""
+    action_event = FakeActionEvent(params={"count": 5, "name": saved_profiles[1].name})
+
+    harness.charm._on_show_profiles_action(action_event)
+
+    assert action_event.results["path"] == str(saved_profiles[1])
+    assert "cumulative" in action_event.results["stats"]
+    assert base64.b64decode(action_event.results["data"]) == saved_profiles[1].read_bytes()
+
+
+def test_on_show_profiles_action_unknown(harness, saved_profiles):
+    """Test only the saved profiles can be fetched."""
+    action_event = FakeActionEvent(params={"count": 5, "name": "../hook-timings.json"})
+
+    harness.charm._on_show_profiles_action(action_event)
+
+    assert action_event.results == {"failed": "No profile named ../hook-timings.json."}
+
+
+BENCHMARK_PARAMS = {
+    "sequential-block-size": 1048576,
+    "random-block-size": 4096,
+    "queue-depth": 4,
+    "duration": 1,
+}
+
+
+@pytest.mark.parametrize(
+    "params", [{}, {"alias": "data1", "device": "/dev/loop0"}], ids=["none", "both"]
+)
+def test_on_benchmark_action_invalid_params(harness, params):
+    """Test either an alias or a device must be benchmarked."""
+    action_event = FakeActionEvent(params={**BENCHMARK_PARAMS, **params})
+
+    harness.charm._on_benchmark_action(action_event)
+
+    assert action_event.results["failed"] == "Exactly one of alias and device must be given."
+
+
+def test_on_benchmark_action_device(harness, mocker):
+    """Test a device is benchmarked on its own."""
+    mock_run = mocker.patch("charm.benchmark_utils.run", return_value={"iops": 100})
+    action_event = FakeActionEvent(params={**BENCHMARK_PARAMS, "device": "/dev/loop0"})
+
+    harness.charm._on_benchmark_action(action_event)
+
+    mock_run.assert_has_calls(
+        [
+            call(["/dev/loop0"], "sequential", 1048576, 4, 1),
+            call(["/dev/loop0"], "random", 4096, 4, 1),
+        ]
+    )
+    assert yaml.safe_load(action_event.results["results"]) == {
+        "/dev/loop0": {"random": {"iops": 100}, "sequential": {"iops": 100}}
+    }
+
+
+def test_on_benchmark_action_alias(harness, mocker):
+    """Test the multipath device and each of its path groups are benchmarked."""
+    mocker.patch(
+        "charm.multipath_utils.get_path_groups",
+        return_value=[
+            charm.multipath_utils.PathGroup("service-time 0", 50, "active", ["sda", "sdd"]),
+            charm.multipath_utils.PathGroup("service-time 0", 10, "enabled", ["sdb"]),
+        ],
+    )
+    mock_run = mocker.patch("charm.benchmark_utils.run", return_value={"iops": 100})
+    action_event = FakeActionEvent(params={**BENCHMARK_PARAMS, "alias": "data1"})
+
+    harness.charm._on_benchmark_action(action_event)
+
+    assert [args[0] for args, _ in mock_run.call_args_list] == [
+        [str(harness.charm.DEV_MAPPER / "data1")],
+        [str(harness.charm.DEV_MAPPER / "data1")],
+        ["/dev/sda", "/dev/sdd"],
+        ["/dev/sda", "/dev/sdd"],
+        ["/dev/sdb"],
+        ["/dev/sdb"],
+    ]
+    assert list(yaml.safe_load(action_event.results["results"])) == [
+        "multipath",
+        "path-group-1 (active, prio 50)",
+        "path-group-2 (enabled, prio 10)",
+    ]
+    assert action_event.logs[0] == "Benchmarking multipath"
+
+
+def test_on_benchmark_action_unknown_alias(harness, mocker):
+    """Test the action fails for unknown multipath maps."""
+    mocker.patch(
+        "charm.multipath_utils.get_path_groups",
+        side_effect=subprocess.CalledProcessError(returncode=1, cmd=["multipath"]),
+    )
+    action_event = FakeActionEvent(params={**BENCHMARK_PARAMS, "alias": "data9"})
+
+    harness.charm._on_benchmark_action(action_event)
+
+    assert action_event.results["failed"] == (
+        "Multipath map data9 not available, see the unit logs for details"
+    )
+
+
+@pytest.mark.parametrize(
+    "params, error",
+    [
+        ({"device": "/dev/loop0", "path-selectors": "queue-length"}, "needs an alias"),
+        (
+            {"alias": "data1", "path-selectors": "queue-length least-pending"},
+            "Unknown path selectors: least-pending.",
+        ),
+    ],
+    ids=["no-alias", "unknown-selector"],
+)
+def test_on_benchmark_action_invalid_path_selectors(harness, params, error):
+    """Test the path selectors to compare are validated."""
+    action_event = FakeActionEvent(params={**BENCHMARK_PARAMS, **params})
+
+    harness.charm._on_benchmark_action(action_event)
+
+    assert error in action_event.results["failed"]
+
+
+def test_on_benchmark_action_path_selectors(harness, mocker):
+    """Test the map is benchmarked with each path selector and then restored."""
+    harness.charm.MULTIPATH_CONF_PATH.mkdir()
+    conf = harness.charm.MULTIPATH_CONF_PATH / harness.charm.BENCHMARK_CONF_NAME
+    rendered = []
+    mocker.patch("charm.multipath_utils.get_map_wwid", return_value="3624a9370")
+    mock_reconfigure = mocker.patch(
+        "charm.multipath_utils.reconfigure",
+        side_effect=lambda: rendered.append(
+            (conf.read_text(), conf.stat().st_mode & 0o777) if conf.exists() else None
+        ),
+    )
+    mocker.patch(
+        "charm.multipath_utils.get_path_groups",
+        side_effect=[
+            [charm.multipath_utils.PathGroup("service-time 0", 50, "active", ["sda"])],
+            [charm.multipath_utils.PathGroup("round-robin 0", 50, "active", ["sda"])],
+            [charm.multipath_utils.PathGroup("queue-length 0", 50, "active", ["sda"])],
+        ],
+    )
+    mock_sleep = mocker.patch("charm.time.sleep")
+    mock_run = mocker.patch("charm.benchmark_utils.run", return_value={"iops": 100})
+    action_event = FakeActionEvent(
+        params={
+            **BENCHMARK_PARAMS,
+            "alias": "data1",
+            "path-selectors": "round-robin queue-length",
+            "rr-min-io-rq": 1,
+        }
+    )
+
+    harness.charm._on_benchmark_action(action_event)
+
+    assert list(yaml.safe_load(action_event.results["results"])) == [
+        "multipath (queue-length 0)",
+        "multipath (round-robin 0)",
+    ]
+    assert mock_run.call_count == 4
+    assert mock_reconfigure.call_count == 3
+    assert 'path_selector "round-robin 0"' in rendered[0][0]
+    assert 'rr_min_io_rq "1"' in rendered[0][0]
+    assert 'wwid "3624a9370"' in rendered[0][0]
+    assert rendered[0][1] == 0o600
+    assert 'path_selector "queue-length 0"' in rendered[1][0]
+    assert rendered[2] is None  # restored
+    mock_sleep.assert_called_once_with(1)
+
+
+def test_on_benchmark_action_path_selector_not_applied(harness, mocker):
+    """Test the comparison stops and restores the map if a selector is not applied."""
+    harness.charm.MULTIPATH_CONF_PATH.mkdir()
+    mocker.patch("charm.multipath_utils.get_map_wwid", return_value="3624a9370")
+    mock_reconfigure = mocker.patch("charm.multipath_utils.reconfigure")
+    mocker.patch(
+        "charm.multipath_utils.get_path_groups",
+        return_value=[charm.multipath_utils.PathGroup("service-time 0", 50, "active", ["sda"])],
+    )
+    mocker.patch("charm.time.sleep")
+    mocker.patch("charm.time.monotonic", side_effect=[0, 10, 31])
+    action_event = FakeActionEvent(
+        params={**BENCHMARK_PARAMS, "alias": "data1", "path-selectors": "round-robin"}
+    )
+
+    harness.charm._on_benchmark_action(action_event)
+
+    assert action_event.results["failed"] == (
+        "Multipath map data1 did not switch to round-robin 0."
+    )
+    assert mock_reconfigure.call_count == 2
+    assert not (harness.charm.MULTIPATH_CONF_PATH / harness.charm.BENCHMARK_CONF_NAME).exists()
+
+
+def test_on_benchmark_action_path_selectors_unknown_alias(harness, mocker):
+    """Test the comparison fails for unknown multipath maps."""
+    mocker.patch("charm.multipath_utils.get_map_wwid", return_value=None)
+    action_event = FakeActionEvent(
+        params={**BENCHMARK_PARAMS, "alias": "data9", "path-selectors": "round-robin"}
+    )
+
+    harness.charm._on_benchmark_action(action_event)
+
+    assert action_event.results["failed"] == "Multipath map data9 not found."
+
+
+def test_on_benchmark_action_failed(harness, mocker):
+    """Test read errors fail the action."""
+    mocker.patch("charm.benchmark_utils.run", side_effect=OSError("Input/output error"))
+    action_event = FakeActionEvent(params={**BENCHMARK_PARAMS, "device": "/dev/loop0"})
+
+    harness.charm._on_benchmark_action(action_event)
+
+    assert action_event.results["failed"] == (
+        "Benchmark of /dev/loop0 failed: Input/output error"
+    )
+
+
 def test_get_status_message(harness, mocker):
     """Test on setting active status with correct status message."""
     mock_get_deferred_restarts = mocker.patch(
-        "charm.deferred_events.get_deferred_restarts", return_value=[]
+        "charmhelpers.contrib.openstack.deferred_events.get_deferred_restarts", return_value=[]
     )
     assert harness.charm.get_status_message() == "Unit is ready"
 
+    # deferred events are read once per dispatch
+    harness.charm._deferred_restarts = None
     mock_get_deferred_restarts.return_value = [
         deferred_events.ServiceEvent(
             timestamp=123456,
@@ -885,9 +2647,11 @@ def test_get_status_message(harness, mocker):
 
 def test_check_deferred_restarts_queue(harness, mocker):
     """Test check_deferred_restarts_queue decorator function."""
-    mock_check_restart_timestamps = mocker.patch("charm.deferred_events.check_restart_timestamps")
+    mock_check_restart_timestamps = mocker.patch(
+        "charm.StorageConnectorCharm._check_restart_timestamps"
+    )
     mocker.patch(
-        "charm.deferred_events.get_deferred_restarts",
+        "charmhelpers.contrib.openstack.deferred_events.get_deferred_restarts",
         return_value=[
             deferred_events.ServiceEvent(
                 timestamp=234567,
@@ -915,18 +2679,85 @@ def test_check_deferred_restarts_queue_logs_error(harness, mocker):
     mock_error = mocker.patch("charm.logging.error")
     value_error = ValueError("test")
     mock_check_restart_timestamps = mocker.patch(
-        "charm.deferred_events.check_restart_timestamps", side_effect=value_error
+        "charm.StorageConnectorCharm._check_restart_timestamps", side_effect=value_error
     )
     harness.charm.on.update_status.emit()
     mock_check_restart_timestamps.assert_called_once()
     mock_error.assert_called_once_with("Cannot retrieve services' start time: %s", value_error)
 
 
+def test_check_restart_timestamps(harness, mocker):
+    """Test deferred restarts are cleared for services restarted after deferral."""
+    mocker.patch(
+        "charmhelpers.contrib.openstack.deferred_events.get_deferred_restarts",
+        return_value=[
+            deferred_events.ServiceEvent(
+                timestamp=1000,
+                service=service,
+                reason="Reason",
+                action="restart",
+                policy_requestor_name="storage-connector",
+                policy_requestor_type="charm",
+            )
+            for service in ["iscsid", "open-iscsi", "multipathd"]
+        ],
+    )
+    mock_clear = mocker.patch(
+        "charmhelpers.contrib.openstack.deferred_events.clear_deferred_restarts"
+    )
+    mock_get_start_times = mocker.patch(
+        "charm.systemd_utils.get_start_times",
+        return_value={
+            "iscsid": datetime.fromtimestamp(500),
+            "open-iscsi": datetime.fromtimestamp(2000),
+            "multipathd": None,
+        },
+    )
+
+    harness.charm._check_restart_timestamps()
+
+    mock_get_start_times.assert_called_once_with(["iscsid", "multipathd", "open-iscsi"])
+    mock_clear.assert_called_once_with(["open-iscsi", "multipathd"])
+
+
+def test_check_deferred_restarts_queue_fast_path(harness, mocker):
+    """Test the deferred restarts check is skipped while no deferred events exist."""
+    mock_check_restart_timestamps = mocker.patch(
+        "charm.StorageConnectorCharm._check_restart_timestamps"
+    )
+    mocker.patch(
+        "charmhelpers.contrib.openstack.deferred_events.get_deferred_restarts", return_value=[]
+    )
+    events_dir = harness.charm.DEFERRED_EVENTS_DIR
+    events_dir.mkdir()
+    harness.charm.unit.status = ActiveStatus("Unit is ready")
+
+    # recently modified directory is not trusted
+    harness.charm.on.update_status.emit()
+    harness.charm.on.update_status.emit()
+    assert mock_check_restart_timestamps.call_count == 2
+
+    # first run performs the full check and remembers the idle directory state
+    os.utime(events_dir, (1000, 1000))
+    harness.charm.on.update_status.emit()
+    harness.charm.on.update_status.emit()
+    assert mock_check_restart_timestamps.call_count == 3
+    assert harness.charm.unit.status == ActiveStatus("Unit is ready")
+
+    # a new deferred event invalidates the fast path
+    (events_dir / "charm-storage-connector-1.deferred").touch()
+    os.utime(events_dir, (2000, 2000))
+    harness.charm.on.update_status.emit()
+    harness.charm.on.update_status.emit()
+    assert mock_check_restart_timestamps.call_count == 5
+    assert harness.charm._stored.idle_deferred_events_state is None
+
+
 def test_configure_deferred_restarts(harness, mocker):
     """Test on setting up deferred restarts in policy-rc.d."""
-    mock_install_policy_rcd = mocker.patch("charm.policy_rcd.install_policy_rcd")
-    mock_remove_policy_file = mocker.patch("charm.policy_rcd.remove_policy_file")
-    mock_add_policy_block = mocker.patch("charm.policy_rcd.add_policy_block")
+    mock_install_policy_rcd = mocker.patch("charmhelpers.contrib.openstack.policy_rcd.install_policy_rcd")
+    mock_remove_policy_file = mocker.patch("charmhelpers.contrib.openstack.policy_rcd.remove_policy_file")
+    mock_add_policy_block = mocker.patch("charmhelpers.contrib.openstack.policy_rcd.add_policy_block")
     mock_chmod = mocker.patch("charm.os.chmod")
 
     harness.update_config({"enable-auto-restarts": True})
@@ -947,6 +2778,29 @@ def test_configure_deferred_restarts(harness, mocker):
     )
 
 
+def test_configure_deferred_restarts_failure(harness, mocker):
+    """Test a failure to set up policy-rc.d is logged and reported."""
+    mocker.patch(
+        "charmhelpers.contrib.openstack.policy_rcd.install_policy_rcd",
+        side_effect=PermissionError("denied"),
+    )
+    mock_exception = mocker.patch("charm.logging.exception")
+
+    assert harness.charm._configure_deferred_restarts() is False
+    mock_exception.assert_called_once_with("Failed to set up the deferred restarts.")
+
+
+def test_create_directories(harness, mocker):
+    """Test the configuration directories are created, and failures reported."""
+    assert harness.charm._create_directories() is True
+    assert harness.charm.MULTIPATH_CONF_PATH.is_dir()
+
+    mocker.patch("charm.Path.mkdir", side_effect=PermissionError("denied"))
+    mock_exception = mocker.patch("charm.logging.exception")
+    assert harness.charm._create_directories() is False
+    mock_exception.assert_called_once_with("Failed to create the configuration directories.")
+
+
 def test_on_restart_non_iscsi_services(harness, mocker):
     """Test on restarting non-iscsi services."""
     mock_check_call = mocker.patch("charm.subprocess.check_call")
@@ -984,6 +2838,60 @@ def test_on_restart_iscsi_services_without_discovery_login(harness, mocker):
     mock_iscsi_discovery_and_login.assert_not_called()
 
 
+def test_restart_order(harness):
+    """Test independent services are grouped and dependencies come first."""
+    assert harness.charm._restart_order(["open-iscsi", "multipathd", "iscsid"]) == [
+        ["iscsid", "multipathd"],
+        ["open-iscsi"],
+    ]
+    assert harness.charm._restart_order(["open-iscsi"]) == [["open-iscsi"]]
+
+
+def test_on_restart_services_waits_for_readiness(harness, mocker):
+    """Test every group of services is waited for before the next one."""
+    manager = mocker.Mock()
+    manager.attach_mock(mocker.patch("charm.subprocess.check_call"), "check_call")
+    manager.attach_mock(
+        mocker.patch("charm.systemd_utils.wait_until_ready", return_value=[]), "wait_until_ready"
+    )
+    manager.attach_mock(
+        mocker.patch("charm.StorageConnectorCharm._iscsi_discovery_and_login"), "discovery"
+    )
+    mock_listening = mocker.patch(
+        "charm.systemd_utils.is_unix_socket_listening", return_value=True
+    )
+    harness.update_config({"iscsi-discovery-and-login": True})
+
+    harness.charm._restart_services(services=["iscsid", "open-iscsi"])
+
+    assert [mock_call[0] for mock_call in manager.mock_calls] == [
+        "check_call",
+        "wait_until_ready",
+        "check_call",
+        "wait_until_ready",
+        "discovery",
+    ]
+    checks = manager.wait_until_ready.call_args[1]["checks"]
+    assert checks["iscsid"]()
+    mock_listening.assert_called_once_with("@ISCSIADM_ABSTRACT_NAMESPACE")
+
+
+def test_on_restart_iscsi_services_not_ready(harness, mocker):
+    """Test discovery and login is skipped if iscsi services are not ready."""
+    mocker.patch("charm.subprocess.check_call")
+    mocker.patch("charm.systemd_utils.wait_until_ready", side_effect=[["iscsid"], []])
+    mock_iscsi_discovery_and_login = mocker.patch(
+        "charm.StorageConnectorCharm._iscsi_discovery_and_login"
+    )
+    mock_error = mocker.patch("charm.logging.error")
+    harness.update_config({"iscsi-discovery-and-login": True})
+
+    harness.charm._restart_services(services=["iscsid", "open-iscsi"])
+
+    mock_iscsi_discovery_and_login.assert_not_called()
+    mock_error.assert_called_once()
+
+
 def test_iscsiadm_discovery_failed(harness, mocker):
     """Test response to iscsiadm discovery failure."""
     mock_log_exception = mocker.patch("charm.logging.exception")
@@ -1053,7 +2961,7 @@ def test_on_nrpe_external_master_changed(harness, mocker):
     """Test the relation event handlers for nrpe-external-master."""
     mocker.patch("storage_connector.metrics_utils.install_exporter")
     mocker.patch("storage_connector.metrics_utils.uninstall_exporter")
-    mock_update_nrpe_config = mocker.patch("charm.nrpe_utils.update_nrpe_config")
+    mock_update_nrpe_config = mocker.patch("storage_connector.nrpe_utils.update_nrpe_config")
 
     rel_id = harness.add_relation("nrpe-external-master", "nrpe")
     harness.add_relation_unit(rel_id, "nrpe/0")
@@ -1065,7 +2973,7 @@ def test_on_nrpe_external_master_handlers_config(harness, mocker):
     """Test the relation event handlers for nrpe-external-master."""
     mocker.patch("charm.metrics_utils.install_exporter")
     mocker.patch("charm.metrics_utils.uninstall_exporter")
-    mock_update_nrpe_config = mocker.patch("charm.nrpe_utils.update_nrpe_config")
+    mock_update_nrpe_config = mocker.patch("storage_connector.nrpe_utils.update_nrpe_config")
 
     harness.add_relation("nrpe-external-master", "nrpe")
     harness.charm.on.config_changed.emit()
@@ -1073,6 +2981,43 @@ def test_on_nrpe_external_master_handlers_config(harness, mocker):
     mock_update_nrpe_config.assert_called_once_with(harness.charm.model.config)
 
 
+@pytest.mark.parametrize(
+    "env, expected",
+    [
+        ({}, False),
+        ({"JUJU_DISPATCH_PATH": "hooks/config-changed"}, False),
+        ({"JUJU_DISPATCH_PATH": "hooks/update-status"}, True),
+        ({"JUJU_DISPATCH_PATH": "actions/restart-services", "JUJU_ACTION_NAME": "x"}, True),
+    ],
+    ids=["no-dispatch", "config-changed", "update-status", "action"],
+)
+def test_skip_cos_agent(harness, monkeypatch, env, expected):
+    """Test the cos_agent provider is skipped only for frequent hooks and actions."""
+    monkeypatch.delenv("JUJU_ACTION_NAME", raising=False)
+    monkeypatch.delenv("JUJU_DISPATCH_PATH", raising=False)
+    for key, value in env.items():
+        monkeypatch.setenv(key, value)
+    assert harness.charm._skip_cos_agent() is expected
+
+
+def test_charm_module_does_not_import_heavy_modules():
+    """Test that loading the charm module does not pull in the slow imports."""
+    heavy_modules = [
+        "apt",
+        "jinja2",
+        "charmhelpers.contrib.openstack.deferred_events",
+        "charmhelpers.contrib.openstack.policy_rcd",
+        "charmhelpers.core.hookenv",
+        "charms.grafana_agent.v0.cos_agent",
+        "pydantic",
+    ]
+    code = f"import sys, charm; print([m for m in {heavy_modules!r} if m in sys.modules])"
+    output = subprocess.check_output(
+        [sys.executable, "-c", code], env={**os.environ, "PYTHONPATH": "src:lib"}, text=True
+    )
+    assert output.strip() == "[]"
+
+
 class FakeActionEvent(EventBase):
     """Set a fake action class for unit tests mocking."""
 
@@ -1082,6 +3027,7 @@ class FakeActionEvent(EventBase):
         if params is None:
             params = {}
         self.params = params
+        self.logs = []
 
     def set_results(self, results):
         """Mock results."""
@@ -1089,4 +3035,4 @@ class FakeActionEvent(EventBase):
 
     def log(self, log):
         """Mock logs."""
-        self.log = log
+        self.logs.append(log)
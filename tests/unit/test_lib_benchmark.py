@@ -0,0 +1,120 @@
+"""Unit tests for the benchmark library."""
+
+import os
+
+import pytest
+from storage_connector import benchmark_utils
+
+
+@pytest.fixture
+def data_file(tmp_path):
+    """Return a file to benchmark, standing in for a block device."""
+    path = tmp_path / "data"
+    path.write_bytes(os.urandom(1024 * 1024))
+    return str(path)
+
+
+@pytest.mark.parametrize("pattern", benchmark_utils.PATTERNS)
+def test_run(data_file, pattern):
+    """Test the reads are accounted in the summary."""
+    summary = benchmark_utils.run(
+        [data_file, data_file], pattern, 4096, queue_depth=3, duration=0.05, direct=False
+    )
+
+    assert summary["iops"] > 0
+    assert summary["mb-per-s"] > 0
+    assert list(summary["latency-us"]) == ["p50", "p90", "p99", "p99.9", "max"]
+
+
+def test_run_reads_every_path(data_file, mocker):
+    """Test every path is read when the queue depth is lower than the paths."""
+    mock_open = mocker.spy(benchmark_utils.os, "open")
+    mock_preadv = mocker.spy(benchmark_utils.os, "preadv")
+
+    benchmark_utils.run(
+        [data_file, data_file, data_file], "random", 4096, 1, duration=0.05, direct=False
+    )
+
+    fds = {mock_call.args[0] for mock_call in mock_preadv.call_args_list}
+    assert fds == set(mock_open.spy_return_list)
+
+
+def test_run_latency_samples(data_file, mocker):
+    """Test the latencies kept are bounded, while every read is accounted."""
+    mocker.patch("storage_connector.benchmark_utils.LATENCY_SAMPLES", 10)
+    mock_summarize = mocker.spy(benchmark_utils, "summarize")
+
+    benchmark_utils.run([data_file], "sequential", 4096, 2, duration=0.05, direct=False)
+
+    latencies = mock_summarize.call_args.args[1]
+    assert len(latencies) == 10
+    assert mock_summarize.call_args.kwargs["reads"] > 10
+    assert mock_summarize.call_args.kwargs["slowest"] >= max(latencies)
+
+
+def test_run_direct(data_file):
+    """Test the reads bypass the page cache, where the filesystem supports it."""
+    try:
+        summary = benchmark_utils.run([data_file], "random", 4096, 1, 0.05)
+    except OSError as err:  # pragma: nocover
+        pytest.skip(f"O_DIRECT not supported: {err}")
+    assert summary["iops"] > 0
+
+
+@pytest.mark.parametrize(
+    "pattern, block_size, queue_depth, duration, error",
+    [
+        ("write", 4096, 1, 1, "unknown pattern write"),
+        ("random", 1000, 1, 1, "multiple of 512"),
+        ("random", 4096, 0, 1, "must be positive"),
+        ("random", 4096, 1, 0, "must be positive"),
+        ("random", 2 * 1024 * 1024, 1, 1, "smaller than the block size"),
+    ],
+    ids=["pattern", "block-size", "queue-depth", "duration", "too-small"],
+)
+def test_run_invalid(data_file, pattern, block_size, queue_depth, duration, error):
+    """Test invalid parameters are rejected."""
+    with pytest.raises(ValueError, match=error):
+        benchmark_utils.run([data_file], pattern, block_size, queue_depth, duration)
+
+
+def test_run_not_a_device(tmp_path):
+    """Test only block devices and regular files are read."""
+    with pytest.raises(ValueError, match="neither a block device nor a regular file"):
+        benchmark_utils.run([str(tmp_path)], "random", 4096, 1, 1)
+
+
+def test_run_read_error(data_file, mocker):
+    """Test read errors of the readers are raised."""
+    mocker.patch("storage_connector.benchmark_utils.os.preadv", side_effect=OSError(5, "EIO"))
+    with pytest.raises(OSError):
+        benchmark_utils.run([data_file], "sequential", 4096, 2, 1, direct=False)
+
+
+def test_summarize():
+    """Test the throughput and latency percentiles."""
+    latencies = [i / 10**6 for i in range(1, 1001)]
+
+    summary = benchmark_utils.summarize(1000 * 4096, latencies, elapsed=2)
+
+    assert summary == {
+        "mb-per-s": 2.0,
+        "iops": 500,
+        "latency-us": {"p50": 501, "p90": 901, "p99": 991, "p99.9": 1000, "max": 1000},
+    }
+
+
+def test_summarize_sample():
+    """Test the IOPS and the max latency of sampled latencies."""
+    latencies = [i / 10**6 for i in range(1, 101)]
+
+    summary = benchmark_utils.summarize(1000 * 4096, latencies, 2, reads=1000, slowest=0.005)
+
+    assert summary["iops"] == 500
+    assert summary["latency-us"]["p50"] == 51
+    assert summary["latency-us"]["max"] == 5000
+
+
+def test_summarize_no_reads():
+    """Test the latencies are omitted if nothing was read."""
+    assert benchmark_utils.summarize(0, [], elapsed=1) == {"mb-per-s": 0.0, "iops": 0}
@@ -0,0 +1,132 @@
+"""Unit tests for the block queue library."""
+
+import subprocess
+from unittest.mock import call
+
+import pytest
+from storage_connector import block_utils
+
+
+def test_parse_queue_rules():
+    """Test rules are parsed with the scheduler set first."""
+    rules = block_utils.parse_queue_rules(
+        '[{"vendor": "PURE", "product": "FlashArray", "nr_requests": 256, "scheduler": "none"},'
+        ' {"alias": "data1", "read_ahead_kb": 4096}]'
+    )
+
+    assert rules == [
+        block_utils.QueueRule(
+            "PURE", "FlashArray", None, {"scheduler": "none", "nr_requests": 256}
+        ),
+        block_utils.QueueRule(None, None, "data1", {"read_ahead_kb": 4096}),
+    ]
+    assert list(rules[0].settings) == ["scheduler", "nr_requests"]
+    assert block_utils.parse_queue_rules("") == []
+
+
+@pytest.mark.parametrize(
+    "value, error",
+    [
+        ("[", "invalid JSON"),
+        ('{"vendor": "PURE"}', "expected a list of rules"),
+        ('["PURE"]', "expected a dictionary per rule"),
+        ('[{"scheduler": "none"}]', "either a vendor"),
+        ('[{"vendor": "PURE", "alias": "data1", "scheduler": "none"}]', "either a vendor"),
+        ('[{"alias": "data1", "product": "x", "scheduler": "none"}]', "either a vendor"),
+        ('[{"vendor": "PURE"}]', "at least one queue setting"),
+        ('[{"vendor": "PURE", "scheduler": "cfq"}]', "scheduler must be one of"),
+        ('[{"vendor": "PURE", "nr_requests": "256"}]', "nr_requests must be an integer"),
+        ('[{"vendor": "PURE", "add_random": true}]', "add_random must be an integer"),
+        ('[{"vendor": "PURE", "rq_affinity": 3}]', "rq_affinity must be between 0 and 2"),
+        ('[{"vendor": "PURE", "iosched": "none"}]', "unknown queue setting iosched"),
+        ('[{"vendor": 1, "scheduler": "none"}]', "vendor must be a string"),
+        ('[{"alias": ["data1"], "scheduler": "none"}]', "alias must be a string"),
+        ('[{"vendor": "PURE\\"", "scheduler": "none"}]', "vendor must not contain quotes"),
+        ('[{"vendor": "PURE", "product": "a,b", "scheduler": "none"}]', "must not contain"),
+        ('[{"alias": "data1\\n", "scheduler": "none"}]', "alias must not contain"),
+        ('[{"alias": "data1\\\\", "scheduler": "none"}]', "alias must not contain"),
+    ],
+)
+def test_parse_queue_rules_invalid(value, error):
+    """Test malformed rules are rejected."""
+    with pytest.raises(ValueError, match=error):
+        block_utils.parse_queue_rules(value)
+
+
+def _write(path, content):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(content)
+
+
+def test_apply_queue_rules(mocker, tmp_path):
+    """Test the rules are reloaded and replayed on the devices they match only."""
+    mocker.patch("storage_connector.block_utils.SYS_BLOCK", tmp_path)
+    _write(tmp_path / "sda" / "device" / "vendor", "PURE    \n")
+    _write(tmp_path / "sda" / "device" / "model", "FlashArray      \n")
+    _write(tmp_path / "sdb" / "device" / "vendor", "QEMU    \n")
+    _write(tmp_path / "sdb" / "device" / "model", "QEMU HARDDISK   \n")
+    _write(tmp_path / "sdc" / "device" / "vendor", "PURE    \n")
+    _write(tmp_path / "sdc" / "device" / "model", "Other\n")
+    (tmp_path / "sda1").mkdir()
+    _write(tmp_path / "dm-0" / "dm" / "name", "data1\n")
+    _write(tmp_path / "dm-1" / "dm" / "name", "data2\n")
+    mock_check_call = mocker.patch("storage_connector.command_utils.subprocess.check_call")
+    rules = block_utils.parse_queue_rules(
+        '[{"vendor": "PU", "product": "Flash", "nr_requests": 256},'
+        ' {"alias": "data1", "read_ahead_kb": 4096}]'
+    )
+
+    block_utils.apply_queue_rules(rules)
+
+    assert mock_check_call.call_args_list == [
+        call(["udevadm", "control", "--reload"]),
+        call(
+            ["udevadm", "trigger", "--action=change", "--subsystem-match=block"]
+            + ["--sysname-match=sda", "--sysname-match=dm-0"]
+        ),
+    ]
+
+
+def test_apply_queue_rules_no_devices(mocker, tmp_path):
+    """Test no device is replayed when the rules match none."""
+    mocker.patch("storage_connector.block_utils.SYS_BLOCK", tmp_path)
+    mock_check_call = mocker.patch("storage_connector.command_utils.subprocess.check_call")
+
+    block_utils.apply_queue_rules([])
+
+    mock_check_call.assert_called_once_with(["udevadm", "control", "--reload"])
+
+
+def test_apply_queue_rules_error(mocker):
+    """Test udevadm errors are raised."""
+    mocker.patch(
+        "storage_connector.command_utils.subprocess.check_call",
+        side_effect=subprocess.CalledProcessError(returncode=1, cmd=["udevadm"]),
+    )
+    with pytest.raises(subprocess.CalledProcessError):
+        block_utils.apply_queue_rules([])
+
+
+def test_get_queue_settings(mocker, tmp_path):
+    """Test the queue settings are read from sysfs."""
+    mocker.patch("storage_connector.block_utils.SYS_BLOCK", tmp_path)
+    _write(tmp_path / "sda" / "device" / "vendor", "PURE    \n")
+    _write(tmp_path / "sda" / "device" / "model", "FlashArray      \n")
+    _write(tmp_path / "sda" / "queue" / "scheduler", "[none] mq-deadline\n")
+    _write(tmp_path / "sda" / "queue" / "nr_requests", "256\n")
+    _write(tmp_path / "dm-0" / "dm" / "name", "data1\n")
+    _write(tmp_path / "dm-0" / "queue" / "scheduler", "none\n")
+    _write(tmp_path / "dm-0" / "queue" / "read_ahead_kb", "4096\n")
+    _write(tmp_path / "loop0" / "queue" / "read_ahead_kb", "128\n")
+
+    settings = block_utils.get_queue_settings()
+
+    assert list(settings) == ["sda", "dm-0"]
+    assert settings["sda"]["vendor"] == "PURE"
+    assert settings["sda"]["model"] == "FlashArray"
+    assert settings["sda"]["scheduler"] == "none"
+    assert settings["sda"]["nr_requests"] == "256"
+    assert settings["sda"]["add_random"] is None
+    assert settings["dm-0"]["name"] == "data1"
+    assert settings["dm-0"]["scheduler"] == "none"
+    assert settings["dm-0"]["read_ahead_kb"] == "4096"
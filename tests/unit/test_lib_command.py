@@ -0,0 +1,110 @@
+"""Unit tests for the command accounting library."""
+
+import subprocess
+
+import pytest
+from storage_connector import command_utils, timing_utils
+
+
+@pytest.fixture
+def profile(mocker):
+    """Return the profile of a hook, as the current profile."""
+    mocker.patch("storage_connector.timing_utils._current", None)
+    return timing_utils.start("config-changed")
+
+
+@pytest.mark.parametrize(
+    "args, name",
+    [
+        (["iscsiadm", "-m", "session"], "iscsiadm"),
+        ("/sbin/iscsi-iname", "iscsi-iname"),
+        ("multipath -ll", "multipath"),
+    ],
+)
+def test_get_name(args, name):
+    """Test commands are named after their executable."""
+    assert command_utils.get_name(args) == name
+
+
+def test_check_output(mocker, profile):
+    """Test the runs of a command are totalled in the current profile."""
+    mock_check_output = mocker.patch(
+        "storage_connector.command_utils.subprocess.check_output", return_value=b"sda\n"
+    )
+
+    assert command_utils.check_output(["lsblk"], stderr=subprocess.STDOUT) == b"sda\n"
+    command_utils.check_output(["lsblk"])
+
+    mock_check_output.assert_called_with(["lsblk"])
+    assert profile.commands["lsblk"] == {
+        "count": 2,
+        "duration": mocker.ANY,
+        "failures": 0,
+        "output": 8,
+    }
+
+
+def test_check_call_failed(mocker, profile):
+    """Test failed commands are counted, and the error is raised as is."""
+    mocker.patch(
+        "storage_connector.command_utils.subprocess.check_call",
+        side_effect=subprocess.CalledProcessError(returncode=15, cmd=["iscsiadm"], output=None),
+    )
+    mock_debug = mocker.patch("storage_connector.command_utils.logger.debug")
+
+    with pytest.raises(subprocess.CalledProcessError):
+        command_utils.check_call(["iscsiadm", "-m", "node", "--login"])
+
+    assert profile.commands["iscsiadm"]["failures"] == 1
+    mock_debug.assert_called_once_with(
+        "Command %s took %.3f seconds (exit code %s)", "iscsiadm", mocker.ANY, 15
+    )
+
+
+def test_getoutput_slow(mocker, profile):
+    """Test commands slower than the threshold are logged as warnings."""
+    mocker.patch("storage_connector.command_utils.subprocess.getoutput", return_value="")
+    mocker.patch("storage_connector.command_utils.time.perf_counter", side_effect=[0.0, 12.5])
+    mocker.patch("storage_connector.command_utils._slow_threshold", 10.0)
+    mock_warning = mocker.patch("storage_connector.command_utils.logger.warning")
+
+    assert command_utils.getoutput("multipath -ll") == ""
+
+    mock_warning.assert_called_once_with(
+        "Slow command %s took %.1f seconds (exit code %s)", "multipath", 12.5, None
+    )
+    assert profile.to_dict()["commands"] == {
+        "multipath": {"count": 1, "duration": 12.5, "failures": 0, "output": 0}
+    }
+
+
+def test_set_slow_threshold(mocker):
+    """Test the slow command threshold can be changed."""
+    mocker.patch("storage_connector.command_utils._slow_threshold", 10.0)
+
+    command_utils.set_slow_threshold(2.5)
+
+    assert command_utils._slow_threshold == 2.5
+
+
+def test_slow_command_arguments_not_logged(mocker, profile):
+    """Test the arguments of slow commands, which may hold secrets, are not logged."""
+    mocker.patch("storage_connector.command_utils.subprocess.check_call")
+    mocker.patch("storage_connector.command_utils.time.perf_counter", side_effect=[0.0, 12.5])
+    mocker.patch("storage_connector.command_utils._slow_threshold", 10.0)
+    mock_warning = mocker.patch("storage_connector.command_utils.logger.warning")
+
+    command_utils.check_call(
+        ["iscsiadm", "-m", "node", "-n", "node.session.auth.password", "-v", "secret"]
+    )
+
+    assert "secret" not in str(mock_warning.call_args)
+
+
+def test_call(mocker, profile):
+    """Test the exit code of commands run with call is recorded."""
+    mocker.patch("storage_connector.command_utils.subprocess.call", return_value=1)
+
+    assert command_utils.call(["systemd-detect-virt", "--container"]) == 1
+
+    assert profile.commands["systemd-detect-virt"]["failures"] == 1
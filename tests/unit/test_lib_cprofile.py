@@ -0,0 +1,45 @@
+"""Unit tests for the hook profiling library."""
+
+import gzip
+import marshal
+
+from storage_connector import cprofile_utils
+
+
+def test_save_keeps_most_recent(tmp_path):
+    """Test the profiles are saved compressed, and only the most recent are kept."""
+    directory = tmp_path / "profiles"
+    paths = []
+    for hook in ["install", "config-changed", ""]:
+        profiler = cprofile_utils.start()
+        sorted(range(10))
+        paths.append(cprofile_utils.save(directory, profiler, hook, keep=2))
+
+    assert cprofile_utils.list_profiles(directory) == [paths[2], paths[1]]
+    assert paths[1].name.endswith("-config-changed.pstats.gz")
+    assert paths[2].name.endswith("-unknown.pstats.gz")
+    with gzip.open(paths[2], "rb") as file:
+        stats = marshal.load(file)
+    assert any(function == "<built-in method builtins.sorted>" for _, _, function in stats)
+
+
+def test_start_another_profiler_active(mocker):
+    """Test no profiler is returned if another profiler is already active."""
+    mock_profile = mocker.patch("cProfile.Profile")
+    mock_profile.return_value.enable.side_effect = ValueError("Another profiler is active")
+    mock_warning = mocker.patch("storage_connector.cprofile_utils.logger.warning")
+
+    assert cprofile_utils.start() is None
+    mock_warning.assert_called_once()
+
+
+def test_summarize(tmp_path):
+    """Test the functions with the highest cumulative time are summarized."""
+    profiler = cprofile_utils.start()
+    sorted(range(10))
+    path = cprofile_utils.save(tmp_path, profiler, "update-status", keep=1)
+
+    summary = cprofile_utils.summarize(path, 5)
+
+    assert "cumulative" in summary
+    assert "function calls" in summary
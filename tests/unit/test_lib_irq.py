@@ -0,0 +1,91 @@
+"""Unit tests for the irq affinity library."""
+
+import pytest
+from storage_connector import irq_utils
+
+
+@pytest.mark.parametrize(
+    "cpulist, expected",
+    [("0-3,8", [0, 1, 2, 3, 8]), ("5\n", [5]), ("", [])],
+    ids=["ranges", "single", "empty"],
+)
+def test_parse_cpulist(cpulist, expected):
+    """Test kernel cpu lists are expanded."""
+    assert irq_utils.parse_cpulist(cpulist) == expected
+
+
+@pytest.fixture
+def sysfs(mocker, tmp_path):
+    """Return a fake sysfs with one PCI device holding an HBA port and a NIC."""
+    device = tmp_path / "devices" / "0000:3b:00.0"
+    (device / "msi_irqs").mkdir(parents=True)
+    for irq in (120, 121, 122):
+        (device / "msi_irqs" / str(irq)).touch()
+    (device / "numa_node").write_text("1\n")
+    (device / "local_cpulist").write_text("8-9\n")
+    (device / "host5").mkdir()
+
+    fc_host = tmp_path / "fc_host"
+    (fc_host / "host5").mkdir(parents=True)
+    (fc_host / "host5" / "device").symlink_to(device / "host5")
+
+    net = tmp_path / "net"
+    (net / "ens1f0").mkdir(parents=True)
+    (net / "ens1f0" / "device").symlink_to(device)
+    (net / "bond0").mkdir()
+    (net / "bond0" / "lower_ens1f0").symlink_to(net / "ens1f0")
+    (net / "lo").mkdir()
+
+    proc_irq = tmp_path / "irq"
+    for irq in (120, 121, 122):
+        (proc_irq / str(irq)).mkdir(parents=True)
+        (proc_irq / str(irq) / "smp_affinity_list").write_text("0-15\n")
+    (proc_irq / "120" / "effective_affinity_list").write_text("3\n")
+
+    mocker.patch("storage_connector.irq_utils.SYS_CLASS_FC_HOST", fc_host)
+    mocker.patch("storage_connector.irq_utils.SYS_CLASS_NET", net)
+    mocker.patch("storage_connector.irq_utils.PROC_IRQ", proc_irq)
+    return device
+
+
+def test_get_fc_devices(sysfs):
+    """Test the HBA PCI devices are found from the fc hosts."""
+    assert irq_utils.get_fc_devices() == {"0000:3b:00.0": sysfs}
+
+
+def test_get_fc_devices_no_hba(mocker, tmp_path):
+    """Test no devices are returned without FC HBAs."""
+    mocker.patch("storage_connector.irq_utils.SYS_CLASS_FC_HOST", tmp_path / "missing")
+    assert irq_utils.get_fc_devices() == {}
+
+
+def test_get_nic_devices(sysfs):
+    """Test the PCI devices are found for NICs and through bonds."""
+    assert irq_utils.get_nic_devices(["ens1f0"]) == {"0000:3b:00.0": sysfs}
+    assert irq_utils.get_nic_devices(["bond0"]) == {"0000:3b:00.0": sysfs}
+    assert irq_utils.get_nic_devices(["lo"]) == {}
+
+
+def test_get_irqs_without_msi(tmp_path):
+    """Test devices without MSI interrupts have no irqs to manage."""
+    assert irq_utils.get_irqs(tmp_path) == []
+
+
+def test_spread_irqs(sysfs, mocker):
+    """Test the interrupts are assigned round-robin to the local CPUs."""
+    proc_irq = irq_utils.PROC_IRQ
+    (proc_irq / "122" / "smp_affinity_list").unlink()
+    (proc_irq / "122" / "smp_affinity_list").mkdir()  # writes fail like managed irqs
+
+    assert irq_utils.spread_irqs(sysfs) == {120: 8, 121: 9}
+    assert (proc_irq / "120" / "smp_affinity_list").read_text() == "8"
+    assert (proc_irq / "121" / "smp_affinity_list").read_text() == "9"
+
+
+def test_describe(sysfs):
+    """Test the NUMA node and the effective affinity are reported."""
+    assert irq_utils.describe(sysfs) == {
+        "numa-node": 1,
+        "local-cpus": "8-9",
+        "irqs": {120: "3", 121: "0-15", 122: "0-15"},
+    }
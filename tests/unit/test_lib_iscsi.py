@@ -0,0 +1,476 @@
+"""Unit tests for the iscsi library."""
+
+import subprocess
+from unittest.mock import call
+
+import pytest
+from storage_connector import iscsi_utils
+
+SESSIONS = (
+    "tcp: [1] 10.0.0.1:3260,1 iqn.2010-06.com.purestorage:flasharray.1 (non-flash)\n"
+    "tcp: [2] 10.0.0.2:3260,1 iqn.2010-06.com.purestorage:flasharray.1 (non-flash)\n"
+)
+
+
+def test_parse_iscsid_conf():
+    """Test parsing of iscsid.conf content."""
+    content = (
+        "# comment\n"
+        "\n"
+        "iscsid.startup = /bin/systemctl start iscsid.socket\n"
+        "node.conn[0].timeo.noop_out_interval = 5\n"
+    )
+    assert iscsi_utils.parse_iscsid_conf(content) == {
+        "iscsid.startup": "/bin/systemctl start iscsid.socket",
+        "node.conn[0].timeo.noop_out_interval": "5",
+    }
+
+
+@pytest.mark.parametrize(
+    "key, expected",
+    [
+        ("node.startup", iscsi_utils.DISRUPTION_NONE),
+        ("node.session.scan", iscsi_utils.DISRUPTION_NONE),
+        ("node.session.queue_depth", iscsi_utils.DISRUPTION_RELOGIN),
+        ("node.session.auth.password", iscsi_utils.DISRUPTION_RELOGIN),
+        ("iscsid.startup", iscsi_utils.DISRUPTION_RESTART),
+        ("discovery.sendtargets.iscsi.MaxRecvDataSegmentLength", iscsi_utils.DISRUPTION_RESTART),
+    ],
+)
+def test_classify_setting(key, expected):
+    """Test the disruption needed by each kind of setting."""
+    assert iscsi_utils.classify_setting(key) == expected
+
+
+def test_changed_settings():
+    """Test new, changed and removed settings are returned."""
+    old = {"node.startup": "automatic", "node.session.scan": "auto", "a": "1"}
+    new = {"node.startup": "manual", "node.session.scan": "auto", "b": "2"}
+    assert iscsi_utils.changed_settings(old, new) == {
+        "node.startup": "manual",
+        "b": "2",
+        "a": None,
+    }
+
+
+@pytest.mark.parametrize(
+    "changes, expected",
+    [
+        ({}, iscsi_utils.DISRUPTION_NONE),
+        ({"node.startup": "manual"}, iscsi_utils.DISRUPTION_NONE),
+        (
+            {"node.startup": "manual", "node.session.cmds_max": "64"},
+            iscsi_utils.DISRUPTION_RELOGIN,
+        ),
+        ({"node.session.cmds_max": "64", "iscsid.startup": "x"}, iscsi_utils.DISRUPTION_RESTART),
+        ({"node.session.auth.username": None}, iscsi_utils.DISRUPTION_RESTART),
+    ],
+)
+def test_get_disruption(changes, expected):
+    """Test the most disruptive change wins."""
+    assert iscsi_utils.get_disruption(changes) == expected
+
+
+def test_get_iscsid_tuning_defaults():
+    """Test the defaults are used if neither preset nor options are set."""
+    tuning = iscsi_utils.get_iscsid_tuning({"iscsi-tuning-preset": ""})
+    assert tuning == {
+        tunable.name: tunable.default for tunable in iscsi_utils.ISCSID_TUNABLES.values()
+    }
+
+
+def test_get_iscsid_tuning_preset_and_override():
+    """Test explicitly set options take precedence over the preset."""
+    tuning = iscsi_utils.get_iscsid_tuning(
+        {"iscsi-tuning-preset": "netapp-ontap", "iscsi-node-session-queue-depth": 64}
+    )
+    assert tuning["cmds_max"] == 1024
+    assert tuning["queue_depth"] == 64
+    assert tuning["replacement_timeout"] == 5
+    assert tuning["nr_sessions"] == 1
+
+
+def test_get_iscsid_tuning_array_preset():
+    """Test the array preset is used unless iscsi-tuning-preset is set."""
+    tuning = iscsi_utils.get_iscsid_tuning({"iscsi-tuning-preset": "", "array-preset": "hpe-3par"})
+    assert tuning["replacement_timeout"] == 10
+
+    tuning = iscsi_utils.get_iscsid_tuning(
+        {"iscsi-tuning-preset": "pure", "array-preset": "hpe-3par"}
+    )
+    assert tuning["replacement_timeout"] == 20
+
+
+@pytest.mark.parametrize(
+    "config, error",
+    [
+        ({"iscsi-tuning-preset": "unknown"}, "unknown preset unknown"),
+        ({"iscsi-node-session-queue-depth": 0}, "must be between 1 and 1024"),
+        ({"iscsi-node-session-cmds-max": 4096}, "must be between 2 and 2048"),
+        ({"iscsi-node-session-cmds-max": 100}, "must be a power of 2"),
+        (
+            {
+                "iscsi-node-session-iscsi-first-burst-length": 65536,
+                "iscsi-node-session-iscsi-max-burst-length": 8192,
+            },
+            "must not exceed",
+        ),
+    ],
+    ids=["preset", "minimum", "maximum", "power-of-2", "burst-length"],
+)
+def test_get_iscsid_tuning_invalid(config, error):
+    """Test invalid presets and values are rejected."""
+    with pytest.raises(ValueError, match=error):
+        iscsi_utils.get_iscsid_tuning(config)
+
+
+def test_update_node_settings(mocker):
+    """Test settings are updated on all node records."""
+    mock_check_call = mocker.patch("storage_connector.iscsi_utils.subprocess.check_call")
+
+    iscsi_utils.update_node_settings({"node.startup": "manual"})
+
+    mock_check_call.assert_called_once_with(
+        ["iscsiadm", "-m", "node", "-o", "update", "-n", "node.startup", "-v", "manual"]
+    )
+
+
+def test_update_node_settings_no_records(mocker):
+    """Test having no node records at all leaves nothing to update."""
+    mock_check_call = mocker.patch(
+        "storage_connector.iscsi_utils.subprocess.check_call",
+        side_effect=subprocess.CalledProcessError(21, ["iscsiadm"]),
+    )
+
+    iscsi_utils.update_node_settings({"node.startup": "manual", "node.session.scan": "auto"})
+
+    mock_check_call.assert_called_once()
+    with pytest.raises(subprocess.CalledProcessError):
+        iscsi_utils.update_node_settings({"node.startup": "manual"}, target="iqn.2024-01.test:t1")
+
+    mock_check_call.side_effect = subprocess.CalledProcessError(1, ["iscsiadm"])
+    with pytest.raises(subprocess.CalledProcessError):
+        iscsi_utils.update_node_settings({"node.startup": "manual"})
+
+
+def test_update_node_settings_of_target(mocker):
+    """Test settings are updated on the node records of a target and portal only."""
+    mock_check_call = mocker.patch("storage_connector.iscsi_utils.subprocess.check_call")
+
+    iscsi_utils.update_node_settings(
+        {"node.session.queue_depth": "128"}, target="iqn.2024-01.test:t1", portal="10.0.0.1"
+    )
+
+    mock_check_call.assert_called_once_with(
+        ["iscsiadm", "-m", "node", "-T", "iqn.2024-01.test:t1", "-p", "10.0.0.1"]
+        + ["-o", "update", "-n", "node.session.queue_depth", "-v", "128"]
+    )
+
+
+def test_parse_target_overrides():
+    """Test values are converted to the strings iscsiadm expects."""
+    overrides = iscsi_utils.parse_target_overrides(
+        '{"iqn.2024-01.test:t1": {"node.session.queue_depth": 128,'
+        ' "node.session.iscsi.FastAbort": false}}'
+    )
+    assert overrides == {
+        "iqn.2024-01.test:t1": {
+            "node.session.queue_depth": "128",
+            "node.session.iscsi.FastAbort": "No",
+        }
+    }
+    assert iscsi_utils.parse_target_overrides("") == {}
+
+
+@pytest.mark.parametrize(
+    "value, error",
+    [
+        ("{", "invalid JSON"),
+        ('["iqn.2024-01.test:t1"]', "expected a dictionary"),
+        ('{"10.0.0.1": 128}', "expected a dictionary"),
+        ('{"10.0.0.1": {"iscsid.startup": "x"}}', "iscsid.startup of 10.0.0.1 is not a node"),
+        ('{"10.0.0.1": {"node.session.queue_depth": null}}', "invalid value"),
+    ],
+    ids=["json", "list", "settings", "not-node-setting", "value"],
+)
+def test_parse_target_overrides_invalid(value, error):
+    """Test malformed overrides are rejected."""
+    with pytest.raises(ValueError, match=error):
+        iscsi_utils.parse_target_overrides(value)
+
+
+def test_apply_target_overrides(mocker):
+    """Test overrides are applied per target or portal and removed ones are reset."""
+    mock_update = mocker.patch(
+        "storage_connector.iscsi_utils.update_node_settings",
+        side_effect=[None, subprocess.CalledProcessError(returncode=21, cmd=["iscsiadm"])],
+    )
+    old = {"10.0.0.1:3260": {"node.session.queue_depth": "128", "node.custom": "1"}}
+    new = {"iqn.2024-01.test:t1": {"node.session.queue_depth": "64"}}
+
+    iscsi_utils.apply_target_overrides(old, new, {"node.session.queue_depth": "32"})
+
+    mock_update.assert_has_calls(
+        [
+            call({"node.session.queue_depth": "32"}, portal="10.0.0.1:3260"),
+            call({"node.session.queue_depth": "64"}, target="iqn.2024-01.test:t1"),
+        ]
+    )
+
+
+def test_apply_target_overrides_error(mocker):
+    """Test errors other than missing node records are raised."""
+    mocker.patch(
+        "storage_connector.iscsi_utils.update_node_settings",
+        side_effect=subprocess.CalledProcessError(returncode=1, cmd=["iscsiadm"]),
+    )
+    with pytest.raises(subprocess.CalledProcessError):
+        iscsi_utils.apply_target_overrides({}, {"10.0.0.1": {"node.startup": "manual"}}, {})
+
+
+def test_get_sessions(mocker):
+    """Test parsing of the active sessions."""
+    mocker.patch(
+        "storage_connector.iscsi_utils.subprocess.check_output", return_value=SESSIONS.encode()
+    )
+
+    sessions = iscsi_utils.get_sessions()
+
+    assert sessions == [
+        iscsi_utils.Session(
+            "tcp", "1", "10.0.0.1:3260", "1", "iqn.2010-06.com.purestorage:flasharray.1"
+        ),
+        iscsi_utils.Session(
+            "tcp", "2", "10.0.0.2:3260", "1", "iqn.2010-06.com.purestorage:flasharray.1"
+        ),
+    ]
+
+
+def test_get_sessions_no_sessions(mocker):
+    """Test no sessions are returned when iscsiadm finds none."""
+    mocker.patch(
+        "storage_connector.iscsi_utils.subprocess.check_output",
+        side_effect=subprocess.CalledProcessError(returncode=21, cmd=["iscsiadm"]),
+    )
+    assert iscsi_utils.get_sessions() == []
+
+
+def test_get_sessions_error(mocker):
+    """Test other iscsiadm errors are raised."""
+    mocker.patch(
+        "storage_connector.iscsi_utils.subprocess.check_output",
+        side_effect=subprocess.CalledProcessError(returncode=1, cmd=["iscsiadm"]),
+    )
+    with pytest.raises(subprocess.CalledProcessError):
+        iscsi_utils.get_sessions()
+
+
+def test_rolling_relogin(mocker):
+    """Test sessions are relogged one portal at a time, waiting for the paths."""
+    mocker.patch(
+        "storage_connector.iscsi_utils.subprocess.check_output", return_value=SESSIONS.encode()
+    )
+    mock_sleep = mocker.patch("storage_connector.iscsi_utils.time.sleep")
+    mock_check_call = mocker.patch("storage_connector.iscsi_utils.subprocess.check_call")
+    # 4 paths before each portal, paths of the first portal take one retry to come back
+    count_active_paths = mocker.Mock(side_effect=[4, 2, 4, 4, 4])
+
+    iscsi_utils.rolling_relogin(count_active_paths, timeout=10)
+
+    assert count_active_paths.call_count == 5
+    mock_sleep.assert_called_once_with(1)
+
+    target = "iqn.2010-06.com.purestorage:flasharray.1"
+    mock_check_call.assert_has_calls(
+        [
+            call(["iscsiadm", "-m", "node", "-T", target, "-p", "10.0.0.1:3260", "--logout"]),
+            call(["iscsiadm", "-m", "node", "-T", target, "-p", "10.0.0.1:3260", "--login"]),
+            call(["iscsiadm", "-m", "node", "-T", target, "-p", "10.0.0.2:3260", "--logout"]),
+            call(["iscsiadm", "-m", "node", "-T", target, "-p", "10.0.0.2:3260", "--login"]),
+        ]
+    )
+
+
+def test_rolling_relogin_several_sessions_per_portal(mocker):
+    """Test the sessions to a target via a portal are relogged once, not once each."""
+    sessions = (
+        "tcp: [1] 10.0.0.1:3260,1 iqn.2010-06.com.purestorage:flasharray.1 (non-flash)\n"
+        "tcp: [2] 10.0.0.1:3260,1 iqn.2010-06.com.purestorage:flasharray.1 (non-flash)\n"
+    )
+    mocker.patch(
+        "storage_connector.iscsi_utils.subprocess.check_output", return_value=sessions.encode()
+    )
+    mock_check_call = mocker.patch("storage_connector.iscsi_utils.subprocess.check_call")
+    count_active_paths = mocker.Mock(return_value=4)
+
+    iscsi_utils.rolling_relogin(count_active_paths, timeout=10)
+
+    target = "iqn.2010-06.com.purestorage:flasharray.1"
+    assert mock_check_call.call_args_list == [
+        call(["iscsiadm", "-m", "node", "-T", target, "-p", "10.0.0.1:3260", "--logout"]),
+        call(["iscsiadm", "-m", "node", "-T", target, "-p", "10.0.0.1:3260", "--login"]),
+    ]
+
+
+def test_rolling_relogin_timeout(mocker):
+    """Test the relogin stops if the paths of a portal do not come back."""
+    mocker.patch(
+        "storage_connector.iscsi_utils.subprocess.check_output", return_value=SESSIONS.encode()
+    )
+    mocker.patch("storage_connector.iscsi_utils.time.sleep")
+    mocker.patch("storage_connector.iscsi_utils.time.monotonic", side_effect=[0, 5, 11])
+    mock_check_call = mocker.patch("storage_connector.iscsi_utils.subprocess.check_call")
+    count_active_paths = mocker.Mock(side_effect=[4, 2, 2, 2])
+
+    with pytest.raises(TimeoutError):
+        iscsi_utils.rolling_relogin(count_active_paths, timeout=10)
+
+    # second portal is left untouched
+    assert mock_check_call.call_count == 2
+
+
+IP_ADDR = b"""\
+1: lo    inet 127.0.0.1/8 scope host lo\\       valid_lft forever preferred_lft forever
+2: ens1f0    inet 10.0.0.5/24 brd 10.0.0.255 scope global ens1f0\\       valid_lft forever
+3: ens1f1    inet6 fd00::5/64 scope global \\       valid_lft forever preferred_lft forever
+"""
+
+
+def test_resolve_iface_bindings(mocker, tmp_path):
+    """Test NICs are used as-is and IP addresses are resolved to their NIC."""
+    mocker.patch("storage_connector.iscsi_utils.SYS_CLASS_NET", tmp_path)
+    (tmp_path / "ens2f0").mkdir()
+    mocker.patch("storage_connector.iscsi_utils.subprocess.check_output", return_value=IP_ADDR)
+
+    ifaces = iscsi_utils.resolve_iface_bindings("ens2f0 10.0.0.5 fd00::5")
+
+    assert ifaces == {
+        "storage-connector-ens2f0": "ens2f0",
+        "storage-connector-10.0.0.5": "ens1f0",
+        "storage-connector-fd00::5": "ens1f1",
+    }
+
+
+@pytest.mark.parametrize(
+    "bindings, error",
+    [("ens9", "no network interface ens9"), ("10.0.0.9", "no network interface with address")],
+    ids=["nic", "address"],
+)
+def test_resolve_iface_bindings_invalid(mocker, tmp_path, bindings, error):
+    """Test unknown NICs and addresses are rejected."""
+    mocker.patch("storage_connector.iscsi_utils.SYS_CLASS_NET", tmp_path)
+    mocker.patch("storage_connector.iscsi_utils.subprocess.check_output", return_value=IP_ADDR)
+
+    with pytest.raises(ValueError, match=error):
+        iscsi_utils.resolve_iface_bindings(bindings)
+
+
+def test_resolve_iface_bindings_empty():
+    """Test no ifaces are managed without bindings."""
+    assert iscsi_utils.resolve_iface_bindings(None) == {}
+
+
+IFACES = b"""\
+default tcp,<empty>,<empty>,<empty>,<empty>
+iser iser,<empty>,<empty>,<empty>,<empty>
+storage-connector-ens1f0 tcp,<empty>,<empty>,ens1f0,<empty>
+storage-connector-ens1f1 tcp,<empty>,<empty>,ens1f1,<empty>
+"""
+
+
+def test_get_managed_ifaces(mocker):
+    """Test only the ifaces created by the charm are returned."""
+    mocker.patch("storage_connector.iscsi_utils.subprocess.check_output", return_value=IFACES)
+    assert iscsi_utils.get_managed_ifaces() == [
+        "storage-connector-ens1f0",
+        "storage-connector-ens1f1",
+    ]
+
+
+def test_configure_ifaces(mocker):
+    """Test ifaces are created, updated and removed."""
+    mocker.patch("storage_connector.iscsi_utils.subprocess.check_output", return_value=IFACES)
+    mock_check_call = mocker.patch(
+        "storage_connector.iscsi_utils.subprocess.check_call",
+        side_effect=[
+            subprocess.CalledProcessError(returncode=21, cmd=["iscsiadm"]),  # no session
+            None,
+            None,
+            None,
+            None,
+            None,
+        ],
+    )
+
+    iscsi_utils.configure_ifaces(
+        {"storage-connector-ens1f0": "ens1f0", "storage-connector-ens2f0": "ens2f0"}
+    )
+
+    removed = "storage-connector-ens1f1"
+    mock_check_call.assert_has_calls(
+        [
+            call(["iscsiadm", "-m", "node", "-I", removed, "--logout"]),
+            call(["iscsiadm", "-m", "node", "-I", removed, "-o", "delete"]),
+            call(["iscsiadm", "-m", "iface", "-I", removed, "-o", "delete"]),
+            call(
+                [
+                    "iscsiadm",
+                    "-m",
+                    "iface",
+                    "-I",
+                    "storage-connector-ens1f0",
+                    "-o",
+                    "update",
+                    "-n",
+                    "iface.net_ifacename",
+                    "-v",
+                    "ens1f0",
+                ]
+            ),
+            call(["iscsiadm", "-m", "iface", "-I", "storage-connector-ens2f0", "-o", "new"]),
+            call(
+                [
+                    "iscsiadm",
+                    "-m",
+                    "iface",
+                    "-I",
+                    "storage-connector-ens2f0",
+                    "-o",
+                    "update",
+                    "-n",
+                    "iface.net_ifacename",
+                    "-v",
+                    "ens2f0",
+                ]
+            ),
+        ]
+    )
+
+
+@pytest.mark.parametrize("failing_call", [0, 1], ids=["logout", "delete"])
+def test_configure_ifaces_remove_error(mocker, failing_call):
+    """Test errors other than missing sessions or node records are raised."""
+    mocker.patch("storage_connector.iscsi_utils.subprocess.check_output", return_value=IFACES)
+    side_effect = [None, None]
+    side_effect[failing_call] = subprocess.CalledProcessError(returncode=1, cmd=["iscsiadm"])
+    mocker.patch("storage_connector.iscsi_utils.subprocess.check_call", side_effect=side_effect)
+
+    with pytest.raises(subprocess.CalledProcessError):
+        iscsi_utils.configure_ifaces({"storage-connector-ens1f0": "ens1f0"})
+
+
+@pytest.mark.parametrize(
+    "output, expected",
+    [
+        (b"10.0.0.1 dev ens1f0 src 10.0.0.5 uid 0 \n    cache \n", "ens1f0"),
+        (b"local 127.0.0.1 uid 0\n", None),
+    ],
+    ids=["routed", "no-device"],
+)
+def test_get_route_interface(mocker, output, expected):
+    """Test the interface is read from the route to the address."""
+    mock_check_output = mocker.patch(
+        "storage_connector.iscsi_utils.subprocess.check_output", return_value=output
+    )
+    assert iscsi_utils.get_route_interface("10.0.0.1") == expected
+    mock_check_output.assert_called_once_with(["ip", "route", "get", "10.0.0.1"])
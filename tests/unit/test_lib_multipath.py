@@ -0,0 +1,272 @@
+"""Unit tests for the multipath library."""
+
+from unittest.mock import call
+
+import pytest
+from storage_connector import iscsi_utils, multipath_utils
+
+PATHS = b"sda active ready\nsdb failed faulty\nsdc active ghost\nsdd active ready\n\n"
+
+
+def test_get_paths(mocker):
+    """Test parsing of the paths known by multipathd."""
+    mock_check_output = mocker.patch(
+        "storage_connector.command_utils.subprocess.check_output", return_value=PATHS
+    )
+
+    paths = multipath_utils.get_paths()
+
+    mock_check_output.assert_called_once_with(
+        ["multipathd", "show", "paths", "raw", "format", "%d %t %T"]
+    )
+    assert paths[1] == multipath_utils.Path("sdb", "failed", "faulty")
+    assert len(paths) == 4
+
+
+def test_count_active_paths(mocker):
+    """Test only active and ready paths are counted."""
+    mocker.patch("storage_connector.command_utils.subprocess.check_output", return_value=PATHS)
+    assert multipath_utils.count_active_paths() == 2
+
+
+TOPOLOGY = b"""\
+data1 (3624a93701c0d5bb8a2a64e5a00011111) dm-3 PURE,FlashArray
+size=1.0G features='0' hwhandler='1 alua' wp=rw
+|-+- policy='service-time 0' prio=50 status=active
+| |- 1:0:0:1 sdb 8:16 active ready running
+| `- 2:0:0:1 sdd 8:48 active ready running
+`-+- policy='service-time 0' prio=10 status=enabled
+  `- 1:0:1:1 sdc 8:32 active ready running
+"""
+
+
+def test_get_path_groups(mocker):
+    """Test the path groups are parsed from the topology of the map."""
+    mock_check_output = mocker.patch(
+        "storage_connector.command_utils.subprocess.check_output", return_value=TOPOLOGY
+    )
+
+    groups = multipath_utils.get_path_groups("data1")
+
+    mock_check_output.assert_called_once_with(["multipath", "-ll", "data1"])
+    assert groups == [
+        multipath_utils.PathGroup("service-time 0", 50, "active", ["sdb", "sdd"]),
+        multipath_utils.PathGroup("service-time 0", 10, "enabled", ["sdc"]),
+    ]
+
+
+def test_get_path_groups_old_format(mocker, multipath_topology):
+    """Test the path groups are parsed from the older topology format."""
+    mocker.patch(
+        "storage_connector.command_utils.subprocess.check_output",
+        return_value=multipath_topology.encode(),
+    )
+
+    assert multipath_utils.get_path_groups("diskname") == [
+        multipath_utils.PathGroup("round-robin 0", 100, "active", ["sda", "sdd"]),
+        multipath_utils.PathGroup("round-robin 0", 20, "enabled", ["sdb", "sdc"]),
+    ]
+
+
+def test_get_map_wwid(mocker):
+    """Test the WWID of a map is looked up by alias."""
+    mocker.patch(
+        "storage_connector.command_utils.subprocess.check_output",
+        return_value=b"data1 3624a9370\ndata2 3624a9371\n",
+    )
+    assert multipath_utils.get_map_wwid("data2") == "3624a9371"
+    assert multipath_utils.get_map_wwid("data3") is None
+
+
+def test_reconfigure(mocker):
+    """Test multipathd is reconfigured."""
+    mock_check_call = mocker.patch("storage_connector.command_utils.subprocess.check_call")
+    multipath_utils.reconfigure()
+    mock_check_call.assert_called_once_with(["multipathd", "reconfigure"])
+
+
+def test_parse_section():
+    """Test parsing of the multipath.conf sections."""
+    assert multipath_utils.parse_section(
+        "defaults", {"find_multipaths": True, "polling_interval": 5}
+    ) == {
+        "find_multipaths": "yes",
+        "polling_interval": "5",
+    }
+    assert multipath_utils.parse_section(
+        "devices", {"vendor": "PURE", "product": "FlashArray"}
+    ) == [{"vendor": "PURE", "product": "FlashArray"}]
+    assert multipath_utils.parse_section(
+        "blacklist", [{"devnode": "^sd[a-b]$"}, {"vendor": "QEMU", "product": "*"}]
+    ) == [{"devnode": "^sd[a-b]$"}, {"device": {"vendor": "QEMU", "product": "*"}}]
+
+
+@pytest.mark.parametrize(
+    "section, data",
+    [
+        ("defaults", {"reassign_maps": "no", "multipath_dir": "/lib/multipath"}),
+        ("defaults", {"hw_str_match": "no", "ignore_new_boot_devs": "no"}),
+        ("devices", {"vendor": "PURE", "product": "*", "pg_timeout": "none"}),
+    ],
+)
+def test_parse_section_older_keywords(section, data):
+    """Test the keywords of the older multipath-tools releases are accepted."""
+    assert multipath_utils.parse_section(section, data)
+
+
+@pytest.mark.parametrize(
+    "section, data, error",
+    [
+        ("defaults", ["yes"], "defaults entries must be dictionaries"),
+        ("defaults", {"Bad Key": "1"}, "invalid keyword Bad Key in defaults"),
+        ("devices", [{"vendor": "PURE", "features": [0]}], "invalid value of features"),
+        ("devices", [{"vendor": "PURE"}], "devices entries need a vendor and a product"),
+        ("defaults", {"user_friendly_name": "yes"}, "invalid keyword user_friendly_name"),
+        ("devices", {"vendor": "PURE", "product": "*", "alias": "x"}, "invalid keyword alias"),
+        ("blacklist", {"vendor": "QEMU", "wwid": ".*"}, "only match on vendor"),
+        ("blacklist_exceptions", {}, "entries need a vendor or any of wwid"),
+        ("blacklist", {"wwid": ".*", "no_path_retry": 1}, "invalid keyword no_path_retry"),
+    ],
+)
+def test_parse_section_invalid(section, data, error):
+    """Test invalid multipath.conf entries are rejected."""
+    with pytest.raises(ValueError, match=error):
+        multipath_utils.parse_section(section, data)
+
+
+def test_get_maps(mocker):
+    """Test parsing of the maps known by multipathd."""
+    mocker.patch(
+        "storage_connector.command_utils.subprocess.check_output",
+        return_value=b"data1 3600a\nmpatha 3600b\n",
+    )
+    assert multipath_utils.get_maps() == {"data1": "3600a", "mpatha": "3600b"}
+    assert multipath_utils.get_map_wwid("mpatha") == "3600b"
+    assert multipath_utils.get_map_wwid("data2") is None
+
+
+def test_apply_map_changes(mocker):
+    """Test only the maps affected by the multipaths changes are updated."""
+    mocker.patch(
+        "storage_connector.command_utils.subprocess.check_output",
+        return_value=b"data1 3600a\nmpatha 3600b\nmpathc 3600c\nold 3600d\n",
+    )
+    mock_check_call = mocker.patch("storage_connector.command_utils.subprocess.check_call")
+
+    updated = multipath_utils.apply_map_changes(
+        {"3600a": "data1", "3600c": "data3", "3600d": "old"},
+        {"3600a": "data1", "3600b": "data2", "3600c": "data3", "3600e": "data5"},
+    )
+
+    # 3600b is new, 3600c does not have its alias yet, 3600d was removed and
+    # 3600e has no map yet
+    assert updated == ["3600b", "3600c", "3600d", "3600e"]
+    assert mock_check_call.call_args_list[:2] == [
+        call(["multipath", "3600b"]),
+        call(["multipathd", "add", "map", "3600b"]),
+    ]
+    assert mock_check_call.call_count == 8
+
+
+def test_get_map_changes(mocker):
+    """Test the affected maps are found without changing them."""
+    mocker.patch(
+        "storage_connector.command_utils.subprocess.check_output",
+        return_value=b"data1 3600a\nmpathc 3600c\n",
+    )
+    mock_check_call = mocker.patch("storage_connector.command_utils.subprocess.check_call")
+
+    assert multipath_utils.get_map_changes(
+        {"3600a": "data1", "3600c": "data3"}, {"3600a": "data1", "3600c": "data3"}
+    ) == ["3600c"]
+    mock_check_call.assert_not_called()
+
+
+def test_presets():
+    """Test every array preset is valid and has matching iscsid values."""
+    assert set(multipath_utils.MULTIPATH_PRESETS) == set(iscsi_utils.ISCSID_PRESETS)
+    for preset in multipath_utils.MULTIPATH_PRESETS.values():
+        assert multipath_utils.parse_section("devices", preset) == [preset]
+
+
+def test_apply_preset():
+    """Test entries of the preset array override the preset, others are kept."""
+    devices = multipath_utils.apply_preset(
+        "pure",
+        [
+            {"vendor": "NETAPP", "product": "LUN"},
+            {"vendor": "PURE", "product": "FlashArray", "no_path_retry": "queue"},
+        ],
+    )
+    assert devices == [
+        {**multipath_utils.MULTIPATH_PRESETS["pure"], "no_path_retry": "queue"},
+        {"vendor": "NETAPP", "product": "LUN"},
+    ]
+    assert multipath_utils.MULTIPATH_PRESETS["pure"]["no_path_retry"] == "0"
+
+    with pytest.raises(ValueError, match="unknown preset acme, valid presets are pure, "):
+        multipath_utils.apply_preset("acme", [])
+
+
+def test_parse_wwids():
+    """Test parsing of the managed WWIDs."""
+    assert multipath_utils.parse_wwids(["3600a", "3600b"]) == {"3600a": None, "3600b": None}
+    assert multipath_utils.parse_wwids({"3600a": "data1", "3600b": None}) == {
+        "3600a": "data1",
+        "3600b": None,
+    }
+
+
+@pytest.mark.parametrize(
+    "data, error",
+    [
+        ("3600a", "expected a list of WWIDs"),
+        (["3600 a"], "invalid WWID 3600 a"),
+        ({"3600a": "data 1"}, "invalid alias data 1 of 3600a"),
+        ({"3600a": 1}, "invalid alias 1 of 3600a"),
+        ({"3600a": "data1", "3600b": "data1"}, "alias data1 is used more than once"),
+    ],
+)
+def test_parse_wwids_invalid(data, error):
+    """Test invalid managed WWIDs are rejected."""
+    with pytest.raises(ValueError, match=error):
+        multipath_utils.parse_wwids(data)
+
+
+def test_render_wwids_and_bindings():
+    """Test the wwids and bindings files are sorted and parsed back."""
+    wwids = multipath_utils.render_wwids(["3600b", "3600a"])
+    assert wwids.endswith("# Valid WWIDs:\n/3600a/\n/3600b/\n")
+
+    bindings = multipath_utils.render_bindings({"3600a": "mpathb", "3600b": "mpatha"})
+    assert bindings.startswith("# Multipath bindings, Version : 1.0\n")
+    assert bindings.endswith("#\nmpatha 3600b\nmpathb 3600a\n")
+    assert multipath_utils.parse_bindings(bindings + "data1 3600c # comment\n") == {
+        "3600a": "mpathb",
+        "3600b": "mpatha",
+        "3600c": "data1",
+    }
+
+
+def test_write_atomic(tmp_path):
+    """Test files are replaced with the given mode, only if their content changed."""
+    path = tmp_path / "wwids"
+
+    assert multipath_utils.write_atomic(str(path), "/3600a/\n")
+    assert path.read_text() == "/3600a/\n"
+    assert path.stat().st_mode & 0o777 == 0o600
+    inode = path.stat().st_ino
+
+    assert not multipath_utils.write_atomic(str(path), "/3600a/\n")
+    assert path.stat().st_ino == inode
+    assert multipath_utils.write_atomic(str(path), "/3600b/\n", mode=0o644)
+    assert path.stat().st_mode & 0o777 == 0o644
+    assert [entry.name for entry in tmp_path.iterdir()] == ["wwids"]
+
+
+def test_write_atomic_cleans_up_upon_error(mocker, tmp_path):
+    """Test the temporary file is removed if the file cannot be replaced."""
+    mocker.patch("storage_connector.multipath_utils.os.replace", side_effect=OSError)
+    with pytest.raises(OSError):
+        multipath_utils.write_atomic(str(tmp_path / "bindings"), "")
+    assert not list(tmp_path.iterdir())
@@ -0,0 +1,126 @@
+"""Unit tests for the reconciler library."""
+
+from unittest.mock import MagicMock
+
+import pytest
+from storage_connector import reconcile_utils
+from storage_connector.reconcile_utils import Operation, Resource
+
+
+def make_resource(name, inputs, observed=True, result=None, depends=()):
+    """Return a resource with mocked observe and apply functions."""
+    return Resource(
+        name,
+        lambda: inputs,
+        MagicMock(return_value=result),
+        MagicMock(return_value=observed),
+        depends,
+    )
+
+
+def test_digest():
+    """Test digests do not depend on the order of the keys."""
+    assert reconcile_utils.digest({"a": 1, "b": [2]}) == reconcile_utils.digest({"b": [2], "a": 1})
+    assert reconcile_utils.digest({"a": 1}) != reconcile_utils.digest({"a": 2})
+
+
+def test_sort_resources():
+    """Test dependencies come first, else the declaration order is kept."""
+    first = Resource("first", dict, dict, depends=("third",))
+    second = Resource("second", dict, dict)
+    third = Resource("third", dict, dict)
+    assert reconcile_utils.sort_resources([first, second, third]) == [third, first, second]
+
+
+@pytest.mark.parametrize(
+    "resources, error",
+    [
+        ([Resource("a", dict, dict, depends=("b",))], "unknown dependency b of a"),
+        (
+            [Resource("a", dict, dict, depends=("b",)), Resource("b", dict, dict, depends=("a",))],
+            "circular dependency on a",
+        ),
+    ],
+)
+def test_sort_resources_invalid(resources, error):
+    """Test unknown and circular dependencies are rejected."""
+    with pytest.raises(ValueError, match=error):
+        reconcile_utils.sort_resources(resources)
+
+
+def test_reconcile():
+    """Test only changed and drifted resources and their dependents are applied."""
+    files = make_resource("files", {"option": 1})
+    service = make_resource("service", {}, depends=("files",))
+    maps = make_resource("maps", {"alias": "data1"}, observed=False)
+    queues = make_resource("queues", {"rules": []})
+    digests = {
+        "files": "outdated",
+        "service": reconcile_utils.digest({}),
+        "maps": reconcile_utils.digest({"alias": "data1"}),
+        "queues": reconcile_utils.digest({"rules": []}),
+    }
+
+    pending = reconcile_utils.get_pending([files, service, maps, queues], digests)
+    assert [(resource.name, reason) for resource, reason in pending] == [
+        ("files", reconcile_utils.REASON_INPUTS),
+        ("service", reconcile_utils.REASON_DEPENDENCY),
+        ("maps", reconcile_utils.REASON_DRIFT),
+    ]
+
+    applied = reconcile_utils.reconcile([files, service, maps, queues], digests)
+
+    assert applied == ["files", "service", "maps"]
+    assert digests["files"] == reconcile_utils.digest({"option": 1})
+    queues.apply.assert_not_called()
+    queues.observe.assert_called()
+
+
+def test_reconcile_stops_upon_failure():
+    """Test resources after a failed one are left pending."""
+    files = make_resource("files", {"option": 1}, result=False)
+    service = make_resource("service", {})
+    digests = {}
+
+    assert reconcile_utils.reconcile([files, service], digests) == []
+    assert digests == {}
+    service.apply.assert_not_called()
+
+
+def test_plan():
+    """Test the operations of the pending resources are planned without applying them."""
+    operations = [
+        Operation("write", "iscsid.conf", reconcile_utils.DISRUPTION_NONE),
+        Operation("restart", "iscsid", reconcile_utils.DISRUPTION_RESTART),
+    ]
+    iscsi = make_resource("iscsi", {"option": 1})._replace(plan=MagicMock(return_value=operations))
+    queues = make_resource("queues", {"rules": []}, depends=("iscsi",))
+    digests = {"queues": reconcile_utils.digest({"rules": []})}
+
+    steps = reconcile_utils.plan([iscsi, queues], digests)
+
+    assert steps == [
+        ("iscsi", reconcile_utils.REASON_INPUTS, operations),
+        (
+            "queues",
+            reconcile_utils.REASON_DEPENDENCY,
+            [Operation("apply", "queues", reconcile_utils.DISRUPTION_NONE)],
+        ),
+    ]
+    iscsi.apply.assert_not_called()
+    queues.apply.assert_not_called()
+    assert digests == {"queues": reconcile_utils.digest({"rules": []})}
+
+
+def test_get_disruption():
+    """Test the most disruptive class of the operations is returned."""
+    assert reconcile_utils.get_disruption([]) == reconcile_utils.DISRUPTION_NONE
+    assert (
+        reconcile_utils.get_disruption(
+            [
+                Operation("relogin", "sessions", reconcile_utils.DISRUPTION_RELOGIN),
+                Operation("reload", "multipathd", reconcile_utils.DISRUPTION_RELOAD),
+            ]
+        )
+        == reconcile_utils.DISRUPTION_RELOGIN
+    )
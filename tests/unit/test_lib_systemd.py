@@ -0,0 +1,157 @@
+"""Unit tests for the systemd library."""
+
+from datetime import datetime
+
+import pytest
+from storage_connector import systemd_utils
+
+
+@pytest.mark.parametrize("function", ["enable", "restart", "reload"])
+def test_batched_operations(mocker, function):
+    """Test that all services are handled by a single systemctl call."""
+    mock_check_call = mocker.patch("storage_connector.command_utils.subprocess.check_call")
+
+    getattr(systemd_utils, function)(["iscsid", "open-iscsi"])
+
+    mock_check_call.assert_called_once_with(["systemctl", function, "iscsid", "open-iscsi"])
+
+
+def test_operation_without_services(mocker):
+    """Test that systemctl is not run without services."""
+    mock_check_call = mocker.patch("storage_connector.command_utils.subprocess.check_call")
+
+    systemd_utils.restart([])
+
+    mock_check_call.assert_not_called()
+
+
+def test_show(mocker):
+    """Test reading properties of several services at once."""
+    mock_check_output = mocker.patch(
+        "storage_connector.command_utils.subprocess.check_output",
+        return_value=(
+            b"ActiveState=active\nActiveEnterTimestamp=Mon 2024-01-01 10:00:00 UTC\n\n"
+            b"ActiveState=inactive\nActiveEnterTimestamp=\n"
+        ),
+    )
+
+    result = systemd_utils.show(["iscsid", "open-iscsi"], ["ActiveState", "ActiveEnterTimestamp"])
+
+    mock_check_output.assert_called_once_with(
+        [
+            "systemctl",
+            "show",
+            "iscsid",
+            "open-iscsi",
+            "--property=ActiveState,ActiveEnterTimestamp",
+        ]
+    )
+    assert result == {
+        "iscsid": {
+            "ActiveState": "active",
+            "ActiveEnterTimestamp": "Mon 2024-01-01 10:00:00 UTC",
+        },
+        "open-iscsi": {"ActiveState": "inactive", "ActiveEnterTimestamp": ""},
+    }
+
+
+def test_show_without_services(mocker):
+    """Test that systemctl is not run without services."""
+    mock_check_output = mocker.patch("storage_connector.command_utils.subprocess.check_output")
+
+    assert systemd_utils.show([], ["ActiveState"]) == {}
+    mock_check_output.assert_not_called()
+
+
+def test_get_start_times(mocker):
+    """Test parsing of the services' start times."""
+    mocker.patch(
+        "storage_connector.command_utils.subprocess.check_output",
+        return_value=b"ActiveEnterTimestamp=Mon 2024-01-01 10:00:00 UTC\n\nActiveEnterTimestamp=\n",
+    )
+
+    assert systemd_utils.get_start_times(["iscsid", "open-iscsi"]) == {
+        "iscsid": datetime(2024, 1, 1, 10, 0, 0),
+        "open-iscsi": None,
+    }
+
+
+def test_get_start_times_invalid_timestamp(mocker):
+    """Test that an invalid timestamp raises ValueError."""
+    mocker.patch(
+        "storage_connector.command_utils.subprocess.check_output",
+        return_value=b"ActiveEnterTimestamp=yesterday\n",
+    )
+
+    with pytest.raises(ValueError):
+        systemd_utils.get_start_times(["iscsid"])
+
+
+def test_get_active_states(mocker):
+    """Test reading the services' active states."""
+    mocker.patch(
+        "storage_connector.command_utils.subprocess.check_output",
+        return_value=b"ActiveState=active\n\nActiveState=failed\n",
+    )
+
+    assert systemd_utils.get_active_states(["iscsid", "open-iscsi"]) == {
+        "iscsid": "active",
+        "open-iscsi": "failed",
+    }
+
+
+PROC_NET_UNIX = (
+    "Num       RefCount Protocol Flags    Type St Inode Path\n"
+    "0000000000000000: 00000002 00000000 00010000 0001 01 20 @ISCSIADM_ABSTRACT_NAMESPACE\n"
+    "0000000000000000: 00000003 00000000 00000000 0001 03 21 /run/systemd/notify\n"
+    "0000000000000000: 00000003 00000000 00000000 0001 03 22\n"
+)
+
+
+@pytest.mark.parametrize(
+    "path, expected",
+    [
+        ("@ISCSIADM_ABSTRACT_NAMESPACE", True),
+        ("/run/systemd/notify", False),
+        ("/run/missing.sock", False),
+    ],
+)
+def test_is_unix_socket_listening(mocker, path, expected):
+    """Test detection of listening unix sockets."""
+    mock_proc = mocker.patch("storage_connector.systemd_utils.PROC_NET_UNIX")
+    mock_proc.read_text.return_value = PROC_NET_UNIX
+
+    assert systemd_utils.is_unix_socket_listening(path) is expected
+
+
+def test_wait_until_ready(mocker):
+    """Test waiting until services are active and pass their checks."""
+    mock_sleep = mocker.patch("storage_connector.systemd_utils.time.sleep")
+    mocker.patch(
+        "storage_connector.systemd_utils.get_active_states",
+        side_effect=[
+            {"iscsid": "activating", "multipathd": "active"},
+            {"iscsid": "active"},
+            {"iscsid": "active"},
+        ],
+    )
+    check = mocker.Mock(side_effect=[False, True])
+
+    pending = systemd_utils.wait_until_ready(
+        ["iscsid", "multipathd"], timeout=10, checks={"iscsid": check}
+    )
+
+    assert pending == []
+    assert mock_sleep.call_count == 2
+    assert check.call_count == 2
+
+
+def test_wait_until_ready_timeout(mocker):
+    """Test services still not ready at the deadline are returned."""
+    mocker.patch("storage_connector.systemd_utils.time.sleep")
+    mocker.patch("storage_connector.systemd_utils.time.monotonic", side_effect=[0, 5, 11])
+    mocker.patch(
+        "storage_connector.systemd_utils.get_active_states", return_value={"iscsid": "failed"}
+    )
+
+    assert systemd_utils.wait_until_ready(["iscsid"], timeout=10) == ["iscsid"]
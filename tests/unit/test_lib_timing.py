@@ -0,0 +1,76 @@
+"""Unit tests for the hook timing library."""
+
+import json
+
+import pytest
+from storage_connector import timing_utils
+
+
+@pytest.fixture(autouse=True)
+def no_current_profile(mocker):
+    """Start every test without a current profile."""
+    mocker.patch("storage_connector.timing_utils._current", None)
+
+
+def test_span_nested(mocker):
+    """Test nested spans are named after their parents, in the order they started."""
+    mocker.patch("storage_connector.timing_utils.time.monotonic", side_effect=range(10))
+    profile = timing_utils.start("config-changed")
+
+    with timing_utils.span("reconcile"):
+        with timing_utils.span("iscsi"):
+            pass
+        with timing_utils.span("multipath"):
+            pass
+
+    assert profile.spans == [
+        timing_utils.Span("reconcile", 5),
+        timing_utils.Span("reconcile/iscsi", 1),
+        timing_utils.Span("reconcile/multipath", 1),
+    ]
+    assert profile.to_dict()["spans"] == [
+        ["reconcile", 5],
+        ["reconcile/iscsi", 1],
+        ["reconcile/multipath", 1],
+    ]
+
+
+def test_span_failed_step():
+    """Test a step raising an exception is timed all the same."""
+    profile = timing_utils.start("install")
+
+    with pytest.raises(RuntimeError):
+        with timing_utils.span("apt update"):
+            raise RuntimeError
+
+    with timing_utils.span("apt install"):
+        pass
+    assert [span.name for span in profile.spans] == ["apt update", "apt install"]
+
+
+def test_span_without_profile():
+    """Test spans are not timed if no profile was started."""
+    with timing_utils.span("reconcile"):
+        pass
+
+
+def test_save_profile(tmp_path):
+    """Test only the most recent profiles are kept."""
+    path = tmp_path / "storage-connector" / "hook-timings.json"
+    for hook in ["install", "config-changed", "start"]:
+        timing_utils.save_profile(path, timing_utils.Profile(hook), history=2)
+
+    profiles = timing_utils.load_profiles(path)
+
+    assert [profile["hook"] for profile in profiles] == ["config-changed", "start"]
+    assert json.loads(path.read_text()) == profiles
+    assert list(path.parent.iterdir()) == [path]
+
+
+def test_load_profiles_missing_or_corrupted(tmp_path):
+    """Test missing or corrupted files have no profiles."""
+    path = tmp_path / "hook-timings.json"
+    assert timing_utils.load_profiles(path) == []
+
+    path.write_text("[{")
+    assert timing_utils.load_profiles(path) == []
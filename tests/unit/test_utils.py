@@ -1,3 +1,5 @@
+from unittest.mock import mock_open
+
 import utils
 
 
@@ -12,3 +14,24 @@ def test_is_container(mocker):
     result = utils.is_container()
     mock_exists.assert_called_once_with("/run/container_type")
     assert result
+
+
+def test_is_container_systemd(mocker):
+    mocker.patch("utils.init_is_systemd", return_value=True)
+    mock_call = mocker.patch("utils.command_utils.subprocess.call", return_value=0)
+
+    assert utils.is_container()
+    mock_call.assert_called_once_with(["systemd-detect-virt", "--container"])
+
+
+def test_get_boot_id(mocker):
+    mock_file = mocker.patch("utils.open", mock_open(read_data="abc-123\n"))
+
+    assert utils.get_boot_id() == "abc-123"
+    mock_file.assert_called_once_with("/proc/sys/kernel/random/boot_id", encoding="utf-8")
+
+
+def test_get_boot_id_unreadable(mocker):
+    mocker.patch("utils.open", side_effect=FileNotFoundError)
+
+    assert utils.get_boot_id() is None